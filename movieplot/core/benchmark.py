@@ -0,0 +1,44 @@
+__author__ = 'benjamin'
+
+import time
+
+from collections import OrderedDict
+
+# Benchmarks registered by the benchmarks module of each installed app
+registry = OrderedDict()
+
+def benchmark(func):
+    """
+    Registers a benchmark function with the benchmark management command.
+    Benchmarks take the command options as keyword arguments and return
+    a list of (label, value, unit) rows to report.
+    """
+    registry[func.__name__] = func
+    return func
+
+class Timer(object):
+    """
+    Context manager that records the wall clock time spent inside it.
+    """
+
+    def __init__(self):
+        self.start   = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.start
+
+def best_of(func, repeat=3):
+    """
+    Returns the fastest of repeat timings of calling func.
+    """
+    timings = []
+    for idx in xrange(max(repeat, 1)):
+        with Timer() as timer:
+            func()
+        timings.append(timer.elapsed)
+    return min(timings)
@@ -1,26 +1,122 @@
 __author__ = 'benjamin'
 
+import heapq
+
+from operator import itemgetter
+
+INTEGER_TYPES = set((int, long))
+
 class Histogram(dict):
     """
     A dictionary-like object that only allows integers to be stored as
     values on the dictionary to maintain frequency counting. Helper
     methods have also been added to do frequency-like things.
+
+    The total of all frequencies is kept up to date as the histogram
+    changes, so total, distinct and average are O(1), and the k most or
+    least common items are found with a heap rather than a full sort.
+    It is created and updated like a dict (update replaces frequencies);
+    use count() to count the items of an iterable and add() to add the
+    frequencies of a mapping.
     """
 
+    def __init__(self, *args, **kwargs):
+        super(Histogram, self).__init__()
+        self._total = 0
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
     def __setitem__(self, key, value):
         """
         Only allows integers to be set on the dictionary, raises a
         C{ValueError} if something else attempts to be set on it.
         """
-        if not isinstance(value, int):
+        if not isinstance(value, (int, long)):
             raise ValueError("Set only frequency data as integers")
+        self._total += value - self.get(key, 0)
         super(Histogram, self).__setitem__(key, value)
 
-    def increase(self, key, amount):
+    def __delitem__(self, key):
+        self._total -= self[key]
+        super(Histogram, self).__delitem__(key)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def pop(self, key, *default):
         if key in self:
-            self[key] += amount
-        else:
-            self[key] = amount
+            self._total -= self[key]
+        return super(Histogram, self).pop(key, *default)
+
+    def popitem(self):
+        key, value = super(Histogram, self).popitem()
+        self._total -= value
+        return key, value
+
+    def setdefault(self, key, default=0):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        super(Histogram, self).clear()
+        self._total = 0
+
+    def copy(self):
+        return self.__class__(self)
+
+    def update(self, *args, **kwargs):
+        """
+        Sets the frequencies of a mapping or an iterable of (key, value)
+        pairs, replacing any already set, like dict.update.
+        """
+        if len(args) > 1:
+            raise TypeError("update expected at most 1 arguments, got %i" % len(args))
+
+        items = args[0] if args else ()
+        if hasattr(items, 'iteritems'):
+            if not self and set(map(type, items.itervalues())) <= INTEGER_TYPES:
+                # Copy counts into an empty histogram in one go
+                dict.update(self, items)
+                self._total = sum(self.itervalues())
+                items = ()
+            else:
+                items = items.iteritems()
+        elif hasattr(items, 'keys'):
+            items = ((key, items[key]) for key in items.keys())
+
+        for key, value in items:
+            self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def add(self, counts):
+        """
+        Adds the frequencies of a mapping (or of (key, value) pairs) to
+        those already counted.
+        """
+        items = counts.iteritems() if hasattr(counts, 'iteritems') else counts
+        for key, value in items:
+            self.increase(key, value)
+        return self
+
+    def count(self, iterable):
+        """
+        Counts each item of the iterable once and returns the histogram.
+        """
+        # Bypass the checked __setitem__ for the counting loop
+        get, setitem, total = self.get, dict.__setitem__, 0
+        for key in iterable:
+            setitem(self, key, get(key, 0) + 1)
+            total += 1
+        self._total += total
+        return self
+
+    def increase(self, key, amount):
+        if not isinstance(amount, (int, long)):
+            raise ValueError("Set only frequency data as integers")
+        dict.__setitem__(self, key, self.get(key, 0) + amount)
+        self._total += amount
 
     def decrease(self, key, amount):
         if key in self:
@@ -29,30 +125,53 @@ class Histogram(dict):
             self[key] = 0
 
     def increment(self, key):
-        self.increase(key, 1)
+        dict.__setitem__(self, key, self.get(key, 0) + 1)
+        self._total += 1
     incr = increment
 
     def decrement(self, key):
         self.decrease(key, 1)
     decr = decrement
 
+    def most_common(self, k=None):
+        """
+        Returns the k most common (key, frequency) pairs, or all of them.
+        """
+        if k is None:
+            return sorted(self.iteritems(), key=itemgetter(1), reverse=True)
+        return heapq.nlargest(k, self.iteritems(), key=itemgetter(1))
+
+    def least_common(self, k=None):
+        """
+        Returns the k least common (key, frequency) pairs, or all of them.
+        """
+        if k is None:
+            return sorted(self.iteritems(), key=itemgetter(1))
+        return heapq.nsmallest(k, self.iteritems(), key=itemgetter(1))
+
     @property
     def maximum(self):
-        key = max(self, key=self.get)
-        return key, self[key]
+        if not self:
+            raise ValueError("maximum of an empty histogram")
+        return self.most_common(1)[0]
     max = maximum
 
     @property
     def minimum(self):
-        key = min(self, key=self.get)
-        return key, self[key]
+        if not self:
+            raise ValueError("minimum of an empty histogram")
+        return self.least_common(1)[0]
     min = minimum
 
     @property
     def average(self):
-        return sum(self.values()) / len(self)
+        return self.total / len(self)
     mean = average
 
+    @property
+    def distinct(self):
+        return len(self)
+
     @property
     def total(self):
-        return sum(self.values())
\ No newline at end of file
+        return self._total
@@ -0,0 +1,84 @@
+"""
+Text normalization for titles, names and search queries: punctuation
+stripping, case folding, stopword removal and slugging.
+
+Unicode text goes through unicode.translate with translation tables that
+look up the category of a character only the first time it is seen, so
+the cost of a call depends on the length of the text and not on the size
+of the unicode character set. Byte strings use the 256 character tables
+of the string module.
+"""
+
+__author__ = 'benjamin'
+
+import re
+import string
+import unicodedata
+
+from django.utils.encoding import smart_unicode
+
+STOPWORDS = frozenset(("the", "a", "an", "of", "at", "on", "to", "over", "and", "but", "or", "nor"))
+
+class TranslationTable(dict):
+    """
+    A unicode.translate table of ordinals that computes the translation
+    of a character with func on first lookup and caches it: func returns
+    None to delete the character, or its replacement.
+    """
+
+    def __init__(self, func):
+        super(TranslationTable, self).__init__()
+        self.func = func
+
+    def __missing__(self, ordinal):
+        value = self.func(unichr(ordinal))
+        self[ordinal] = value
+        return value
+
+def _strip_punctuation(char):
+    return None if unicodedata.category(char).startswith('P') else ord(char)
+
+def _slug_char(char):
+    category = unicodedata.category(char)[0]
+    if category in "LN" or char in "-_~":
+        return ord(char)
+    if category == "Z":
+        return u" "
+    return None
+
+PUNCTUATION = TranslationTable(_strip_punctuation)
+SLUG        = TranslationTable(_slug_char)
+SLUG_SPACES = re.compile(r"[-\s]+", re.UNICODE)
+
+def remove_punctuation(text):
+    """
+    Deletes the punctuation characters (unicode category P) of the text.
+    """
+    if isinstance(text, str):
+        return text.translate(None, string.punctuation)
+    elif isinstance(text, unicode):
+        return text.translate(PUNCTUATION)
+    else:
+        raise TypeError("Could not remove punctuation from type %s" % type(text))
+
+def casefold(text):
+    return text.lower()
+
+def remove_stopwords(terms, stopwords=STOPWORDS):
+    return [term for term in terms if term not in stopwords]
+
+def terms(text, stopwords=STOPWORDS):
+    """
+    Returns the search terms of a text: without punctuation, case folded
+    and split on whitespace, less the stopwords.
+    """
+    if not text: return []
+    return remove_stopwords(casefold(remove_punctuation(text)).split(), stopwords)
+
+def slugify(text):
+    """
+    Keeps the letters, numbers and "-_~" of the text, joins its words
+    with hyphens and lowercases it, for use in URLs.
+    """
+    text = unicode(smart_unicode(text)).translate(SLUG)
+    return SLUG_SPACES.sub(u"-", text.strip()).lower()
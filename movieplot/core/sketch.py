@@ -0,0 +1,332 @@
+"""
+Approximate, memory-bounded counting for corpus-level aggregation, where
+a Histogram would keep an entry for every distinct key (most of them
+singletons that nobody asks about).
+
+A CountMinSketch estimates the count of any key from a fixed table of
+counters: an estimate is never below the true count, and exceeds it by
+at most error * total with probability 1 - delta. An ApproximateHistogram
+adds a bounded set of heavy hitters, the keys with the largest estimates,
+so that the most common keys can still be listed.
+
+Keys are hashed with md5 of their utf-8 text (tuples of tokens are joined
+with a unit separator), so that sketches built in different processes or
+on different machines can be merged.
+"""
+
+__author__ = 'benjamin'
+
+import os
+import sys
+import math
+import heapq
+import pickle
+import struct
+import hashlib
+
+from array import array
+from operator import itemgetter
+
+SEPARATOR = u'\x1f'
+DIGEST    = struct.Struct('<QQ')
+
+def key_digest(key):
+    """
+    Returns two 64 bit hashes of a string or a tuple of strings.
+    """
+    if isinstance(key, tuple):
+        key = SEPARATOR.join(key)
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return DIGEST.unpack(hashlib.md5(key).digest())
+
+def sizeof(key):
+    """
+    Returns the approximate number of bytes held by a key.
+    """
+    size = sys.getsizeof(key)
+    if isinstance(key, tuple):
+        size += sum(sys.getsizeof(item) for item in key)
+    return size
+
+class CountMinSketch(object):
+    """
+    A depth x width table of counters; each key increments one counter
+    per row and its count is estimated by the smallest of them.
+
+    The width is e / error and the depth ln(1 / delta), unless max_bytes
+    caps the size of the table, in which case the width is reduced and
+    the error grows accordingly.
+    """
+
+    # Default bound on the overestimate, relative to the total count
+    error = 0.0001
+
+    # Default probability that an estimate exceeds the bound
+    delta = 0.01
+
+    def __init__(self, error=None, delta=None, max_bytes=None):
+        error = error if error is not None else self.error
+        delta = delta if delta is not None else self.delta
+        if not 0 < error < 1 or not 0 < delta < 1:
+            raise ValueError("The error and delta of a sketch must be between 0 and 1.")
+
+        self.depth = int(math.ceil(math.log(1.0 / delta)))
+        self.width = int(math.ceil(math.e / error))
+
+        itemsize = array('L').itemsize
+        if max_bytes is not None:
+            if max_bytes < self.depth * itemsize:
+                raise ValueError("%i bytes cannot hold a sketch of depth %i." % (max_bytes, self.depth))
+            self.width = min(self.width, max_bytes // (self.depth * itemsize))
+
+        # The error actually achieved by the (possibly capped) width
+        self.error  = math.e / self.width
+        self.delta  = delta
+        self.tables = [array('L', [0]) * self.width for row in xrange(self.depth)]
+        self._total = 0
+
+    def indexes(self, key):
+        """
+        Returns the column of the key in each row, by double hashing.
+        """
+        alpha, beta = key_digest(key)
+        beta |= 1
+        return [(alpha + row * beta) % self.width for row in xrange(self.depth)]
+
+    def increase(self, key, amount=1):
+        """
+        Adds amount to the count of the key and returns its new estimate.
+        """
+        if not isinstance(amount, (int, long)) or amount < 0:
+            raise ValueError("Only positive integer counts can be added to a sketch")
+
+        estimate = None
+        for table, idx in zip(self.tables, self.indexes(key)):
+            table[idx] += amount
+            if estimate is None or table[idx] < estimate:
+                estimate = table[idx]
+        self._total += amount
+        return estimate
+
+    def increment(self, key):
+        return self.increase(key, 1)
+    incr = increment
+
+    def decrease(self, key, amount=1):
+        """
+        Takes amount back off the count of the key (a turnstile update)
+        and returns its new estimate. Estimates stay overestimates as long
+        as no more is taken off a key than was added to it.
+        """
+        if not isinstance(amount, (int, long)) or amount < 0:
+            raise ValueError("Only positive integer counts can be taken off a sketch")
+
+        indexes = self.indexes(key)
+        if any(table[idx] < amount for table, idx in zip(self.tables, indexes)):
+            raise ValueError("Cannot take %i off a count that was never added to the sketch" % amount)
+
+        for table, idx in zip(self.tables, indexes):
+            table[idx] -= amount
+        self._total -= amount
+        return min(table[idx] for table, idx in zip(self.tables, indexes))
+
+    def decrement(self, key):
+        return self.decrease(key, 1)
+    decr = decrement
+
+    def estimate(self, key):
+        return min(table[idx] for table, idx in zip(self.tables, self.indexes(key)))
+
+    def __getitem__(self, key):
+        return self.estimate(key)
+
+    def get(self, key, default=0):
+        return self.estimate(key) or default
+
+    def update(self, *args):
+        """
+        Adds the counts of a mapping, or counts the items of an iterable.
+        """
+        if len(args) > 1:
+            raise TypeError("update expected at most 1 arguments, got %i" % len(args))
+
+        iterable = args[0] if args else None
+        if iterable is None:
+            return
+        if hasattr(iterable, 'iteritems'):
+            for key, amount in iterable.iteritems():
+                self.increase(key, amount)
+        else:
+            for key in iterable:
+                self.increase(key, 1)
+
+    def add(self, counts):
+        """
+        Adds the counts of a mapping, as Histogram.add does.
+        """
+        self.update(counts)
+        return self
+
+    def subtract(self, counts):
+        """
+        Takes the counts of a mapping, added earlier, back off the sketch.
+        """
+        for key, amount in counts.iteritems():
+            self.decrease(key, amount)
+        return self
+
+    def compatible(self, other):
+        return self.depth == other.depth and self.width == other.width
+
+    def merge(self, other):
+        """
+        Adds the counts of a sketch of the same shape to this one.
+        """
+        if not self.compatible(other):
+            raise ValueError("Only sketches of the same width and depth can be merged.")
+        for table, counts in zip(self.tables, other.tables):
+            for idx, count in enumerate(counts):
+                if count: table[idx] += count
+        self._total += other.total
+        return self
+
+    @property
+    def total(self):
+        return self._total
+
+    @property
+    def bound(self):
+        """
+        The overestimate that an estimate exceeds with probability delta.
+        """
+        return int(math.ceil(self.error * self.total))
+
+    @property
+    def nbytes(self):
+        return sum(table.itemsize * len(table) for table in self.tables)
+
+    def save(self, path):
+        """
+        Pickles the sketch to a temporary file and renames it into place.
+        """
+        temp = "%s.%i.tmp" % (path, os.getpid())
+        with open(temp, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp, path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            try:
+                sketch = pickle.load(f)
+            except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, IndexError):
+                raise ValueError("%s is not a saved sketch." % path)
+        if not isinstance(sketch, cls):
+            raise ValueError("%s does not hold a %s." % (path, cls.__name__))
+        return sketch
+
+class ApproximateHistogram(CountMinSketch):
+    """
+    A count-min sketch that keeps the heavy hitters, the keys with the
+    largest estimates, so that it can stand in for a Histogram when
+    aggregating counts: items(), most_common() and len() cover the heavy
+    hitters only, while any key can be looked up for an estimate.
+    """
+
+    # Default number of heavy hitters kept
+    heavy_hitters = 1000
+
+    def __init__(self, error=None, delta=None, max_bytes=None, heavy_hitters=None):
+        super(ApproximateHistogram, self).__init__(error, delta, max_bytes)
+        if heavy_hitters is not None:
+            self.heavy_hitters = heavy_hitters
+        self.heavy = {}
+        self._heap = []
+
+    def increase(self, key, amount=1):
+        estimate = super(ApproximateHistogram, self).increase(key, amount)
+        self.offer(key, estimate)
+        return estimate
+
+    def decrease(self, key, amount=1):
+        estimate = super(ApproximateHistogram, self).decrease(key, amount)
+        if key in self.heavy:
+            if estimate:
+                self.heavy[key] = estimate
+                heapq.heappush(self._heap, (estimate, key))
+            else:
+                del self.heavy[key]
+        return estimate
+
+    def offer(self, key, estimate):
+        """
+        Keeps the key as a heavy hitter if its estimate is among the
+        largest, evicting the smallest heavy hitter if there is no room.
+        """
+        if key not in self.heavy and len(self.heavy) >= self.heavy_hitters:
+            if not self.heavy_hitters or estimate <= self.floor():
+                return
+            del self.heavy[heapq.heappop(self._heap)[1]]
+
+        self.heavy[key] = estimate
+        heapq.heappush(self._heap, (estimate, key))
+
+        # Outdated heap entries are dropped lazily, compact if they pile up
+        if len(self._heap) > 4 * max(self.heavy_hitters, 16):
+            self._heap = [(count, key) for key, count in self.heavy.iteritems()]
+            heapq.heapify(self._heap)
+
+    def floor(self):
+        """
+        Returns the smallest estimate of the heavy hitters.
+        """
+        while self._heap[0][0] != self.heavy.get(self._heap[0][1]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0]
+
+    def merge(self, other):
+        super(ApproximateHistogram, self).merge(other)
+
+        # Re-estimate the candidates of both sketches against the merged table
+        candidates = set(self.heavy) | set(getattr(other, 'heavy', ()))
+        estimates  = [(self.estimate(key), key) for key in candidates]
+        self.heavy = dict((key, count) for count, key in heapq.nlargest(self.heavy_hitters, estimates))
+        self._heap = [(count, key) for key, count in self.heavy.iteritems()]
+        heapq.heapify(self._heap)
+        return self
+
+    def most_common(self, k=None):
+        """
+        Returns the k heavy hitters with the largest estimates, or all of them.
+        """
+        if k is None:
+            return sorted(self.heavy.iteritems(), key=itemgetter(1), reverse=True)
+        return heapq.nlargest(k, self.heavy.iteritems(), key=itemgetter(1))
+
+    def iteritems(self):
+        return self.heavy.iteritems()
+
+    def items(self):
+        return self.heavy.items()
+
+    def keys(self):
+        return self.heavy.keys()
+
+    def __iter__(self):
+        return iter(self.heavy)
+
+    def __contains__(self, key):
+        return key in self.heavy
+
+    def __len__(self):
+        return len(self.heavy)
+
+    def __nonzero__(self):
+        return self.total > 0
+
+    @property
+    def nbytes(self):
+        heavy = sys.getsizeof(self.heavy) + sys.getsizeof(self._heap) + sum(map(sizeof, self.heavy))
+        return super(ApproximateHistogram, self).nbytes + heavy
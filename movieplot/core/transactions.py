@@ -0,0 +1,102 @@
+"""
+Callbacks on the outcome of a database transaction, for the process-wide
+caches that must only hold what has been committed (Django 1.4 has no
+transaction hooks of its own).
+
+Outside of a managed transaction Django commits every write as it is
+made, so on_commit() runs its callback at once. Inside one, the callback
+waits for the transaction to be ended by commit_on_success from this
+module, which runs the commit callbacks once Django has committed and the
+rollback callbacks if the block raised. Django commits or rolls back the
+whole transaction when any commit_on_success block ends, nested or not,
+so every callback pending on the connection runs at that point.
+
+Callbacks pending in a transaction that was ended some other way (with
+transaction.commit_manually or Django's own commit_on_success) never run:
+they are dropped the next time this thread works outside a transaction,
+since whether it committed is unknown.
+"""
+
+__author__ = 'benjamin'
+
+import threading
+
+from functools import wraps
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+_state = threading.local()
+
+def pending(using=None):
+    """
+    Returns the (commit, rollback) callback lists of the transaction open
+    on the connection in this thread.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    if not hasattr(_state, 'callbacks'):
+        _state.callbacks = {}
+    if not transaction.is_managed(using=using):
+        _state.callbacks.pop(using, None)
+    return _state.callbacks.setdefault(using, ([], []))
+
+def on_commit(func, using=None):
+    """
+    Calls func once the current transaction commits, or now if there is
+    no managed transaction.
+    """
+    if not transaction.is_managed(using=using):
+        pending(using)
+        func()
+    else:
+        pending(using)[0].append(func)
+
+def on_rollback(func, using=None):
+    """
+    Calls func if the current transaction rolls back.
+    """
+    if transaction.is_managed(using=using):
+        pending(using)[1].append(func)
+
+def finish(using=None, committed=True):
+    """
+    Runs the commit or the rollback callbacks pending on the connection.
+    """
+    commits, rollbacks = _state.__dict__.get('callbacks', {}).pop(using or DEFAULT_DB_ALIAS, ([], []))
+    for func in (commits if committed else rollbacks):
+        func()
+
+class CommitOnSuccess(object):
+    """
+    transaction.commit_on_success that runs the callbacks registered with
+    on_commit and on_rollback when it ends.
+    """
+
+    def __init__(self, using=None):
+        self.using = using
+
+    def __enter__(self):
+        self.transaction = transaction.commit_on_success(using=self.using)
+        self.transaction.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.transaction.__exit__(exc_type, exc_value, traceback)
+        except Exception:
+            finish(self.using, committed=False)
+            raise
+        finish(self.using, committed=exc_type is None)
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with CommitOnSuccess(self.using):
+                return func(*args, **kwargs)
+        return inner
+
+def commit_on_success(using=None):
+    """
+    Use as transaction.commit_on_success: a decorator, with or without a
+    database alias, or a context manager.
+    """
+    if callable(using):
+        return CommitOnSuccess()(using)
+    return CommitOnSuccess(using)
@@ -1,27 +1,36 @@
 __author__ = 'benjamin'
 
-import re
-import sys
-import string
-import unicodedata
+# Text normalization lives in movieplot.core.normalize
+from movieplot.core.normalize import slugify, remove_punctuation
+slugify_unicode = slugify
 
-from django.utils.encoding import smart_unicode
+def chunked(iterable, size):
+    """
+    Yields successive lists of at most size items from the iterable.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-def slugify_unicode(s):
-    chars = []
-    for char in unicode(smart_unicode(s)):
-        cat = unicodedata.category(char)[0]
-        if cat in "LN" or char in "-_~":
-            chars.append(char)
-        elif cat == "Z":
-            chars.append(" ")
-    return re.sub("[-\s]+", "-", "".join(chars).strip()).lower()
-slugify = slugify_unicode
-
-def remove_punctuation(s):
-    if isinstance(s, str):
-        return s.translate(string.maketrans("", ""), string.punctuation)
-    elif isinstance(s, unicode):
-        return s.translate(dict.fromkeys(i for i in xrange(sys.maxunicode) if unicodedata.category(unichr(i)).startswith('P')))
-    else:
-        raise TypeError("Could not remove punctuation from type %s" % type(s))
\ No newline at end of file
+def batched_queryset(queryset, size):
+    """
+    Yields lists of at most size objects from the queryset, ordered by
+    primary key, fetching each batch with its own keyset query so that
+    memory stays flat however large the table is.
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        batch = queryset if last is None else queryset.filter(pk__gt=last)
+        batch = list(batch[:size])
+        if not batch:
+            break
+        yield batch
+        if len(batch) < size:
+            break
+        last = batch[-1]['pk'] if isinstance(batch[-1], dict) else batch[-1].pk
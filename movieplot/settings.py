@@ -154,6 +154,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -162,5 +166,72 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'movies.fragments': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': True,
+        },
     }
 }
+
+# Maximum number of N-Gram natural keys held in the process-wide id cache
+# used by the N-Gram managers and analyzers (0 disables the cache).
+NGRAM_CACHE_SIZE = 100000
+
+# Memory bound (in bytes) of the process-wide cache of token streams used
+# by the N-Gram analyzers, and an optional directory for an on-disk tier.
+NGRAM_TOKEN_CACHE_BYTES = 64 * 1024 * 1024
+NGRAM_TOKEN_CACHE_DIR = None
+
+# How N-Gram analyses are stored: 'rows' of N-Gram models, or 'packed'
+# arrays of (N-Gram id, frequency) per order on the analysis itself. Use
+# the pack command to convert existing analyses.
+NGRAM_STORAGE = 'rows'
+
+# Lowest order of N-Gram stored in the single hashed N-Gram table rather
+# than the Bigram and Trigram tables; orders above 3 are always hashed.
+NGRAM_HASH_ORDER = 4
+
+# Number of N-Grams kept on each top-k leaderboard, and the orders that
+# the leaderboards command builds boards for.
+NGRAM_LEADERBOARD_SIZE = 100
+NGRAM_LEADERBOARD_ORDERS = (1, 2, 3)
+
+# Seconds between the checks of the in-process title search index for
+# movies changed by other processes (changes made in-process apply at once).
+MOVIE_SEARCH_REFRESH = 5
+
+# Most movies of a title search that are fetched with one query (their
+# ids are inlined into it), best first; keyset pages of the search are
+# fetched by id from the full ranking and are not limited.
+MOVIE_SEARCH_MAX_RESULTS = 1000
+
+# Seconds before the cached pool of ids that random movies are drawn from
+# is reloaded, to pick up movies added or removed by other processes.
+MOVIE_SAMPLE_TTL = 300
+
+# Seconds that the result count of a movie search is cached for, per set
+# of normalized search terms.
+MOVIE_SEARCH_COUNT_TIMEOUT = 60
+
+# Every process of the site must share the cache, so that the writes of
+# one (the management commands among them) invalidate the movie detail
+# fragments cached by the others: point this at your memcached servers.
+# The per-process local-memory cache is only fit for the tests (see
+# movieplot.test_settings).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': '127.0.0.1:11211',
+    },
+}
+
+# Name of the cache (in CACHES) that the rendered fragments of the movie
+# detail page are stored in, and the seconds they are kept for; writes to
+# the movies and their analyses invalidate them before then.
+MOVIE_FRAGMENT_CACHE = 'default'
+MOVIE_FRAGMENT_TIMEOUT = 3600
+
+# Number of fragment lookups between the log lines (to the movies.fragments
+# logger) with the hit and miss counters of the fragment cache of a process.
+MOVIE_FRAGMENT_LOG_EVERY = 1000
@@ -0,0 +1,17 @@
+# Django settings for running the movieplot tests:
+#
+#     python manage.py test ngram movies --settings=movieplot.test_settings
+
+from movieplot.settings import *
+
+# The tests run in one process, so a local-memory cache will do. The movie
+# detail fragments take three entries per movie, more than the 300 that
+# Django keeps by default.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    },
+}
@@ -1,5 +1,5 @@
 from django.conf.urls import patterns, include, url
-from django.views.generic import TemplateView
+from movies.views import HomePage
 
 # DEBUGGING MEDIA FILES:
 from django.conf import settings
@@ -10,7 +10,7 @@ from django.contrib import admin
 admin.autodiscover()
 
 urlpatterns = patterns('',
-    url(r'^$', TemplateView.as_view(template_name="index.html"), name='index'),
+    url(r'^$', HomePage.as_view(), name='index'),
     url(r'^movies/', include('movies.urls')),
     url(r'^analyze/', include('ngram.urls')),
 
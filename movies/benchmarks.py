@@ -0,0 +1,139 @@
+__author__ = 'benjamin'
+
+import os
+import re
+import sys
+import codecs
+import unicodedata
+
+from movies.models import Movie
+from movieplot.core import normalize
+from movies.search import TitleIndex, title_index
+from movies.sampling import movie_sampler
+from movies.fragments import fragment_cache
+from movieplot.core.utils import remove_punctuation
+from movieplot.core.benchmark import benchmark, best_of
+
+def fixture_titles():
+    path = os.path.join(os.path.dirname(__file__), 'fixtures', 'title_list_clean.txt')
+    with codecs.open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def legacy_remove_punctuation(s):
+    """
+    remove_punctuation before movieplot.core.normalize, for comparison.
+    """
+    return s.translate(dict.fromkeys(i for i in xrange(sys.maxunicode) if unicodedata.category(unichr(i)).startswith('P')))
+
+def legacy_slugify(s):
+    chars = []
+    for char in unicode(s):
+        cat = unicodedata.category(char)[0]
+        if cat in "LN" or char in "-_~":
+            chars.append(char)
+        elif cat == "Z":
+            chars.append(" ")
+    return re.sub("[-\s]+", "-", "".join(chars).strip()).lower()
+
+def icontains_search(title):
+    """
+    The search that the title index replaced: a LIKE filter per keyword.
+    """
+    queryset = Movie.objects.all()
+    stopwords = ("the", "a", "an", "of", "at", "on", "to", "over", "and", "but", "or", "nor")
+    for keyword in remove_punctuation(title).split():
+        if keyword.lower() in stopwords: continue
+        queryset = queryset.filter(title__icontains=keyword)
+    return queryset
+
+@benchmark
+def search(repeat=3, limit=100, **options):
+    """
+    Title search with the inverted index against chained icontains filters.
+    """
+    titles  = Movie.objects.exclude(title='').values_list('title', flat=True)[:limit]
+    queries = [u" ".join(title.split()[:2]) for title in titles]
+    if not queries: return []
+
+    def page(search):
+        # What a search request costs: the count and the first page
+        for query in queries:
+            queryset = search(query)
+            queryset.count()
+            list(queryset[:20])
+
+    title_index.sync()
+    return [
+        ("build index of %i titles" % Movie.objects.count(), best_of(lambda: TitleIndex().build(), repeat), "sec"),
+        ("icontains, %i queries" % len(queries), best_of(lambda: page(icontains_search), repeat), "sec"),
+        ("title index, %i queries" % len(queries), best_of(lambda: page(Movie.objects.search), repeat), "sec"),
+        ("index lookups only, %i queries" % len(queries), best_of(lambda: [title_index.search(query) for query in queries], repeat), "sec"),
+    ]
+
+@benchmark
+def normalization(repeat=3, **options):
+    """
+    Per-call cost of the text normalization of the title fixtures.
+    """
+    titles = fixture_titles()
+    longer = [title * 10 for title in titles]
+    calls  = float(len(titles))
+
+    def per_call(func, texts):
+        return 1e6 * best_of(lambda: [func(text) for text in texts], repeat) / len(texts)
+
+    # The legacy punctuation table is rebuilt per call, so time only a few
+    return [
+        ("legacy remove_punctuation", per_call(legacy_remove_punctuation, titles[:3]), "usec/call"),
+        ("remove_punctuation, %i titles" % calls, per_call(normalize.remove_punctuation, titles), "usec/call"),
+        ("remove_punctuation, 10x longer titles", per_call(normalize.remove_punctuation, longer), "usec/call"),
+        ("remove_punctuation, byte strings", per_call(normalize.remove_punctuation, [title.encode('utf-8') for title in titles]), "usec/call"),
+        ("legacy slugify", per_call(legacy_slugify, titles), "usec/call"),
+        ("slugify", per_call(normalize.slugify, titles), "usec/call"),
+        ("slugify, 10x longer titles", per_call(normalize.slugify, longer), "usec/call"),
+        ("search terms", per_call(normalize.terms, titles), "usec/call"),
+    ]
+
+@benchmark
+def random_movies(repeat=3, limit=100, **options):
+    """
+    Drawing random movies from the id pool against ORDER BY RANDOM().
+    """
+    if not Movie.objects.exclude(plot__isnull=True).exists(): return []
+    movie_sampler.load()
+
+    return [
+        ("order_by('?'), %i movies" % limit, best_of(lambda: [Movie.objects.exclude(plot__isnull=True).order_by('?')[0] for idx in xrange(limit)], repeat), "sec"),
+        ("sampler, %i movies" % limit, best_of(lambda: [Movie.objects.random() for idx in xrange(limit)], repeat), "sec"),
+        ("sampler, %i samples of 6" % limit, best_of(lambda: [Movie.objects.random_sample(6) for idx in xrange(limit)], repeat), "sec"),
+        ("load pool of %i ids" % len(movie_sampler), best_of(movie_sampler.load, repeat), "sec"),
+    ]
+
+@benchmark
+def movie_detail(repeat=3, limit=100, **options):
+    """
+    Rendering the movie detail fragments against serving them cached.
+    """
+    from movies.views import MovieDetail
+
+    movies = list(Movie.objects.order_by('pk')[:limit])
+    if not movies: return []
+
+    def render(invalidate=False):
+        for movie in movies:
+            if invalidate: fragment_cache.invalidate(movie.pk)
+            view = MovieDetail(object=movie)
+            view.get_context_data(object=movie)
+
+    fragment_cache.reset()
+    rendered = best_of(lambda: render(invalidate=True), repeat)
+    # Drop the fragments orphaned by the invalidating runs
+    fragment_cache.cache.clear()
+    render()
+    fragment_cache.reset()
+    cached = best_of(render, repeat)
+    return [
+        ("rendered, %i movies" % len(movies), rendered, "sec"),
+        ("cached, %i movies" % len(movies), cached, "sec"),
+        ("hit rate of cached runs", fragment_cache.hit_rate, "ratio"),
+    ]
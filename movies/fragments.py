@@ -0,0 +1,210 @@
+"""
+Per-movie cache of the rendered fragments of the movie detail page (the
+movie with its genres, people and similar movies, and its N-Gram
+analysis) in the Django cache named by MOVIE_FRAGMENT_CACHE.
+
+Each fragment of a movie has a version key, and the fragment itself is
+stored under a key that includes the version. Writes invalidate a
+fragment by giving it a new version rather than deleting it, and old
+versions simply expire after MOVIE_FRAGMENT_TIMEOUT seconds. A write in
+a managed transaction gives the fragment a new version at once and again
+when the transaction commits (see movieplot.core.transactions): a render
+that read the rows before the commit stores its stale fragment under a
+version that the second invalidation retires, and a render that reads
+the version after the commit also reads the committed rows. Writes in a
+transaction ended some other way are only invalidated the first time,
+and a render racing with them may be served until it expires.
+
+Only get_many and set_many are used, but the cache must be shared by
+every process of the site, as memcached is: with the local-memory cache
+the writes of one process, the management commands among them, never
+invalidate the fragments cached by the others. The hit
+and miss counters of each process are logged to the movies.fragments
+logger every MOVIE_FRAGMENT_LOG_EVERY lookups.
+
+The receivers below invalidate on the Movie, Genre and Person writes and
+the changes to their relations; ngram.models connects the receivers for
+analyses and similar movies.
+"""
+
+__author__ = 'benjamin'
+
+import uuid
+import logging
+import threading
+
+from functools import partial
+from django.conf import settings
+from django.db import transaction
+from django.core.cache import get_cache
+from django.utils.safestring import mark_safe
+from movieplot.core.transactions import on_commit
+
+logger = logging.getLogger(__name__)
+
+class FragmentCache(object):
+    """
+    Gets the fragments of a movie from the cache, rendering and storing
+    the missing ones. Keeps hit and miss counters for this process.
+    """
+
+    # Every fragment of the movie detail page
+    fragments = ('detail', 'analysis')
+
+    def __init__(self, alias=None, timeout=None):
+        self.alias   = alias
+        self.timeout = timeout
+        self.hits    = 0
+        self.misses  = 0
+        self._cache  = None
+        self._lock   = threading.Lock()
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_cache(self.alias or getattr(settings, 'MOVIE_FRAGMENT_CACHE', 'default'))
+        return self._cache
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return getattr(settings, 'MOVIE_FRAGMENT_TIMEOUT', 3600)
+
+    def version_key(self, name, pk):
+        return "movies:fragment-version:%s:%i" % (name, pk)
+
+    def fragment_key(self, name, pk, version):
+        return "movies:fragment:%s:%i:%s" % (name, pk, version)
+
+    def get_log_every(self):
+        return getattr(settings, 'MOVIE_FRAGMENT_LOG_EVERY', 1000)
+
+    def new_version(self):
+        return uuid.uuid4().hex[:12]
+
+    def versions(self, pk, names):
+        """
+        Returns the current version of each named fragment of the movie,
+        starting a new version for those that have none.
+        """
+        keys     = dict((name, self.version_key(name, pk)) for name in names)
+        cached   = self.cache.get_many(keys.values())
+        versions = dict((name, cached.get(key)) for name, key in keys.items())
+
+        missing = dict((keys[name], self.new_version()) for name, version in versions.items() if version is None)
+        if missing:
+            self.cache.set_many(missing, self.get_timeout())
+            versions.update((name, missing[keys[name]]) for name in names if keys[name] in missing)
+        return versions
+
+    def render(self, pk, renderers):
+        """
+        Returns a dict of the fragments of the movie named by renderers,
+        a dict of names to functions that render the fragment if it is
+        not cached.
+        """
+        versions  = self.versions(pk, renderers.keys())
+        keys      = dict((name, self.fragment_key(name, pk, version)) for name, version in versions.items())
+        cached    = self.cache.get_many(keys.values())
+        fragments = {}
+        rendered  = {}
+
+        for name, key in keys.items():
+            if key in cached:
+                fragments[name] = cached[key]
+            else:
+                fragments[name] = rendered[key] = renderers[name]().strip()
+
+        if rendered:
+            self.cache.set_many(rendered, self.get_timeout())
+
+        with self._lock:
+            lookups      = self.hits + self.misses
+            self.hits   += len(keys) - len(rendered)
+            self.misses += len(rendered)
+
+        every = self.get_log_every()
+        if every and lookups // every != (lookups + len(keys)) // every:
+            logger.info(self.describe())
+
+        return dict((name, mark_safe(fragment)) for name, fragment in fragments.items())
+
+    def invalidate(self, pk, *names):
+        """
+        Gives the named fragments (or all of them) of a movie a new version.
+        """
+        self.invalidate_many([pk], *names)
+
+    def invalidate_many(self, pks, *names):
+        """
+        Gives the named fragments (or all of them) of the movies a new
+        version, and another one when the current transaction commits.
+        """
+        pks, names = list(pks), names or self.fragments
+        self._invalidate(pks, names)
+        if transaction.is_managed():
+            on_commit(partial(self._invalidate, pks, names))
+
+    def _invalidate(self, pks, names):
+        versions = dict((self.version_key(name, pk), self.new_version()) for pk in pks for name in names)
+        if versions:
+            self.cache.set_many(versions, self.get_timeout())
+
+    def reset(self):
+        """
+        Zeroes the counters and looks the cache backend up again.
+        """
+        with self._lock:
+            self.hits   = 0
+            self.misses = 0
+            self._cache = None
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def describe(self):
+        """
+        Returns a line describing the counters of this process.
+        """
+        return "Movie fragment cache: %i hits, %i misses (%0.1f%% hit rate)" % (self.hits, self.misses, 100 * self.hit_rate)
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
+
+# Process-wide fragment cache used by MovieDetail
+fragment_cache = FragmentCache()
+
+def uncache_movie(sender, instance, created=False, **kwargs):
+    # New movies start afresh, in case the id was used before (restores)
+    if created:
+        fragment_cache.invalidate(instance.pk)
+    else:
+        fragment_cache.invalidate(instance.pk, 'detail')
+
+def uncache_movie_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidates the movies whose genres, directors, writers or actors
+    were added, removed or cleared, from either side of the relation.
+    """
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if not reverse:
+        fragment_cache.invalidate(instance.pk, 'detail')
+    elif action == "pre_clear":
+        fragment_cache.invalidate_many(instance.movies.values_list('pk', flat=True), 'detail')
+    else:
+        fragment_cache.invalidate_many(pk_set or (), 'detail')
+
+def uncache_related_movies(sender, instance, created=False, **kwargs):
+    """
+    Invalidates the movies of a renamed genre or person.
+    """
+    if created: return
+    fragment_cache.invalidate_many(instance.movies.values_list('pk', flat=True), 'detail')
@@ -1,10 +1,15 @@
 __author__ = 'benjamin'
 
-from django.db import models
-from movieplot.core.utils import remove_punctuation
+from django.db import models, connection
+from django.conf import settings
+from movies.search import title_index, normalize_terms
+from movies.sampling import movie_sampler
 
 class MovieManager(models.Manager):
 
+    def get_max_results(self):
+        return getattr(settings, 'MOVIE_SEARCH_MAX_RESULTS', 1000)
+
     def search(self, title, **filters):
 
         # Don't return anything on empty search
@@ -12,18 +17,10 @@ class MovieManager(models.Manager):
             return self.none()
         queryset = self.all()
 
-        # Allow for None
-        title = title or ''
-
-        # Remove punctuation
-        title = remove_punctuation(title)
-
-        # Filter on all keywords
-        stopwords = ("the", "a", "an", "of", "at", "on", "to", "over", "and", "but", "or", "nor")
-        for keyword in title.split():
-            keyword = keyword.strip()
-            if keyword.lower() in stopwords: continue
-            queryset = queryset.filter(title__icontains=keyword)
+        # Rank the movies whose titles match all keywords with the index
+        ranked = self.search_ids(title, limit=self.get_max_results())
+        if ranked is not None:
+            queryset = self.ranked(queryset, ranked)
 
         if filters:
             # TODO: implement other filters
@@ -31,8 +28,62 @@ class MovieManager(models.Manager):
 
         return queryset
 
+    def search_ids(self, title, limit=None):
+        """
+        Returns the ids of the movies whose titles match all keywords
+        (only the best limit of them, if given), best first, or None if
+        the title has no keywords.
+        """
+        if not normalize_terms(title):
+            return None
+        return title_index.sync().search(title, limit)
+
+    def ranked(self, queryset, pks):
+        """
+        Filters the queryset to the movies with the primary keys and
+        orders them as they are listed. The keys are integers from the
+        title index, so they are inlined rather than bound as parameters
+        (of which SQLite allows only 999); only the first
+        MOVIE_SEARCH_MAX_RESULTS are kept to bound the size of the query.
+        """
+        pks = list(pks)[:self.get_max_results()]
+        if not pks:
+            return queryset.none()
+
+        qn     = connection.ops.quote_name
+        column = "%s.%s" % (qn(self.model._meta.db_table), qn(self.model._meta.pk.column))
+        rank   = " ".join("WHEN %i THEN %i" % (int(pk), idx) for idx, pk in enumerate(pks))
+        return queryset.extra(
+            select={'search_rank': "CASE %s %s END" % (column, rank)},
+            where=["%s IN (%s)" % (column, ",".join(str(int(pk)) for pk in pks))],
+            order_by=['search_rank'],
+        )
+
     def random(self):
         """
         Returns a random movie with a plot.
         """
-        return self.exclude(plot__isnull=True).order_by('?')[0]
\ No newline at end of file
+        movies = self.random_sample(1)
+        if not movies:
+            raise IndexError("There are no movies with a plot to choose from.")
+        return movies[0]
+
+    def random_sample(self, k):
+        """
+        Returns a list of up to k distinct random movies with a plot,
+        fetched in one query from the ids drawn by the movie sampler.
+        """
+        movies, seen = [], set()
+        while len(movies) < k:
+            drawn = [pk for pk in movie_sampler.sample(k + len(seen)) if pk not in seen][:k - len(movies)]
+            if not drawn: break
+
+            seen.update(drawn)
+            found = self.in_bulk(drawn)
+            for pk in drawn:
+                if pk in found:
+                    movies.append(found[pk])
+                else:
+                    # Deleted by another process since the pool was loaded
+                    movie_sampler.discard(pk)
+        return movies
\ No newline at end of file
@@ -1,5 +1,9 @@
 from django.db import models
 from movies.managers import *
+from movies.search import index_movie, unindex_movie
+from movies.sampling import sample_movie, unsample_movie
+from movies.fragments import uncache_movie, uncache_movie_relations, uncache_related_movies
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from movieplot.core.utils import slugify
 
 blank = { 'null': True, 'blank': True, 'default': None }
@@ -18,8 +22,10 @@ class Movie(models.Model):
     actors       = models.ManyToManyField( 'Actor', related_name="movies" )
     plot         = models.TextField( **blank )
     plot_simple  = models.TextField( **blank )
+    plot_tagged  = models.TextField( editable=False, **blank )
     poster_link  = models.CharField( max_length=255, **blank )
     poster       = models.ImageField( upload_to="posters", **blank )
+    modified     = models.DateTimeField( auto_now=True, null=True, db_index=True )
 
     objects      = MovieManager()
 
@@ -99,3 +105,17 @@ class Actor(Person):
     
     class Meta:
         db_table = "actors"
+
+post_save.connect(index_movie, sender=Movie, dispatch_uid="index_movie")
+post_delete.connect(unindex_movie, sender=Movie, dispatch_uid="unindex_movie")
+post_save.connect(sample_movie, sender=Movie, dispatch_uid="sample_movie")
+post_delete.connect(unsample_movie, sender=Movie, dispatch_uid="unsample_movie")
+post_save.connect(uncache_movie, sender=Movie, dispatch_uid="uncache_movie")
+
+for relation in (Movie.genres, Movie.directors, Movie.writers, Movie.actors):
+    m2m_changed.connect(uncache_movie_relations, sender=relation.through,
+                        dispatch_uid="uncache_%s" % relation.through.__name__)
+
+for related_model in (Genre, Director, Writer, Actor):
+    post_save.connect(uncache_related_movies, sender=related_model,
+                      dispatch_uid="uncache_%s_movies" % related_model.__name__)
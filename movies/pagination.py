@@ -0,0 +1,159 @@
+"""
+Pagination of movie search results without OFFSET scans or a COUNT(*)
+per page.
+
+Keyset pages are addressed by a cursor, the id of the last (or first)
+movie of the neighbouring page: ranked searches page through the ids
+ranked by the title index in memory, and other searches page by primary
+key with "pk > cursor" queries that an index serves whatever the depth.
+Counts that do need a query are cached per normalized search for
+MOVIE_SEARCH_COUNT_TIMEOUT seconds.
+"""
+
+__author__ = 'benjamin'
+
+import hashlib
+
+from django.conf import settings
+from django.http import Http404
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from movieplot.core.normalize import terms
+
+def search_count_key(query):
+    """
+    Returns the cache key of the result count of a search, which is the
+    same for searches with the same terms in any order.
+    """
+    normalized = u" ".join(sorted(set(terms(query)))) or u"*"
+    return "movies:search-count:%s" % hashlib.md5(normalized.encode('utf-8')).hexdigest()
+
+def cached_count(queryset, key, timeout=None):
+    """
+    Returns the count of the queryset, cached under key if one is given.
+    """
+    if key is None:
+        return queryset.count()
+
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        timeout = timeout if timeout is not None else getattr(settings, 'MOVIE_SEARCH_COUNT_TIMEOUT', 60)
+        cache.set(key, count, timeout)
+    return count
+
+class CachedCountPaginator(Paginator):
+    """
+    A numbered paginator whose count is cached under cache_key.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.cache_key = kwargs.pop('cache_key', None)
+        super(CachedCountPaginator, self).__init__(*args, **kwargs)
+        if self.cache_key is not None:
+            self._count = cached_count(self.object_list, self.cache_key)
+
+class KeysetPage(object):
+
+    def __init__(self, object_list, paginator, has_previous, has_next):
+        self.object_list   = object_list
+        self.paginator     = paginator
+        self._has_previous = has_previous
+        self._has_next     = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        return self.object_list[-1].pk if self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        return self.object_list[0].pk if self.object_list else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __repr__(self):
+        return "<Keyset page of %i>" % len(self.object_list)
+
+class KeysetPaginator(object):
+    """
+    Pages a queryset of movies after or before a cursor, through the ids
+    in ranked (the ranking of the title index) if given, or else in order
+    of primary key.
+    """
+
+    def __init__(self, object_list, per_page, ranked=None, cache_key=None):
+        self.object_list = object_list
+        self.per_page    = per_page
+        self.ranked      = ranked
+        self.cache_key   = cache_key
+        self._count      = None
+
+    @property
+    def count(self):
+        if self._count is None:
+            if self.ranked is not None:
+                self._count = len(self.ranked)
+            else:
+                self._count = cached_count(self.object_list, self.cache_key)
+        return self._count
+
+    @property
+    def num_pages(self):
+        return max(1, -(-self.count // self.per_page))
+
+    def cursor(self, value):
+        if value is None or value == '':
+            return None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise Http404("Invalid page cursor '%s'." % value)
+
+    def page(self, after=None, before=None):
+        after, before = self.cursor(after), self.cursor(before)
+        if self.ranked is not None:
+            return self.ranked_page(after, before)
+
+        queryset = self.object_list.order_by('pk')
+        if before is not None:
+            rows = list(queryset.filter(pk__lt=before).order_by('-pk')[:self.per_page + 1])
+            return KeysetPage(rows[:self.per_page][::-1], self, len(rows) > self.per_page, True)
+
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        rows = list(queryset[:self.per_page + 1])
+        return KeysetPage(rows[:self.per_page], self, after is not None, len(rows) > self.per_page)
+
+    def ranked_page(self, after, before):
+        """
+        Slices the ranked ids around the cursor and fetches just those by
+        primary key; a cursor that is no longer ranked starts over from
+        the top.
+        """
+        cursor = after if after is not None else before
+        try:
+            position = self.ranked.index(cursor) if cursor is not None else None
+        except ValueError:
+            position = None
+
+        start = 0
+        if position is not None:
+            start = position + 1 if after is not None else max(0, position - self.per_page)
+
+        pks = self.ranked[start:start + self.per_page]
+        found = dict((movie.pk, movie) for movie in self.object_list.filter(pk__in=pks)) if pks else {}
+        rows = [found[pk] for pk in pks if pk in found]
+        return KeysetPage(rows, self, start > 0, start + self.per_page < len(self.ranked))
@@ -0,0 +1,100 @@
+"""
+Uniform random sampling of movies with a plot from a cached pool of their
+ids, so that drawing a random movie costs a primary key lookup rather
+than the sort of the whole table that ORDER BY RANDOM() does.
+
+The pool is kept current by the post_save and post_delete receivers of
+Movie in this process (once their transaction commits), and reloaded every MOVIE_SAMPLE_TTL seconds to
+pick up the changes made by other processes. Ids of movies deleted
+elsewhere in the meantime are dropped when a draw fails to find them.
+"""
+
+__author__ = 'benjamin'
+
+import time
+import random
+import threading
+
+from functools import partial
+from django.conf import settings
+from movieplot.core.transactions import on_commit
+
+class MovieSampler(object):
+    """
+    Keeps the ids of the movies with a plot in a list (with the position
+    of each id, so that one can be removed in constant time) and draws
+    distinct ids from it uniformly.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl       = ttl if ttl is not None else getattr(settings, 'MOVIE_SAMPLE_TTL', 300)
+        self.pool      = []
+        self.positions = {}
+        self.loaded    = None
+        self._random   = random.Random()
+        self._lock     = threading.Lock()
+
+    def load(self):
+        """
+        Reads the ids of every movie with a plot into the pool.
+        """
+        from movies.models import Movie
+
+        pks = list(Movie.objects.exclude(plot__isnull=True).values_list('pk', flat=True).order_by())
+        with self._lock:
+            self.pool      = pks
+            self.positions = dict((pk, idx) for idx, pk in enumerate(pks))
+            self.loaded    = time.time()
+        return self
+
+    def is_expired(self):
+        return self.loaded is None or time.time() - self.loaded >= self.ttl
+
+    def sample(self, k=1):
+        """
+        Returns a list of min(k, pool size) distinct ids drawn uniformly.
+        """
+        if self.is_expired():
+            self.load()
+        with self._lock:
+            return self._random.sample(self.pool, min(k, len(self.pool)))
+
+    def add(self, pk):
+        with self._lock:
+            if pk not in self.positions:
+                self.positions[pk] = len(self.pool)
+                self.pool.append(pk)
+
+    def discard(self, pk):
+        """
+        Removes an id by moving the last id of the pool into its place.
+        """
+        with self._lock:
+            idx = self.positions.pop(pk, None)
+            if idx is None: return
+            last = self.pool.pop()
+            if idx < len(self.pool):
+                self.pool[idx] = last
+                self.positions[last] = idx
+
+    def clear(self):
+        with self._lock:
+            self.pool      = []
+            self.positions = {}
+            self.loaded    = None
+
+    def __len__(self):
+        return len(self.pool)
+
+# Process-wide sampler used by MovieManager.random and random_sample
+movie_sampler = MovieSampler()
+
+def sample_movie(sender, instance, using=None, **kwargs):
+    if movie_sampler.loaded is None: return
+    if instance.plot is None:
+        on_commit(partial(movie_sampler.discard, instance.pk), using)
+    else:
+        on_commit(partial(movie_sampler.add, instance.pk), using)
+
+def unsample_movie(sender, instance, using=None, **kwargs):
+    on_commit(partial(movie_sampler.discard, instance.pk), using)
@@ -0,0 +1,202 @@
+"""
+In-process inverted index of the terms of movie titles, which serves
+MovieManager.search without a LIKE '%keyword%' scan of the movies table.
+
+Titles are normalized into terms (punctuation removed, lowercased and
+stopwords dropped) and each term keeps a posting set of the ids of the
+movies that have it. The sorted list of terms lets a query term match
+every title term it is a prefix of, so "star" finds "Stars" as well as
+"Star Wars".
+
+The index is built on first use and kept current by the post_save and
+post_delete receivers of Movie in this process, which apply a change once
+its transaction commits (see movieplot.core.transactions), so that rolled
+back writes are never searchable. Changes made by other
+processes are picked up every MOVIE_SEARCH_REFRESH seconds by reading
+the movies modified since the last sync, and the index is rebuilt if the
+number of movies no longer matches (a movie was deleted elsewhere).
+"""
+
+__author__ = 'benjamin'
+
+import math
+import heapq
+import time
+import threading
+
+from bisect import bisect_left, insort
+from functools import partial
+from django.conf import settings
+from movieplot.core.utils import batched_queryset
+from movieplot.core.normalize import terms as normalize_terms
+from movieplot.core.transactions import on_commit
+
+class TitleIndex(object):
+    """
+    Maps title terms to posting sets of movie ids and ranks the movies
+    that match every term of a query.
+    """
+
+    # Number of movies read per query when the index is built
+    batch_size = 5000
+
+    # Query terms shorter than this only match title terms exactly
+    min_prefix = 2
+
+    def __init__(self, refresh=None):
+        self.refresh  = refresh if refresh is not None else getattr(settings, 'MOVIE_SEARCH_REFRESH', 5)
+        self.postings = {}
+        self.terms    = []
+        self.titles   = {}
+        self.built    = False
+        self.synced   = None
+        self.checked  = 0
+        self._lock    = threading.RLock()
+
+    def build(self):
+        """
+        Reads the title of every movie into a fresh index.
+        """
+        from movies.models import Movie
+
+        with self._lock:
+            self.clear()
+            started = time.time()
+            latest  = None
+            for batch in batched_queryset(Movie.objects.values('pk', 'title', 'modified'), self.batch_size):
+                for row in batch:
+                    self._add(row['pk'], row['title'])
+                    if row['modified'] and (latest is None or row['modified'] > latest):
+                        latest = row['modified']
+            self.built   = True
+            self.synced  = latest
+            self.checked = started
+        return self
+
+    def sync(self):
+        """
+        Builds the index on first use, and at most every refresh seconds
+        reads the movies changed since the last sync.
+        """
+        from movies.models import Movie
+
+        with self._lock:
+            if not self.built:
+                return self.build()
+            if time.time() - self.checked < self.refresh:
+                return self
+
+            self.checked = time.time()
+            changed = Movie.objects.values('pk', 'title', 'modified')
+            if self.synced is not None:
+                changed = changed.filter(modified__gte=self.synced)
+            for batch in batched_queryset(changed, self.batch_size):
+                for row in batch:
+                    self.add(row['pk'], row['title'])
+                    if row['modified'] and (self.synced is None or row['modified'] > self.synced):
+                        self.synced = row['modified']
+
+            if Movie.objects.count() != len(self.titles):
+                return self.build()
+        return self
+
+    def add(self, pk, title):
+        """
+        Indexes the title of a movie, replacing its previous title.
+        """
+        with self._lock:
+            self._remove(pk)
+            self._add(pk, title)
+
+    def remove(self, pk):
+        with self._lock:
+            self._remove(pk)
+
+    def clear(self):
+        with self._lock:
+            self.postings.clear()
+            self.titles.clear()
+            self.terms   = []
+            self.built   = False
+            self.synced  = None
+            self.checked = 0
+
+    def _add(self, pk, title):
+        terms = normalize_terms(title)
+        self.titles[pk] = (frozenset(terms), len(terms), (title or u'').lower())
+        for term in self.titles[pk][0]:
+            if term not in self.postings:
+                insort(self.terms, term)
+                self.postings[term] = set()
+            self.postings[term].add(pk)
+
+    def _remove(self, pk):
+        entry = self.titles.pop(pk, None)
+        if entry is None: return
+        for term in entry[0]:
+            postings = self.postings[term]
+            postings.discard(pk)
+            if not postings:
+                del self.postings[term]
+                del self.terms[bisect_left(self.terms, term)]
+
+    def matches(self, term):
+        """
+        Returns the title terms matched by a query term.
+        """
+        if len(term) < self.min_prefix:
+            return [term] if term in self.postings else []
+        start = bisect_left(self.terms, term)
+        end   = start
+        while end < len(self.terms) and self.terms[end].startswith(term):
+            end += 1
+        return self.terms[start:end]
+
+    def search(self, query, limit=None):
+        """
+        Returns the ids of the movies whose titles match every term of
+        the query (only the best limit of them, if given), best first,
+        or None if the query has no terms.
+        """
+        terms = normalize_terms(query)
+        if not terms:
+            return None
+
+        with self._lock:
+            total  = float(max(len(self.titles), 1))
+            scores = None
+            for term in set(terms):
+                # Exact matches outweigh prefix matches, rare terms common ones
+                weights = {}
+                for match in self.matches(term):
+                    postings = self.postings[match]
+                    weight   = math.log(1.0 + total / len(postings)) * (1.0 if match == term else 0.5)
+                    for pk in postings:
+                        if weight > weights.get(pk, 0): weights[pk] = weight
+
+                if scores is None:
+                    scores = weights
+                else:
+                    scores = dict((pk, score + weights[pk]) for pk, score in scores.iteritems() if pk in weights)
+                if not scores:
+                    return []
+
+            # Best score first, then the closest (shortest) title
+            rank = lambda pk: (-scores[pk],) + self.titles[pk][1:] + (pk,)
+            if limit is None:
+                return sorted(scores, key=rank)
+            return heapq.nsmallest(limit, scores, key=rank)
+
+    def __len__(self):
+        return len(self.titles)
+
+# Process-wide title index used by MovieManager.search
+title_index = TitleIndex()
+
+def index_movie(sender, instance, using=None, **kwargs):
+    if title_index.built:
+        on_commit(partial(title_index.add, instance.pk, instance.title), using)
+
+def unindex_movie(sender, instance, using=None, **kwargs):
+    if title_index.built:
+        on_commit(partial(title_index.remove, instance.pk), using)
@@ -5,7 +5,19 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+from datetime import timedelta
+from django.db import connection
 from django.test import TestCase
+from django.utils import timezone
+from movies.models import Movie, Genre, Director
+from movieplot.core import normalize
+from movies.search import title_index, normalize_terms
+from movies.sampling import movie_sampler
+from movies.pagination import search_count_key
+from movies.fragments import FragmentCache, fragment_cache
+from django.core.cache import cache
+from movieplot.core.transactions import commit_on_success
+from django.test.client import RequestFactory
 
 
 class SimpleTest(TestCase):
@@ -15,6 +27,342 @@ class SimpleTest(TestCase):
         """
         self.assertEqual(1 + 1, 2)
 
+class NormalizeTest(TestCase):
+
+    def test_matches_legacy(self):
+        from movies.benchmarks import fixture_titles, legacy_remove_punctuation, legacy_slugify
+        titles = fixture_titles() + [u"Caf\xe9 \u2014 \xabNo\xebl\xbb\u3000\u201cQuotes\u201d", u"  --Spaced_out~  "]
+        for title in titles:
+            self.assertEqual(normalize.slugify(title), legacy_slugify(title))
+        self.assertEqual(map(normalize.remove_punctuation, titles[-2:]), map(legacy_remove_punctuation, titles[-2:]))
+
+    def test_normalization(self):
+        self.assertEqual(normalize.remove_punctuation("Spider-Man: Homecoming!"), "SpiderMan Homecoming")
+        self.assertEqual(normalize.remove_punctuation(u"\xbfQu\xe9?"), u"Qu\xe9")
+        self.assertRaises(TypeError, normalize.remove_punctuation, 42)
+        self.assertEqual(normalize.terms(u"The Lord of the Rings"), [u"lord", u"rings"])
+        self.assertEqual(normalize.terms(u"The Lord of the Rings", stopwords=()), [u"the", u"lord", u"of", u"the", u"rings"])
+        self.assertEqual(normalize.slugify("Star Wars 1977"), u"star-wars-1977")
+
+        # Characters are looked up once, then served from the table
+        size = len(normalize.PUNCTUATION)
+        normalize.remove_punctuation(u"\u2603\u2603!")
+        normalize.remove_punctuation(u"\u2603!")
+        self.assertLessEqual(len(normalize.PUNCTUATION), size + 2)
+
+class MovieSearchTest(TestCase):
+
+    titles = (
+        "Star Wars", "Stars in Their Eyes", "The Lone Star", "Spider-Man",
+        "Spider-Man 2", "Lord of the Rings: The Two Towers", u"Am\xe9lie",
+    )
+
+    def setUp(self):
+        title_index.clear()
+        self.addCleanup(title_index.clear)
+        self.movies = dict((title, Movie.objects.create(title=title, year="2001")) for title in self.titles)
+
+    def search(self, query):
+        return [movie.title for movie in Movie.objects.search(query)]
+
+    def test_normalize_terms(self):
+        self.assertEqual(normalize_terms("The Lord of the Rings: Two Towers"), ["lord", "rings", "two", "towers"])
+        self.assertEqual(normalize_terms(u"Am\xe9lie!"), [u"am\xe9lie"])
+        self.assertEqual(normalize_terms(None), [])
+
+    def test_ranked_matches(self):
+        # Exact terms rank above prefixes, then shorter titles first
+        self.assertEqual(self.search("star"), ["Star Wars", "The Lone Star", "Stars in Their Eyes"])
+        self.assertEqual(self.search("spider-man"), ["Spider-Man", "Spider-Man 2"])
+        self.assertEqual(self.search("rings two"), ["Lord of the Rings: The Two Towers"])
+        self.assertEqual(self.search(u"AM\xc9LIE"), [u"Am\xe9lie"])
+        self.assertEqual(self.search("star rings"), [])
+        self.assertEqual(Movie.objects.search("").count(), 0)
+        self.assertEqual(Movie.objects.search("the").count(), len(self.titles))
+
+    def test_index_follows_saves(self):
+        self.search("star")
+        movie = self.movies["Star Wars"]
+        with commit_on_success():
+            movie.title = "Moon Wars"
+            movie.save()
+            self.movies["The Lone Star"].delete()
+            Movie.objects.create(title="Star Trek", year="2009")
+
+            # Changes are indexed once they commit
+            self.assertEqual(title_index.search("moon"), [])
+
+        self.assertEqual(self.search("star"), ["Star Trek", "Stars in Their Eyes"])
+        self.assertEqual(self.search("moon"), ["Moon Wars"])
+
+        # Changes made by other processes are read on the next refresh
+        Movie.objects.filter(pk=movie.pk).update(title="Star Wars", modified=timezone.now() + timedelta(seconds=1))
+        title_index.checked = 0
+        self.assertEqual(self.search("wars"), ["Star Wars"])
+
+        Movie.objects.filter(title="Star Trek").delete()
+        title_index.checked = 0
+        self.assertEqual(self.search("star"), ["Star Wars", "Stars in Their Eyes"])
+
+    def test_rolled_back_saves(self):
+        self.search("star")
+        with self.assertRaises(ValueError):
+            with commit_on_success():
+                Movie.objects.create(title="Star Dust", year="2007")
+                raise ValueError("rolled back")
+        self.assertEqual(title_index.search("dust"), [])
+
+    def test_max_results(self):
+        with self.settings(MOVIE_SEARCH_MAX_RESULTS=2):
+            self.assertEqual(self.search("star"), ["Star Wars", "The Lone Star"])
+            self.assertEqual(len(Movie.objects.search_ids("star")), len(title_index.search("star")))
+            self.assertEqual(title_index.search("star", 2), title_index.search("star")[:2])
+            ranked = Movie.objects.ranked(Movie.objects.all(), [movie.pk for movie in self.movies.values()])
+            self.assertEqual(ranked.count(), 2)
+
+class MovieSearchViewTest(TestCase):
+
+    def setUp(self):
+        title_index.clear()
+        cache.clear()
+        self.addCleanup(title_index.clear)
+        for idx in xrange(45):
+            Movie.objects.create(title="Star %i" % idx, year="2001")
+        self.factory = RequestFactory()
+
+    def get(self, **params):
+        from movies.views import MovieSearch
+        pagination = params.pop('pagination', 'keyset')
+        response = MovieSearch.as_view(pagination=pagination)(self.factory.get('/movies/', params))
+        return response.context_data
+
+    def test_keyset_pages(self):
+        context = self.get(query="star")
+        self.assertEqual(context['paginator'].count, 45)
+        with self.settings(MOVIE_SEARCH_MAX_RESULTS=10):
+            cache.clear()
+            self.assertEqual(self.get(query="star")['paginator'].count, 45)
+        self.assertFalse(context['page_obj'].has_previous())
+
+        pages = [context['results']]
+        while context['page_obj'].has_next():
+            with self.assertNumQueries(2):
+                context = self.get(query="star", after=context['page_obj'].next_cursor)
+            pages.append(context['results'])
+
+        # The page is fetched by its ids, without the ranking of the search
+        connection.use_debug_cursor = True
+        self.addCleanup(setattr, connection, 'use_debug_cursor', None)
+        start = len(connection.queries)
+        self.get(query="star", after=pages[0][-1].pk)
+        self.assertTrue(connection.queries[start:])
+        self.assertFalse(any("CASE" in query['sql'] for query in connection.queries[start:]))
+
+        self.assertEqual([len(page) for page in pages], [20, 20, 5])
+        self.assertEqual(sum(pages, []), list(Movie.objects.search("star")))
+
+        context = self.get(query="star", before=pages[2][0].pk)
+        self.assertEqual(context['results'], pages[1])
+        self.assertTrue(context['page_obj'].has_previous())
+        self.assertTrue(float(context['query_time']) >= 0)
+
+    def test_query_time_excludes_index_build(self):
+        import time
+        build = title_index.build
+        title_index.build = lambda: time.sleep(0.2) or build()
+        self.addCleanup(delattr, title_index, 'build')
+        context = self.get(query="star")
+        self.assertEqual(context['paginator'].count, 45)
+        self.assertTrue(float(context['query_time']) < 0.2)
+
+    def test_cached_counts(self):
+        # Stopwords only match every movie, paged by primary key
+        context = self.get(query="the")
+        self.assertEqual(context['paginator'].count, 45)
+        last = self.get(query="the", after=context['page_obj'].next_cursor)['page_obj']
+        self.assertEqual(len(self.get(query="the", after=last.next_cursor)['results']), 5)
+
+        Movie.objects.create(title="Star Wars", year="1977")
+        self.assertEqual(self.get(query="The the")['paginator'].count, 45)
+        cache.clear()
+        self.assertEqual(self.get(query="the")['paginator'].count, 46)
+
+    def test_offset_pages(self):
+        context = self.get(query="star", page=3, pagination='offset')
+        self.assertEqual(len(context['results']), 5)
+        self.assertEqual(context['paginator'].count, 45)
+        self.assertEqual(cache.get(search_count_key("STAR")), 45)
+
+class MovieSamplerTest(TestCase):
+
+    def setUp(self):
+        movie_sampler.clear()
+        self.addCleanup(movie_sampler.clear)
+        self.movies = [Movie.objects.create(title="Movie %i" % idx, year="2001", plot="A plot") for idx in xrange(5)]
+        self.plotless = Movie.objects.create(title="No Plot", year="2001")
+
+    def test_random(self):
+        Movie.objects.random()
+        with self.assertNumQueries(1):
+            movie = Movie.objects.random()
+        self.assertIn(movie, self.movies)
+
+        drawn = set(Movie.objects.random().pk for idx in xrange(200))
+        self.assertEqual(drawn, set(movie.pk for movie in self.movies))
+
+    def test_random_sample(self):
+        with self.assertNumQueries(2):
+            sample = Movie.objects.random_sample(3)
+        self.assertEqual(len(set(sample)), 3)
+        self.assertEqual(set(Movie.objects.random_sample(10)), set(self.movies))
+
+    def test_pool_follows_writes(self):
+        Movie.objects.random()
+        with commit_on_success():
+            self.movies[0].delete()
+            self.movies[1].plot = None
+            self.movies[1].save()
+            self.plotless.plot = "Now with a plot"
+            self.plotless.save()
+            self.assertIn(self.movies[1].pk, movie_sampler.positions)
+        expected = set(movie.pk for movie in self.movies[2:] + [self.plotless])
+        self.assertEqual(set(movie.pk for movie in Movie.objects.random_sample(10)), expected)
+
+        # Movies deleted by other processes are dropped when drawn
+        Movie.objects.filter(pk=self.plotless.pk).delete()
+        movie_sampler.add(self.plotless.pk)
+        self.assertEqual(len(Movie.objects.random_sample(10)), 3)
+        self.assertNotIn(self.plotless.pk, movie_sampler.positions)
+
+        Movie.objects.all().delete()
+        movie_sampler.clear()
+        self.assertRaises(IndexError, Movie.objects.random)
+
+    def test_rolled_back_writes(self):
+        Movie.objects.random()
+        expected = set(movie.pk for movie in self.movies)
+        with self.assertRaises(ValueError):
+            with commit_on_success():
+                Movie.objects.create(title="Rolled Back", year="2001", plot="A plot")
+                self.movies[0].delete()
+                raise ValueError("rolled back")
+        self.assertEqual(set(movie_sampler.pool), expected)
+
+class FragmentCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        fragment_cache.reset()
+        self.movie = Movie.objects.create(title="The Bear", year="2001", plot="A plot")
+        self.movie.genres.add(Genre.objects.create(name="Drama"))
+        self.movie.directors.add(Director.objects.create(name="Ann Smith"))
+        self.factory = RequestFactory()
+
+    def get(self):
+        from movies.views import MovieDetail
+        response = MovieDetail.as_view()(self.factory.get('/'), slug=self.movie.slug)
+        return response.context_data
+
+    def test_cached_fragments(self):
+        context = self.get()
+        self.assertIn("The Bear", context['detail_fragment'])
+        self.assertIn("Ann Smith", context['detail_fragment'])
+        self.assertEqual(context['analysis_fragment'], "")
+
+        # Only the movie itself is read once the fragments are cached
+        with self.assertNumQueries(1):
+            cached = self.get()
+        self.assertEqual(cached['detail_fragment'], context['detail_fragment'])
+        self.assertEqual(fragment_cache.stats, {'hits': 2, 'misses': 2, 'hit_rate': 0.5})
+
+    def test_write_invalidation(self):
+        self.get()
+        self.movie.title = "The Brown Bear"
+        self.movie.save()
+        self.assertIn("The Brown Bear", self.get()['detail_fragment'])
+
+        self.movie.genres.add(Genre.objects.create(name="Comedy"))
+        self.assertIn("Comedy", self.get()['detail_fragment'])
+
+        director = Director.objects.create(name="Bob Jones")
+        director.movies.add(self.movie)
+        self.assertIn("Bob Jones", self.get()['detail_fragment'])
+
+        director.name = "Robert Jones"
+        director.save()
+        self.assertIn("Robert Jones", self.get()['detail_fragment'])
+
+        Genre.objects.get(name="Drama").movies.clear()
+        self.assertNotIn("Drama", self.get()['detail_fragment'])
+
+        # The analysis fragment was only rendered the first time
+        self.assertEqual(fragment_cache.misses, 7)
+
+    def test_invalidated_after_commit(self):
+        self.get()
+        key = fragment_cache.version_key('detail', self.movie.pk)
+        with commit_on_success():
+            self.movie.title = "The Brown Bear"
+            self.movie.save()
+            # A render racing with the write stores under this version
+            during = cache.get(key)
+            self.assertTrue(during)
+        self.assertNotEqual(cache.get(key), during)
+        self.assertIn("The Brown Bear", self.get()['detail_fragment'])
+
+    def test_logged_counters(self):
+        import logging
+        logged = []
+
+        class Collect(logging.Handler):
+            def emit(self, record):
+                logged.append(record.getMessage())
+
+        logger = logging.getLogger('movies.fragments')
+        self.addCleanup(setattr, logger, 'handlers', logger.handlers)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.handlers = [Collect()]
+        logger.setLevel(logging.INFO)
+
+        with self.settings(MOVIE_FRAGMENT_LOG_EVERY=4):
+            self.get()
+            self.get()
+            self.get()
+        self.assertEqual(logged, ["Movie fragment cache: 2 hits, 2 misses (50.0% hit rate)"])
+
+    def test_file_based_backend(self):
+        import shutil
+        import tempfile
+
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        caches = {
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'files': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location},
+        }
+
+        renders = []
+        def renderer(name):
+            def render():
+                renders.append(name)
+                return u" <p>%s %i</p> " % (name, len(renders))
+            return render
+
+        with self.settings(CACHES=caches):
+            fragments = FragmentCache(alias='files')
+            first  = fragments.render(self.movie.pk, {'detail': renderer('detail'), 'analysis': renderer('analysis')})
+            second = fragments.render(self.movie.pk, {'detail': renderer('detail'), 'analysis': renderer('analysis')})
+            self.assertEqual(first, second)
+            self.assertEqual(first['detail'][:4], u"<p>d")
+            self.assertEqual(sorted(renders), ['analysis', 'detail'])
+
+            fragments.invalidate(self.movie.pk, 'analysis')
+            third = fragments.render(self.movie.pk, {'detail': renderer('detail'), 'analysis': renderer('analysis')})
+            self.assertEqual(third['detail'], first['detail'])
+            self.assertNotEqual(third['analysis'], first['analysis'])
+            self.assertEqual(renders[-1], 'analysis')
+            self.assertEqual(fragments.hit_rate, 0.5)
+
 def save_slugs(model):
     from django.db import connection
 
@@ -1,7 +1,21 @@
 import time
 
 from movies.models import *
-from django.views.generic import ListView, DetailView
+from movies.search import title_index
+from movies.fragments import fragment_cache
+from movies.pagination import CachedCountPaginator, KeysetPaginator, search_count_key
+from django.template.loader import render_to_string
+from django.views.generic import ListView, DetailView, TemplateView
+
+class HomePage(TemplateView):
+
+    template_name = "index.html"
+    sample_size = 6
+
+    def get_context_data(self, **kwargs):
+        context = super(HomePage, self).get_context_data(**kwargs)
+        context['random_movies'] = Movie.objects.random_sample(self.sample_size)
+        return context
 
 class MovieSearch(ListView):
 
@@ -9,31 +23,69 @@ class MovieSearch(ListView):
     template_name = "search.html"
     context_object_name = "results"
     paginate_by = 20
+    paginator_class = CachedCountPaginator
     query = None
 
+    # Page with 'keyset' cursors (after/before) or numbered 'offset' pages
+    pagination = 'keyset'
+
     def get(self, request, *args, **kwargs):
         self.query = request.GET.get('query', None)
+
+        # Building or syncing the title index is not part of the query time
+        if self.query:
+            title_index.sync()
+        self.started = time.time()
         return super(MovieSearch, self).get(request, *args, **kwargs)
 
+    def get_ranked(self):
+        """
+        Returns the movie ids ranked by the title index for the query, or
+        None if it has no keywords, looked up once per request.
+        """
+        if not hasattr(self, 'ranked'):
+            self.ranked = self.model.objects.search_ids(self.query) if self.query else None
+        return self.ranked
+
     def get_queryset(self):
-        return self.model.objects.search(self.query)
+        # Keyset pages of a ranked search are fetched by id from the ranking
+        if self.pagination == 'keyset' and self.get_ranked() is not None:
+            return self.model.objects.prefetch_related('genres')
+        return self.model.objects.search(self.query).prefetch_related('genres')
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        cache_key = search_count_key(self.query) if self.query else None
+        return self.paginator_class(queryset, per_page, orphans=orphans,
+                                    allow_empty_first_page=allow_empty_first_page, cache_key=cache_key)
+
+    def paginate_queryset(self, queryset, page_size):
+        if self.pagination != 'keyset':
+            return super(MovieSearch, self).paginate_queryset(queryset, page_size)
+
+        cache_key = search_count_key(self.query) if self.query else None
+        paginator = KeysetPaginator(queryset, page_size, ranked=self.get_ranked(), cache_key=cache_key)
+        page      = paginator.page(after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        return (paginator, page, page.object_list, page.has_other_pages())
 
     def get_context_data(self, **kwargs):
-        start   = time.time()
         context = super(MovieSearch, self).get_context_data(**kwargs)
 
+        # Evaluate the page here so that query_time covers its queries
+        context[self.context_object_name] = list(context['object_list'])
+        context['object_list'] = context[self.context_object_name]
+
         # Save query in context for template access
         context['query'] = self.query
+        context['keyset'] = self.pagination == 'keyset'
 
         # Get the URL for pagination
         pqd = self.request.GET.copy()
-        if 'page' in pqd: del pqd['page']
+        for key in ('page', 'after', 'before'):
+            if key in pqd: del pqd[key]
         context['pqdurl'] = pqd.urlencode()
 
-        # Calculate the time required
-        finit = time.time()
-        delta = finit - start
-        context['query_time'] = "%0.5f" % delta
+        # Time spent on the search and the fetch of the evaluated page
+        context['query_time'] = "%0.5f" % (time.time() - self.started)
 
         return context
 
@@ -42,3 +94,25 @@ class MovieDetail(DetailView):
     model = Movie
     template_name = "movie-detail.html"
     context_object_name = "movie"
+
+    # Templates of the fragments cached per movie, by fragment name
+    fragments = {
+        'detail': "movie-detail-fragment.html",
+        'analysis': "movie-analysis-fragment.html",
+    }
+
+    def get_context_data(self, **kwargs):
+        context = super(MovieDetail, self).get_context_data(**kwargs)
+        context['similar_movies'] = self.object.similar_movies.select_related('similar').order_by('rank')
+        for name, fragment in self.get_fragments(context).items():
+            context['%s_fragment' % name] = fragment
+        return context
+
+    def get_fragments(self, context):
+        """
+        Returns the rendered fragments of the movie, from the cache where
+        they have not been invalidated since they were rendered.
+        """
+        def renderer(template):
+            return lambda: render_to_string(template, context)
+        return fragment_cache.render(self.object.pk, dict((name, renderer(template)) for name, template in self.fragments.items()))
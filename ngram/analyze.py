@@ -1,9 +1,19 @@
 __author__ = 'benjamin'
 
 import nltk
+import hashlib
 from ngram.models import *
 from movies.models import *
+from ngram import engines
+from ngram import encoding
+from ngram.cache import token_cache
+from ngram.vocabulary import Vocabulary
+from django.conf import settings
+from movieplot.core.transactions import commit_on_success
+from django.contrib.contenttypes.models import ContentType
 from movieplot.core.counting import Histogram
+from movieplot.core.sketch import ApproximateHistogram
+from django.core.exceptions import ObjectDoesNotExist, ImproperlyConfigured
 
 class TextProcessor(object):
     """
@@ -11,15 +21,47 @@ class TextProcessor(object):
     and is of a length that is manageable in memory, then segments,
     tokenizes, and tags the text. (It does not deal with paragraphs).
 
+    The NLTK segmenter and tagger are loaded once per processor by load()
+    (called on first use, or explicitly to warm up a worker process) and
+    the sentences of a text, or of a batch of texts with process_many(),
+    are tagged with a single call to the tagger.
+
     @todo: Add Parsing!
     """
 
+    # Bump whenever the output of the processor changes
+    version = 1
+
+    # Resource name of the NLTK sentence segmenter
+    segmenter_resource = 'tokenizers/punkt/english.pickle'
+
+    def __init__(self):
+        self.segmenter = None
+        self.tagger    = None
+
+    def load(self):
+        """
+        Loads the NLTK segmenter and tagger if they are not loaded yet.
+        """
+        if self.segmenter is None:
+            self.segmenter = nltk.data.load(self.segmenter_resource)
+
+        if self.tagger is None:
+            try:
+                from nltk.tag.perceptron import PerceptronTagger
+                self.tagger = PerceptronTagger()
+            except ImportError:
+                # NLTK 2 ships a pickled tagger instead
+                self.tagger = nltk.data.load(nltk.tag._POS_TAGGER)
+
+        return self
+
     def segment(self, text):
         """
         Override to specify a different segmenter. Default NLTK used now.
         """
         if not text: return []
-        return nltk.sent_tokenize(text)
+        return self.load().segmenter.tokenize(text)
 
     def tokenize(self, text):
         """
@@ -33,7 +75,18 @@ class TextProcessor(object):
         Override to specify a different tagger. Default NLTK used now.
         """
         if not tokens: return []
-        return nltk.pos_tag(tokens)
+        return self.load().tagger.tag(tokens)
+
+    def postag_sents(self, sentences):
+        """
+        Tags a list of tokenized sentences with one call to the tagger.
+        Override along with postag to specify a different tagger.
+        """
+        if not sentences: return []
+        tagger = self.load().tagger
+        if hasattr(tagger, 'tag_sents'):
+            return list(tagger.tag_sents(sentences))
+        return tagger.batch_tag(sentences)
 
     def process(self, text):
         """
@@ -41,71 +94,173 @@ class TextProcessor(object):
         tagged token tuples, where the first part of the tuple is the
         token and the second part is the part of speech.
         """
-        for sentence in self.segment(text):
-            yield self.postag(self.tokenize(sentence))
+        return self.postag_sents([self.tokenize(sentence) for sentence in self.segment(text)])
 
-    def serialize(self, text, preprocessed=False):
+    def process_many(self, texts, batch_size=1000):
+        """
+        Streams the processed sentences of each of the texts, in order,
+        tagging the sentences of as many texts as fit in a batch of about
+        batch_size sentences at once.
         """
-        Creates a representation that can be saved to the database.
+        lengths   = []
+        sentences = []
+        for text in texts:
+            tokenized = [self.tokenize(sentence) for sentence in self.segment(text)]
+            lengths.append(len(tokenized))
+            sentences.extend(tokenized)
+
+            if len(sentences) >= batch_size:
+                for processed in self._split(lengths, self.postag_sents(sentences)):
+                    yield processed
+                lengths, sentences = [], []
+
+        for processed in self._split(lengths, self.postag_sents(sentences)):
+            yield processed
+
+    def _split(self, lengths, sentences):
+        start = 0
+        for length in lengths:
+            yield sentences[start:start+length]
+            start += length
 
-        Choices: JSON, Brown Simple Tags, Treebanking
+    @property
+    def identity(self):
+        """
+        Digest of the full name of the processor class, stored with its
+        serializations so that another processor does not reuse them.
         """
-        pass
+        cls = type(self)
+        return encoding.processor_digest("%s.%s" % (cls.__module__, cls.__name__))
+
+    def serialize(self, text, preprocessed=False, source=None):
+        """
+        Creates a compact representation of the segmented and tagged text
+        that can be saved to the database (see ngram.encoding). If the text
+        is preprocessed it must be the list of tagged sentences, and the
+        source text they came from can be given to stamp the encoding.
+        """
+        if preprocessed:
+            return encoding.encode(text, encoding.digest(source), self.version, self.identity)
+        return encoding.encode(self.process(text), encoding.digest(text), self.version, self.identity)
 
     def deserialize(self, text):
         """
         Unpacks a saved representation of the preprocessed text.
         """
-        pass
+        return encoding.decode(text)
+
+    def is_serialization_of(self, serialized, text):
+        """
+        Returns True if the serialization is current with the text and
+        was created by this version of this processor.
+        """
+        return encoding.is_encoding_of(serialized, text, self.version, self.identity)
 
 class NGramAnalyzer(object):
     """
     Takes a generic bit of text and outputs NGrams along with their
     associated frequencies.
+
+    Frequencies are counted by an engine from ngram.engines, either the
+    default pure Python engine or the vectorized "numpy" engine, which is
+    selected per analyzer with the engine argument or class attribute.
+
+    Analyzers that share a sketch (an ApproximateHistogram) also add the
+    counts of their text to it, keyed by token tuples, to aggregate the
+    counts of a corpus in bounded memory.
     """
 
     # Static Processor to reduce load times in memory
     processor = TextProcessor()
 
-    def __init__(self, text, N=1, preprocessed=False):
+    # Name of the engine used to count frequencies
+    engine = 'python'
+
+    def __init__(self, text, N=1, preprocessed=False, engine=None, sketch=None):
         self.N = N
         self.text = text
+        self.sketch = sketch
+        self._sketched = False
         self._frequency = Histogram()
         self.preprocessed = preprocessed
+        if engine is not None:
+            self.engine = engine
+
+    def get_engine(self):
+        return engines.get_engine(self.engine)
+
+    def count(self, tokens):
+        """
+        Counts the windows of the tokens with the engine, keyed by token
+        tuples, adding them to the sketch the first time.
+        """
+        counts = self.get_engine().count(self, tokens)
+        if self.sketch is not None and not self._sketched:
+            self.sketch.add(counts)
+            self._sketched = True
+        return counts
 
     @property
     def frequency(self):
         if not self._frequency:
-            for ngram in self:
-                self._frequency.increment(ngram)
+            counts = self.count(list(self.tokenize()))
+            if self.N == 1:
+                # Special case for Unigrams, which are counted as tokens
+                for (token,), count in counts.items():
+                    self._frequency[token] = count
+            else:
+                self._frequency = counts
         return self._frequency
 
     def tokenize(self):
         """
-        Tokenize using processor.
+        Tokenize using processor, or the token stream cache if the text
+        has been tokenized by the same processor before.
         """
-        if not self.preprocessed:
-            text = self.processor.process(self.text)
-        else:
-            text = self.processor.deserialize(self.text)
+        key    = token_cache.key(self.text, self.processor, self.preprocessed)
+        tokens = token_cache.get(key)
+
+        if tokens is None:
+            if not self.preprocessed:
+                text = self.processor.process(self.text)
+            else:
+                text = self.processor.deserialize(self.text)
 
-        for sentence in text:
-            for token, postag in sentence:
-                yield token.lower()
+            tokens = [token.lower() for sentence in text for token, postag in sentence]
+            token_cache.set(key, tokens)
 
-    def __iter__(self):
+        for token in tokens:
+            yield token
+
+    def windows(self, tokens):
+        """
+        Yields the token tuples of the N-Grams of the tokens, in order.
+        """
         if self.N == 1:
             # Special case for Unigrams
-            for token in self.tokenize(): yield token
+            for token in tokens: yield (token,)
         else:
             ngram = []
-            for token in self.tokenize():
+            for token in tokens:
                 if len(ngram) < self.N:
                     ngram.append(token)
                 if len(ngram) == self.N:
                     yield tuple(ngram)
                     ngram = ngram[1:]
 
+    def spans(self, length):
+        """
+        Describes windows() for vectorized engines as a list of (order,
+        positions) pairs: windows of each order start at every one of the
+        first positions tokens.
+        """
+        return [(self.N, max(length - self.N + 1, 0))]
+
+    def __iter__(self):
+        for ngram in self.windows(self.tokenize()):
+            # Special case for Unigrams, which are yielded as tokens
+            yield ngram[0] if self.N == 1 else ngram
+
     def __len__(self):
         return self.frequency.total
 
@@ -113,26 +268,41 @@ class NGramModelAnalyzer(NGramAnalyzer):
     """
     An NGram analyzer that interacts with the database.
 
+    Tokens and N-Gram windows are resolved to models in bulk through a
+    Vocabulary; pass a shared vocabulary (see resolve_vocabulary) to
+    resolve a batch of texts in a single pass.
+
     @note: __iter__ won't save anything to the database, use ngrams() if
     you want to create new ngrams in the course of the analysis.
     """
-    model_map = {
-        1: Unigram,
-        2: Bigram,
-        3: Trigram,
-    }
 
     def __init__(self, *args, **kwargs):
+        self.vocabulary = kwargs.pop('vocabulary', None)
         super(NGramModelAnalyzer, self).__init__(*args, **kwargs)
-        self.model = self.model_map[self.N]
+        self.model = get_model_for_order(self.N)
+        self._tokens = None
+        self._keys = None
 
     @property
     def frequency(self):
         if not self._frequency:
-            for ngram in self.ngrams():
-                self._frequency.increment(ngram)
+            counts = self.count(self.tokens())
+            keys   = counts.keys()
+            for ngram, key in zip(self.resolve(keys), keys):
+                self._frequency[ngram] = counts[key]
         return self._frequency
 
+    def resolve(self, keys, save=True):
+        """
+        Resolves a list of token tuples to models, in the same order.
+        """
+        vocabulary = self.vocabulary
+        if vocabulary is None:
+            vocabulary = Vocabulary(save=save)
+        vocabulary.update(keys)
+        vocabulary.resolve()
+        return [vocabulary[key] for key in keys]
+
     def tokenize(self, save=True):
         """
         Spits out tokens as Unigrams.
@@ -140,35 +310,35 @@ class NGramModelAnalyzer(NGramAnalyzer):
         If save is true, will add rows to the database, otherwise errors
         will occur if the Unigram does not exist in the database.
         """
-        for token in super(NGramModelAnalyzer, self).tokenize():
-            if save:
-                yield Unigram.objects.get_or_create(token=token)[0]
-            else:
-                yield Unigram.objects.get_by_natural_key(token)
+        tokens = [(token,) for token in self.tokens()]
+        for unigram in self.resolve(tokens, save=save):
+            yield unigram
+
+    def tokens(self):
+        """
+        Returns the list of token strings of the text, tokenizing it once.
+        """
+        if self._tokens is None:
+            self._tokens = list(super(NGramModelAnalyzer, self).tokenize())
+        return self._tokens
+
+    def keys(self):
+        """
+        Returns the token tuples in the order that ngrams() yields models.
+        """
+        if self._keys is None:
+            self._keys = list(self.windows(self.tokens()))
+        return self._keys
 
     def ngrams(self, save=True):
-        if self.N == 1:
-            # Special case for Unigrams
-            for token in self.tokenize(save=save): yield token
-        else:
-            ngram = []
-            for token in self.tokenize(save=save):
-                if len(ngram) < self.N:
-                    ngram.append(token)
-                if len(ngram) == self.N:
-                    keys   = ('alpha', 'beta', 'gamma', 'delta')
-                    kwargs = dict(zip(keys, ngram))
-                    if save:
-                        yield self.model.objects.get_or_create(**kwargs)[0]
-                    else:
-                        yield self.model.objects.get(**kwargs)
-                    ngram = ngram[1:]
+        for ngram in self.resolve(self.keys(), save=save):
+            yield ngram
 
     def __iter__(self):
         try:
             for ngram in self.ngrams(save=False):
                 yield ngram
-        except (self.model.DoesNotExist, Unigram.DoesNotExist) as e:
+        except ObjectDoesNotExist:
             raise self.model.DoesNotExist("__iter__ does not save to the database, use ngrams() to create new ngrams.")
 
 class MultiNGramAnalyzer(NGramAnalyzer):
@@ -179,14 +349,13 @@ class MultiNGramAnalyzer(NGramAnalyzer):
     the piece of text for analysis.
     """
 
-    def __iter__(self):
-
+    def windows(self, tokens):
         if self.N == 1:
             # Special case for Unigrams
-            for token in self.tokenize(): yield token
+            for token in tokens: yield (token,)
         else:
             state = []
-            for token in self.tokenize():
+            for token in tokens:
                 if len(state) < self.N:
                     state.append(token)
                 if len(state) == self.N:
@@ -196,61 +365,209 @@ class MultiNGramAnalyzer(NGramAnalyzer):
                         yield tuple(ngram)
                     state = state[1:]
 
-class MultiNGramModelAnalyzer(NGramModelAnalyzer):
+    def spans(self, length):
+        if self.N == 1:
+            return [(1, length)]
+
+        # Only the prefixes of complete windows are yielded
+        positions = max(length - self.N + 1, 0)
+        return [(order, positions) for order in xrange(1, self.N + 1)]
+
+class MultiNGramModelAnalyzer(NGramModelAnalyzer, MultiNGramAnalyzer):
     """
     An MultiNGramAnalyzer that uses the database.
     """
-
-    def ngrams(self, save=True):
-        if self.N == 1:
-            # Special case for Unigrams (Which have been fetched by tokenize())
-            for token in self.tokenize(save=save): yield token
-        else:
-            state = []
-            for token in self.tokenize(save=save):
-                if len(state) < self.N:
-                    state.append(token)
-                if len(state) == self.N:
-                    ngram = []
-                    for t in state:
-                        ngram.append(t)
-
-                        if len(ngram) == 1:
-                            yield ngram[0]
-                            continue
-
-                        keys   = ('alpha', 'beta', 'gamma', 'delta')
-                        kwargs = dict(zip(keys, ngram))
-                        self.model = self.model_map[len(ngram)]
-                        if save:
-                            yield self.model.objects.get_or_create(**kwargs)[0]
-                        else:
-                            yield self.model.objects.get(**kwargs)
-                    state = state[1:]
+    pass
 
 class MoviePlotAnalyzer(object):
     """
     Utilizes a MultiNGramModelAnalyzer to create Plot Analyses in the
     database -- this is only here because of the current coupling between
     the ngram app and the movies app.
+
+    An analysis, including the replacement of a previous analysis of the
+    movie, is written in a single transaction with bulk inserts, and is
+    stamped with a fingerprint of the plot and the analyzer settings so
+    that movies whose plot has not changed can be skipped.
     """
 
+    # Orders above 3 are stored in the hashed N-Gram table
     max_n_value = 3
+    batch_size  = 500
+
+    @classmethod
+    def get_analyzer(cls, movie, **kwargs):
+        """
+        Analyzes the tagged plot saved on the movie, tagging and saving it
+        first if it is missing or out of date.
+        """
+        processor = NGramAnalyzer.processor
+        if not processor.is_serialization_of(movie.plot_tagged, movie.plot):
+            cls.save_tagged(movie, processor.serialize(movie.plot))
+        return MultiNGramModelAnalyzer(movie.plot_tagged, cls.max_n_value, preprocessed=True, **kwargs)
+
+    @classmethod
+    def save_tagged(cls, movie, serialized):
+        # Update rather than save so that the modified stamp is unchanged
+        movie.plot_tagged = serialized
+        Movie.objects.filter(pk=movie.pk).update(plot_tagged=serialized)
+
+    @classmethod
+    def preprocess_many(cls, texts):
+        """
+        Yields the serialized tagging of each of the texts along with its
+        token count; the CPU bound part of an analysis that does not use
+        the database.
+        """
+        processor = NGramAnalyzer.processor
+        for text, sentences in zip(texts, processor.process_many(texts)):
+            yield processor.serialize(sentences, preprocessed=True, source=text), sum(map(len, sentences))
+
+    @classmethod
+    def fingerprint(cls, movie):
+        """
+        Hashes the plot along with the settings that affect the analysis.
+        """
+        processor = NGramAnalyzer.processor
+        name      = "%s.%s" % (type(processor).__module__, type(processor).__name__)
+        signature = "%s:%s:%i:%i:%s:%i\n" % (cls.__name__, name, processor.version, cls.max_n_value,
+                                             cls.get_storage(), getattr(settings, 'NGRAM_HASH_ORDER', 4))
+        return hashlib.sha1(signature + (movie.plot or u'').encode('utf-8')).hexdigest()
+
+    @classmethod
+    def is_current(cls, movie, fingerprint=None):
+        """
+        Returns True if the movie has an analysis of its current plot.
+        """
+        fingerprint = fingerprint or cls.fingerprint(movie)
+        return NGramPlotAnalysis.objects.filter(movie=movie, fingerprint=fingerprint).exists()
 
     @classmethod
-    def analyze(cls, movie):
+    def analyze_many(cls, movies, sketch=None):
+        """
+        Analyzes a batch of movies, tagging the plots that need it and
+        resolving the vocabulary of all their plots at once. The N-Gram
+        counts of the plots are added to the sketch, if one is given.
+        """
+        processor = NGramAnalyzer.processor
+        untagged  = [movie for movie in movies if not processor.is_serialization_of(movie.plot_tagged, movie.plot)]
+        for movie, (serialized, tokens) in zip(untagged, cls.preprocess_many([movie.plot for movie in untagged])):
+            cls.save_tagged(movie, serialized)
+
+        analyzers = [cls.get_analyzer(movie, sketch=sketch) for movie in movies]
+        resolve_vocabulary(analyzers)
+        return [cls.analyze(movie, analyzer) for movie, analyzer in zip(movies, analyzers)]
+
+    @classmethod
+    def analyze(cls, movie, analyzer=None, force=True):
+        """
+        Analyzes the plot of the movie; unless forced, an analysis that is
+        current with the plot is returned as is.
+        """
         if not isinstance(movie, Movie):
             raise TypeError("Only movies can be analyzed.")
 
-        analyzer  = MultiNGramModelAnalyzer(movie.plot, cls.max_n_value, preprocessed=False)
-        histogram = analyzer.frequency
-        analysis  = NGramPlotAnalysis.objects.create(movie=movie)
+        fingerprint = cls.fingerprint(movie)
+        if not force and cls.is_current(movie, fingerprint):
+            return movie.ngram_analysis
+
+        analyzer = analyzer or cls.get_analyzer(movie)
+        return cls.write_analysis(movie, analyzer.frequency, fingerprint)
 
-        for ngram, count in histogram.items():
-            NGramModel.objects.create(analysis=analysis, ngram=ngram, frequency=count)
+    @classmethod
+    def get_storage(cls):
+        """
+        Returns how analyses are stored: 'rows' of N-Gram models, or
+        'packed' histograms on the analysis itself.
+        """
+        storage = getattr(settings, 'NGRAM_STORAGE', 'rows')
+        if storage not in ('rows', 'packed'):
+            raise ImproperlyConfigured("NGRAM_STORAGE must be 'rows' or 'packed', not '%s'." % storage)
+        return storage
 
+    @classmethod
+    @commit_on_success
+    def write_analysis(cls, movie, histogram, fingerprint=None):
+        """
+        Replaces the analysis of the movie with the N-Gram frequencies in
+        the histogram, resolving each content type only once.
+        """
+        NGramPlotAnalysis.objects.filter(movie=movie).delete()
+        summary = NGramPlotAnalysis.summarize_histogram(histogram)
+
+        if cls.get_storage() == 'packed':
+            counts = dict((model, {}) for model in NGRAM_MODELS)
+            for ngram, count in histogram.iteritems():
+                counts[type(ngram)][ngram.pk] = count
+            for model, ids in counts.items():
+                summary[NGramPlotAnalysis.packed_field(model)] = encoding.pack_histogram(ids)
+
+        analysis = NGramPlotAnalysis.objects.create(movie=movie, fingerprint=fingerprint, **summary)
+
+        if not analysis.is_packed:
+            ngram_types = {}
+            for model in set(type(ngram) for ngram in histogram):
+                ngram_types[model] = ContentType.objects.get_for_model(model).pk
+
+            rows = [
+                NGramModel(analysis=analysis, ngram_type_id=ngram_types[type(ngram)], ngram_id=ngram.pk, frequency=count)
+                for ngram, count in histogram.items()
+            ]
+            NGramModel.objects.bulk_create(rows, batch_size=cls.batch_size)
+
+        NGramCorpusFrequency.objects.add_analysis(analysis)
+        NGramLeaderboard.objects.mark_stale(NGramLeaderboard.objects.movie_slices(movie))
         return analysis
 
+class CorpusSketch(ApproximateHistogram):
+    """
+    Approximate N-Gram counts of the plot analyses of the corpus, kept by
+    the chunk command. The sketch remembers which analysis of each movie
+    it holds the counts of, so that they can be taken back out (a
+    turnstile update) when the movie is reanalyzed; the counts of an
+    analysis replaced behind its back can not be, and stay in.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CorpusSketch, self).__init__(*args, **kwargs)
+        self.analyses = {}
+
+    def holds(self, analysis):
+        return self.analyses.get(analysis.movie_id) == analysis.pk
+
+    def counted(self, analysis):
+        """
+        Records that the counts of the analysis were added while it was
+        being written.
+        """
+        self.analyses[analysis.movie_id] = analysis.pk
+
+    def add_analysis(self, analysis):
+        """
+        Adds the counts of a stored analysis.
+        """
+        self.add(analysis.token_histogram())
+        self.counted(analysis)
+
+    def remove_analysis(self, analysis):
+        """
+        Takes the counts of an analysis about to be replaced back out.
+        """
+        if self.holds(analysis):
+            self.subtract(analysis.token_histogram())
+        self.analyses.pop(analysis.movie_id, None)
+
+def resolve_vocabulary(analyzers, save=True):
+    """
+    Shares a single Vocabulary between the NGramModelAnalyzers of a batch
+    of texts and resolves all of their N-Grams with one set of queries.
+    """
+    vocabulary = Vocabulary(save=save)
+    for analyzer in analyzers:
+        vocabulary.update(analyzer.keys())
+        analyzer.vocabulary = vocabulary
+    return vocabulary.resolve()
+
 def ngram_factory(text, N, **kwargs):
     database = kwargs.pop('database', False)
     if database:
@@ -0,0 +1,177 @@
+__author__ = 'benjamin'
+
+import os
+import sys
+import nltk
+import codecs
+import movies
+
+from ngram import encoding
+from django.db import connections, DatabaseError
+from movies.models import Movie
+from ngram.models import NGramPlotAnalysis, NGramModel, NGRAM_MODELS
+from ngram.analyze import TextProcessor, NGramAnalyzer, MultiNGramAnalyzer
+from movieplot.core.counting import Histogram
+from movieplot.core.sketch import ApproximateHistogram, sizeof
+from movieplot.core.benchmark import benchmark, best_of
+
+def sample_plots(limit):
+    plots = Movie.objects.exclude(plot__isnull=True).exclude(plot='')
+    return list(plots.values_list('plot', flat=True)[:limit])
+
+def table_size(model):
+    """
+    Returns the bytes on disk of the table of a model and its indexes, or
+    None if the database can not say (SQLite needs the dbstat table).
+    """
+    connection = connections[model.objects.db]
+    table      = model._meta.db_table
+    queries    = {
+        'postgresql': ("SELECT pg_total_relation_size(%s)", [table]),
+        'sqlite': ("SELECT SUM(pgsize) FROM dbstat WHERE name IN "
+                   "(SELECT name FROM sqlite_master WHERE tbl_name = %s)", [table]),
+    }
+    if connection.vendor not in queries:
+        return None
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute(*queries[connection.vendor])
+    except DatabaseError:
+        return None
+    size = cursor.fetchone()[0]
+    return int(size) if size is not None else None
+
+@benchmark
+def tagging(repeat=3, limit=100, **options):
+    """
+    Decoding saved tagged plots against segmenting and tagging with NLTK.
+    """
+    plots = sample_plots(limit)
+    if not plots: return []
+
+    processor = NGramAnalyzer.processor
+    encoded   = [processor.serialize(plot) for plot in plots]
+    retag     = best_of(lambda: [list(processor.process(plot)) for plot in plots], repeat)
+    decode    = best_of(lambda: [processor.deserialize(data) for data in encoded], repeat)
+
+    return [
+        ("tag %i plots" % len(plots), retag, "sec"),
+        ("decode %i plots" % len(plots), decode, "sec"),
+        ("speedup", retag / max(decode, 1e-9), "x"),
+        ("mean encoded size", float(sum(map(len, encoded))) / len(encoded), "bytes"),
+    ]
+
+@benchmark
+def counting(repeat=3, limit=100, **options):
+    """
+    Counting unigrams to trigrams with the python and numpy engines.
+    """
+    plots = sample_plots(limit)
+    if not plots: return []
+
+    processor = NGramAnalyzer.processor
+    tagged    = [processor.serialize(plot) for plot in plots]
+
+    rows = []
+    for engine in ('python', 'numpy'):
+        count = lambda: [MultiNGramAnalyzer(data, 3, preprocessed=True, engine=engine).frequency for data in tagged]
+        rows.append(("%s engine, %i plots" % (engine, len(plots)), best_of(count, repeat), "sec"))
+    return rows
+
+@benchmark
+def pipeline(repeat=3, limit=100, **options):
+    """
+    Per-sentence nltk.pos_tag against the warm, batched TextProcessor.
+    """
+    plots = sample_plots(limit)
+    if not plots: return []
+
+    processor = TextProcessor().load()
+
+    def per_sentence():
+        for plot in plots:
+            [nltk.pos_tag(nltk.word_tokenize(sentence)) for sentence in nltk.sent_tokenize(plot)]
+
+    return [
+        ("per-sentence nltk.pos_tag, %i plots" % len(plots), best_of(per_sentence, repeat), "sec"),
+        ("batched process, %i plots" % len(plots), best_of(lambda: [processor.process(plot) for plot in plots], repeat), "sec"),
+        ("batched process_many, %i plots" % len(plots), best_of(lambda: list(processor.process_many(plots)), repeat), "sec"),
+    ]
+
+@benchmark
+def storage(repeat=3, limit=100, **options):
+    """
+    Size and load time of N-Gram model rows against packed histograms.
+    """
+    analyses = list(NGramPlotAnalysis.objects.filter(packed_unigrams__isnull=True)[:limit])
+    if not analyses: return []
+
+    def load_rows():
+        for analysis in analyses:
+            for model in NGRAM_MODELS:
+                dict(analysis.filter_by_type(model).values_list('ngram_id', 'frequency'))
+
+    packed = [[encoding.pack_histogram(analysis.histogram(model)) for model in NGRAM_MODELS]
+              for analysis in analyses]
+
+    def load_packed():
+        for histograms in packed:
+            for data in histograms:
+                dict(encoding.unpack_histogram(data))
+
+    rows  = NGramModel.objects.filter(analysis__in=analyses).count()
+    size  = sum(len(data) for histograms in packed for data in histograms)
+    table = table_size(NGramModel)
+
+    # The table is measured whole, so its size is shared out by row
+    if table is not None:
+        stored = ("N-Gram model rows and indexes on disk", table * rows / max(NGramModel.objects.count(), 1), "bytes")
+    else:
+        stored = ("N-Gram model row payload, estimated at 16 bytes", rows * 16, "bytes")
+
+    return [
+        ("N-Gram model rows, %i analyses" % len(analyses), rows, "rows"),
+        stored,
+        ("packed histograms", size, "bytes"),
+        ("load rows", best_of(load_rows, repeat), "sec"),
+        ("decode packed", best_of(load_packed, repeat), "sec"),
+    ]
+
+def title_tokens():
+    path = os.path.join(os.path.dirname(movies.__file__), 'fixtures', 'title_list_clean.txt')
+    with codecs.open(path, encoding='utf-8') as f:
+        return [line.lower().split() for line in f if line.strip()]
+
+@benchmark
+def sketch(repeat=3, **options):
+    """
+    Accuracy and memory of approximate N-Gram counts of the title fixtures.
+    """
+    titles = title_tokens()
+
+    def count(counter):
+        for tokens in titles:
+            for N in (1, 2, 3):
+                NGramAnalyzer(None, N, sketch=counter).count(tokens)
+        return counter
+
+    exact = count(Histogram())
+    top   = set(key for key, frequency in exact.most_common(100))
+    rows  = [
+        ("exact histogram, %i distinct N-Grams" % len(exact), sys.getsizeof(exact) + sum(map(sizeof, exact)), "bytes"),
+        ("exact histogram", best_of(lambda: count(Histogram()), repeat), "sec"),
+    ]
+
+    for max_bytes in (4096, 16384, 65536, 262144):
+        approx = count(ApproximateHistogram(max_bytes=max_bytes, heavy_hitters=100))
+        errors = [approx[key] - frequency for key, frequency in exact.iteritems()]
+        label  = "%i KB sketch" % (max_bytes // 1024)
+        rows.extend([
+            ("%s, size with 100 heavy hitters" % label, approx.nbytes, "bytes"),
+            ("%s, mean overestimate" % label, float(sum(errors)) / len(errors), "counts"),
+            ("%s, exact estimates" % label, 100.0 * errors.count(0) / len(errors), "%"),
+            ("%s, top 100 recall" % label, float(len(top & set(approx))), "%"),
+            ("%s" % label, best_of(lambda: count(ApproximateHistogram(max_bytes=max_bytes, heavy_hitters=100)), repeat), "sec"),
+        ])
+    return rows
@@ -0,0 +1,275 @@
+__author__ = 'benjamin'
+
+import os
+import sys
+import zlib
+import marshal
+import hashlib
+import threading
+
+from functools import partial
+from collections import OrderedDict
+from django.conf import settings
+from django.db import transaction
+from movieplot.core.transactions import on_commit, on_rollback
+
+class NGramCache(object):
+    """
+    A bounded, process-wide LRU cache mapping the natural keys of N-Grams
+    (a token for a Unigram, a tuple of Unigram ids otherwise) to their
+    primary keys, so that frequent tokens do not cost a query every time
+    they are resolved. Keeps hit and miss counters to help size it.
+
+    Ids read or created inside a managed transaction may belong to rows
+    that are rolled back, so they are kept apart for the thread that made
+    them until the transaction commits (see movieplot.core.transactions)
+    and only then shared.
+    """
+
+    def __init__(self, size=None):
+        self.size   = size if size is not None else getattr(settings, 'NGRAM_CACHE_SIZE', 100000)
+        self.hits   = 0
+        self.misses = 0
+        self._data  = OrderedDict()
+        self._lock  = threading.Lock()
+        self._local = threading.local()
+
+    def get(self, model, key):
+        """
+        Returns the primary key for the natural key of the model, or None.
+        """
+        ckey = (model.__name__, key)
+        with self._lock:
+            pk = self._data.pop(ckey, None)
+            if pk is not None:
+                self._data[ckey] = pk
+                self.hits += 1
+                return pk
+
+        pk = self.pending().get(ckey)
+        with self._lock:
+            if pk is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return pk
+
+    def set(self, model, key, pk):
+        ckey = (model.__name__, key)
+        if transaction.is_managed():
+            pending = self.pending(create=True)
+            if len(pending) < self.size:
+                pending[ckey] = pk
+        else:
+            self._store([(ckey, pk)])
+
+    def pending(self, create=False):
+        """
+        Returns the ids cached by this thread in the open transaction.
+        """
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None and not transaction.is_managed():
+            # Left over from a transaction that was not ended by
+            # movieplot.core.transactions, which may have rolled back
+            pending = self._local.pending = None
+        if pending is None and create:
+            pending = self._local.pending = {}
+            on_commit(partial(self.publish, pending))
+            on_rollback(partial(self.forget, pending))
+        return pending if pending is not None else {}
+
+    def publish(self, pending):
+        """
+        Shares the ids cached in a transaction once it has committed.
+        """
+        self.forget(pending)
+        self._store(pending.items())
+
+    def forget(self, pending):
+        if getattr(self._local, 'pending', None) is pending:
+            self._local.pending = None
+
+    def _store(self, items):
+        with self._lock:
+            for ckey, pk in items:
+                self._data.pop(ckey, None)
+                self._data[ckey] = pk
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def discard(self, model, key):
+        ckey = (model.__name__, key)
+        self.pending().pop(ckey, None)
+        with self._lock:
+            self._data.pop(ckey, None)
+
+    def clear(self):
+        self._local.pending = None
+        with self._lock:
+            self._data.clear()
+            self.hits   = 0
+            self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self),
+            'capacity': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+# Process-wide cache shared by the NGram managers and analyzers
+ngram_cache = NGramCache()
+
+class TokenCache(object):
+    """
+    A memory bounded LRU cache of the token streams of texts, keyed by a
+    hash of the text and the processor that tokenized it, so that the
+    unigram, bigram and trigram analyzers of one text only pay for the
+    processor once. An optional on-disk tier (a directory of compressed
+    token lists) keeps streams across processes and evictions.
+    """
+
+    def __init__(self, max_bytes=None, directory=None):
+        self.max_bytes  = max_bytes if max_bytes is not None else getattr(settings, 'NGRAM_TOKEN_CACHE_BYTES', 64 * 1024 * 1024)
+        self.directory  = directory if directory is not None else getattr(settings, 'NGRAM_TOKEN_CACHE_DIR', None)
+        self.bytes      = 0
+        self.hits       = 0
+        self.disk_hits  = 0
+        self.misses     = 0
+        self._data      = OrderedDict()
+        self._lock      = threading.Lock()
+
+    def key(self, text, processor, preprocessed=False):
+        """
+        Returns the hash of the text and the processor settings.
+        """
+        if text is None: text = u''
+        if isinstance(text, unicode): text = text.encode('utf-8')
+        cls    = type(processor)
+        prefix = "%s.%s:%i:%i\n" % (cls.__module__, cls.__name__, processor.version, int(preprocessed))
+        return hashlib.sha1(prefix + text).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached list of tokens for the key, or None.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._data[key] = entry
+                self.hits += 1
+                return entry[0]
+
+        tokens = self._read(key)
+        if tokens is None:
+            self.misses += 1
+            return None
+
+        self.disk_hits += 1
+        self._store(key, tokens)
+        return tokens
+
+    def set(self, key, tokens):
+        tokens = list(tokens)
+        self._store(key, tokens)
+        self._write(key, tokens)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes     = 0
+            self.hits      = 0
+            self.disk_hits = 0
+            self.misses    = 0
+
+    def sizeof(self, tokens):
+        return sys.getsizeof(tokens) + sum(sys.getsizeof(token) for token in tokens)
+
+    def _store(self, key, tokens):
+        size = self.sizeof(tokens)
+        if size > self.max_bytes: return
+
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+            self._data[key] = (tokens, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (evicted, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _read(self, key):
+        if not self.directory: return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return marshal.loads(zlib.decompress(f.read()))
+        except (IOError, ValueError, EOFError, TypeError, zlib.error):
+            return None
+
+    def _write(self, key, tokens):
+        if not self.directory: return
+        path = self._path(key)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+
+            # Write then rename so readers never see a partial file
+            temp = "%s.%i.tmp" % (path, os.getpid())
+            with open(temp, 'wb') as f:
+                f.write(zlib.compress(marshal.dumps(tokens)))
+            os.rename(temp, path)
+        except (IOError, OSError):
+            pass
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return float(self.hits + self.disk_hits) / lookups if lookups else 0.0
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+# Process-wide cache of token streams consulted by the NGram analyzers
+token_cache = TokenCache()
+
+def describe(name, stats):
+    """
+    Returns a line describing the counters of one of the caches above.
+    """
+    line = "%s: %i hits, %i misses (%0.1f%% hit rate), %i entries" % (
+        name, stats['hits'] + stats.get('disk_hits', 0), stats['misses'], 100 * stats['hit_rate'], stats['size'])
+    if 'disk_hits' in stats:
+        line += ", %i bytes, %i hits on disk" % (stats['bytes'], stats['disk_hits'])
+    return line
+
+def cache_report():
+    """
+    Returns the lines describing the process-wide caches of this module.
+    """
+    return [describe("N-Gram id cache", ngram_cache.stats), describe("Token cache", token_cache.stats)]
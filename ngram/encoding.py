@@ -0,0 +1,229 @@
+"""
+Compact, versioned encoding of segmented and part of speech tagged text,
+used by TextProcessor.serialize to save the output of NLTK alongside the
+text so that analyses can skip segmenting, tokenizing and tagging.
+
+The encoding is a zlib compressed, base64 encoded record made up of:
+
+    header    magic, format and processor versions, digest of the name
+              of the processor, digest of the source text, flags and
+              the sizes of the tables below
+    tokens    string table of the distinct tokens (utf-8, NUL separated)
+    tags      string table of the distinct part of speech tags
+    sentences the number of tokens in each sentence (uint32)
+    token ids index of every token in the token table (uint16/uint32)
+    tag ids   index of every tag in the tag table (uint8/uint16)
+
+It also holds the packed encoding of the N-Gram histograms of an analysis
+stored in place of NGramModel rows: a zlib compressed, base64 encoded
+record of a small header followed by the sorted N-Gram ids, delta encoded,
+and their frequencies, both as uint32 arrays.
+"""
+
+__author__ = 'benjamin'
+
+import sys
+import zlib
+import base64
+import struct
+import hashlib
+
+from array import array
+
+MAGIC          = 'NGTT'
+FORMAT_VERSION = 2
+HEADER         = struct.Struct('<4sBH4s8sBIIII')
+
+# Format 1 had no processor digest, it is read as an empty one
+HEADERS        = {1: struct.Struct('<4sBH8sBIIII'), 2: HEADER}
+
+WIDE_TOKENS    = 0x1
+WIDE_TAGS      = 0x2
+
+PACKED_MAGIC   = 'NGPH'
+PACKED_VERSION = 1
+PACKED_HEADER  = struct.Struct('<4sBI')
+
+class EncodingError(ValueError):
+    """
+    Raised when a tagged text encoding cannot be decoded.
+    """
+    pass
+
+def digest(text):
+    """
+    Short digest of the source text, used to check that an encoding is
+    still current with the text it was created from.
+    """
+    if text is None: text = u''
+    if isinstance(text, unicode): text = text.encode('utf-8')
+    return hashlib.sha1(text).digest()[:8]
+
+def processor_digest(name):
+    """
+    Short digest of the name of the processor that tagged a text.
+    """
+    return hashlib.sha1(name).digest()[:4]
+
+def _pack_array(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder == 'big': values.byteswap()
+    return values.tostring()
+
+def _unpack_array(typecode, data, offset, count):
+    values = array(typecode)
+    end    = offset + values.itemsize * count
+    values.fromstring(data[offset:end])
+    if sys.byteorder == 'big': values.byteswap()
+    return values, end
+
+def _pack_strings(strings):
+    data = '\0'.join(s.encode('utf-8') for s in strings)
+    return struct.pack('<I', len(data)) + data
+
+def _unpack_strings(data, offset, count):
+    size,  = struct.unpack_from('<I', data, offset)
+    offset = offset + 4
+    if not count:
+        return [], offset + size
+    strings = [s.decode('utf-8') for s in data[offset:offset+size].split('\0')]
+    if len(strings) != count:
+        raise EncodingError("String table holds %i strings, expected %i." % (len(strings), count))
+    return strings, offset + size
+
+def encode(sentences, source_digest='', processor_version=0, processor=''):
+    """
+    Encodes a list of sentences of (token, tag) tuples.
+    """
+    tokens, tags = {}, {}
+    token_ids, tag_ids, lengths = [], [], []
+
+    for sentence in sentences:
+        lengths.append(len(sentence))
+        for token, tag in sentence:
+            token_ids.append(tokens.setdefault(token, len(tokens)))
+            tag_ids.append(tags.setdefault(tag, len(tags)))
+
+    flags = 0
+    if len(tokens) > 0xffff: flags |= WIDE_TOKENS
+    if len(tags) > 0xff: flags |= WIDE_TAGS
+
+    token_table = sorted(tokens, key=tokens.get)
+    tag_table   = sorted(tags, key=tags.get)
+
+    record = ''.join((
+        HEADER.pack(MAGIC, FORMAT_VERSION, processor_version, processor.ljust(4, '\0'), source_digest.ljust(8, '\0'), flags,
+                    len(token_table), len(tag_table), len(lengths), len(token_ids)),
+        _pack_strings(token_table),
+        _pack_strings(tag_table),
+        _pack_array('I', lengths),
+        _pack_array('I' if flags & WIDE_TOKENS else 'H', token_ids),
+        _pack_array('H' if flags & WIDE_TAGS else 'B', tag_ids),
+    ))
+    return base64.b64encode(zlib.compress(record))
+
+def read_header(encoded):
+    """
+    Returns the raw record and its unpacked header, in the layout of the
+    current format.
+    """
+    try:
+        record = zlib.decompress(base64.b64decode(encoded))
+        magic, version = struct.unpack_from('<4sB', record)
+    except (TypeError, zlib.error, struct.error) as e:
+        raise EncodingError("Could not read tagged text encoding: %s" % e)
+
+    if magic != MAGIC:
+        raise EncodingError("Not a tagged text encoding.")
+    if version not in HEADERS:
+        raise EncodingError("Unsupported tagged text encoding version %i." % version)
+
+    try:
+        header = HEADERS[version].unpack_from(record)
+    except struct.error as e:
+        raise EncodingError("Could not read tagged text encoding: %s" % e)
+    if version == 1:
+        header = header[:3] + ('\0' * 4,) + header[3:]
+    return record, header
+
+def decode(encoded):
+    """
+    Decodes an encoding back into a list of sentences of (token, tag).
+    """
+    record, header = read_header(encoded)
+    _, version, _, _, _, flags, ntokens, ntags, nsentences, length = header
+
+    offset = HEADERS[version].size
+    token_table, offset = _unpack_strings(record, offset, ntokens)
+    tag_table, offset   = _unpack_strings(record, offset, ntags)
+    lengths, offset     = _unpack_array('I', record, offset, nsentences)
+    token_ids, offset   = _unpack_array('I' if flags & WIDE_TOKENS else 'H', record, offset, length)
+    tag_ids, offset     = _unpack_array('H' if flags & WIDE_TAGS else 'B', record, offset, length)
+
+    if len(tag_ids) != length:
+        raise EncodingError("Tagged text encoding is truncated.")
+
+    tokens = [token_table[idx] for idx in token_ids]
+    tags   = [tag_table[idx] for idx in tag_ids]
+
+    sentences = []
+    start = 0
+    for size in lengths:
+        sentences.append(zip(tokens[start:start+size], tags[start:start+size]))
+        start += size
+    return sentences
+
+def is_encoding_of(encoded, text, processor_version=None, processor=None):
+    """
+    Returns True if the encoding was created from the text (and by the
+    given processor version and processor digest, if specified).
+    """
+    if not encoded: return False
+    try:
+        _, header = read_header(encoded)
+    except EncodingError:
+        return False
+    if processor_version is not None and header[2] != processor_version:
+        return False
+    if processor is not None and header[3] != processor.ljust(4, '\0'):
+        return False
+    return header[4] == digest(text)
+
+def pack_histogram(counts):
+    """
+    Packs a mapping of N-Gram ids to frequencies.
+    """
+    ids    = sorted(counts)
+    deltas = [ident - prev for ident, prev in zip(ids, [0] + ids[:-1])]
+    record = ''.join((
+        PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, len(ids)),
+        _pack_array('I', deltas),
+        _pack_array('I', [counts[ident] for ident in ids]),
+    ))
+    return base64.b64encode(zlib.compress(record))
+
+def unpack_histogram(encoded):
+    """
+    Unpacks a packed histogram into a list of (N-Gram id, frequency).
+    """
+    try:
+        record = zlib.decompress(base64.b64decode(encoded))
+        magic, version, count = PACKED_HEADER.unpack_from(record)
+    except (TypeError, zlib.error, struct.error) as e:
+        raise EncodingError("Could not read packed histogram: %s" % e)
+
+    if magic != PACKED_MAGIC:
+        raise EncodingError("Not a packed histogram.")
+    if version != PACKED_VERSION:
+        raise EncodingError("Unsupported packed histogram version %i." % version)
+
+    deltas, offset = _unpack_array('I', record, PACKED_HEADER.size, count)
+    counts, offset = _unpack_array('I', record, offset, count)
+    if len(counts) != count:
+        raise EncodingError("Packed histogram is truncated.")
+
+    ids, ident = [], 0
+    for delta in deltas:
+        ident += delta
+        ids.append(ident)
+    return zip(ids, counts)
@@ -0,0 +1,87 @@
+"""
+Engines that count the N-Gram windows of a token stream for the
+analyzers. Each engine's count() takes an analyzer and its list of
+tokens and returns a Histogram keyed by tuples of tokens.
+"""
+
+__author__ = 'benjamin'
+
+from movieplot.core.counting import Histogram
+
+try:
+    import numpy as np
+    from numpy.lib.stride_tricks import as_strided
+except ImportError:
+    np = None
+
+class PythonEngine(object):
+    """
+    Counts the windows yielded by the analyzer one at a time.
+    """
+
+    name = 'python'
+
+    def count(self, analyzer, tokens):
+        histogram = Histogram()
+        for ngram in analyzer.windows(tokens):
+            histogram.increment(ngram)
+        return histogram
+
+class NumpyEngine(object):
+    """
+    Maps the tokens to an integer id array, builds every window of an
+    order as a strided view of that array and counts them with vectorized
+    unique and bincount operations, following the analyzer's spans().
+    """
+
+    name = 'numpy'
+
+    # Windows are packed into a single int64 code when the vocabulary allows
+    max_code = 2 ** 63
+
+    def __init__(self):
+        if np is None:
+            raise ImportError("NumPy is required by the numpy N-Gram engine.")
+
+    def count(self, analyzer, tokens):
+        if not tokens: return Histogram()
+
+        vocab, ids = np.unique(np.array(tokens), return_inverse=True)
+        vocab = np.array(vocab.tolist(), dtype=object)
+        ids   = ids.astype(np.int64)
+        size  = len(vocab)
+
+        keys, counts = [], []
+        for order, positions in analyzer.spans(len(tokens)):
+            if positions <= 0: continue
+
+            if order == 1:
+                bins = np.bincount(ids[:positions], minlength=size)
+                rows = np.flatnonzero(bins)[:, None]
+                freq = bins[rows[:, 0]]
+            else:
+                stride  = ids.strides[0]
+                windows = as_strided(ids, shape=(positions, order), strides=(stride, stride))
+
+                if size ** order < self.max_code:
+                    powers = size ** np.arange(order - 1, -1, -1, dtype=np.int64)
+                    codes, freq = np.unique(windows.dot(powers), return_counts=True)
+                    rows = (codes[:, None] // powers) % size
+                else:
+                    rows, freq = np.unique(windows, axis=0, return_counts=True)
+
+            # Build the token tuples column by column rather than per window
+            keys.extend(zip(*[vocab[rows[:, idx]].tolist() for idx in xrange(order)]))
+            counts.extend(freq.tolist())
+
+        return Histogram(zip(keys, counts))
+
+ENGINES = {
+    PythonEngine.name: PythonEngine,
+    NumpyEngine.name: NumpyEngine,
+}
+
+def get_engine(name):
+    if name not in ENGINES:
+        raise ValueError("Unknown N-Gram engine '%s', choose from %s." % (name, ", ".join(sorted(ENGINES))))
+    return ENGINES[name]()
@@ -0,0 +1,233 @@
+"""
+Read-only, memory-mapped index of the corpus counts of N-Grams, exported
+from the database by the export_ngram_index command for offline jobs. The
+file is laid out so that it can be searched in place: opening it parses
+nothing but the header, and processes that map the same file share its
+pages.
+
+The file (little-endian) is made up of:
+
+    header    magic, format version, the number of tokens, the size of
+              the string table and the number of bigrams and trigrams
+    offsets   uint32 offset of each token in the string table, plus the end
+    strings   the utf-8 tokens in sorted order, padded to 4 bytes
+    unigrams  (frequency, documents) uint32 pairs, by token id
+    bigrams   (alpha, beta, frequency, documents) uint32 records
+    trigrams  (alpha, beta, gamma, frequency, documents) uint32 records
+
+Token ids are positions in the sorted string table, and the bigram and
+trigram records are sorted by their token ids so that every lookup is a
+binary search.
+"""
+
+__author__ = 'benjamin'
+
+import os
+import sys
+import mmap
+import struct
+
+from array import array
+from bisect import bisect_left
+
+MAGIC   = 'NGIX'
+VERSION = 1
+HEADER  = struct.Struct('<4sBIIII')
+OFFSET  = struct.Struct('<I')
+COUNTS  = struct.Struct('<II')
+RECORDS = {
+    2: struct.Struct('<IIII'),
+    3: struct.Struct('<IIIII'),
+}
+
+class NGramIndexError(ValueError):
+    """
+    Raised when an N-Gram index file cannot be read.
+    """
+    pass
+
+def _write_array(f, values):
+    values = array('I', values)
+    if sys.byteorder == 'big': values.byteswap()
+    values.tofile(f)
+
+def write_index(path, unigrams, bigrams=(), trigrams=()):
+    """
+    Writes an index from iterables of (token, frequency, documents) and
+    of ((token, ...), frequency, documents) for the bigrams and trigrams.
+    The file is written beside the path and renamed into place, so that
+    readers never map a partial index.
+    """
+    counts = {}
+    for token, frequency, documents in unigrams:
+        counts[token] = (frequency, documents)
+
+    # Every token of a higher order N-Gram needs an id, counted or not
+    ngrams = {2: list(bigrams), 3: list(trigrams)}
+    for order in ngrams:
+        for key, frequency, documents in ngrams[order]:
+            for token in key:
+                counts.setdefault(token, (0, 0))
+
+    tokens  = sorted(counts, key=lambda token: token.encode('utf-8'))
+    ids     = dict((token, idx) for idx, token in enumerate(tokens))
+    encoded = [token.encode('utf-8') for token in tokens]
+
+    offsets = [0]
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    strings = ''.join(encoded)
+    strings += '\0' * (-len(strings) % 4)
+
+    temp = "%s.%i.tmp" % (path, os.getpid())
+    with open(temp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(tokens), len(strings), len(ngrams[2]), len(ngrams[3])))
+        _write_array(f, offsets)
+        f.write(strings)
+        _write_array(f, (value for token in tokens for value in counts[token]))
+
+        for order in (2, 3):
+            records = sorted(tuple(ids[token] for token in key) + (frequency, documents)
+                             for key, frequency, documents in ngrams[order])
+            _write_array(f, (value for record in records for value in record))
+    os.rename(temp, path)
+    return path
+
+class _Records(object):
+    """
+    Sequence view of the sorted N-Gram records of an order in the mapped
+    file, compared by their token ids, for use with bisect.
+    """
+
+    def __init__(self, data, offset, count, record):
+        self.data   = data
+        self.offset = offset
+        self.count  = count
+        self.record = record
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.count:
+            raise IndexError("Record %i out of range" % idx)
+        return self.record.unpack_from(self.data, self.offset + idx * self.record.size)
+
+    def __len__(self):
+        return self.count
+
+class _Tokens(object):
+    """
+    Sequence view of the sorted utf-8 tokens in the mapped file.
+    """
+
+    def __init__(self, data, offset, count, strings):
+        self.data    = data
+        self.offset  = offset
+        self.count   = count
+        self.strings = strings
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self.count:
+            raise IndexError("Token %i out of range" % idx)
+        start, = OFFSET.unpack_from(self.data, self.offset + idx * OFFSET.size)
+        end,   = OFFSET.unpack_from(self.data, self.offset + (idx + 1) * OFFSET.size)
+        return self.data[self.strings + start:self.strings + end]
+
+    def __len__(self):
+        return self.count
+
+class NGramIndex(object):
+    """
+    Looks up the corpus frequency and document frequency of unigrams
+    (given as a token) and bigrams and trigrams (given as a tuple of
+    tokens) in an exported index file, by binary search over the mapped
+    file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, ntokens, size, nbigrams, ntrigrams = HEADER.unpack_from(self.data)
+        except struct.error:
+            self.close()
+            raise NGramIndexError("%s is not an N-Gram index." % path)
+
+        if magic != MAGIC:
+            self.close()
+            raise NGramIndexError("%s is not an N-Gram index." % path)
+        if version != VERSION:
+            self.close()
+            raise NGramIndexError("Unsupported N-Gram index version %i." % version)
+
+        offset  = HEADER.size
+        strings = offset + (ntokens + 1) * OFFSET.size
+        self.tokens   = _Tokens(self.data, offset, ntokens, strings)
+        self.unigrams = strings + size
+
+        offset = self.unigrams + ntokens * COUNTS.size
+        self.records = {}
+        for order, count in ((2, nbigrams), (3, ntrigrams)):
+            self.records[order] = _Records(self.data, offset, count, RECORDS[order])
+            offset += count * RECORDS[order].size
+
+        if offset > len(self.data):
+            self.close()
+            raise NGramIndexError("%s is truncated." % path)
+
+    def token_id(self, token):
+        """
+        Returns the id of a token in the index, or None.
+        """
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        idx = bisect_left(self.tokens, token)
+        if idx < len(self.tokens) and self.tokens[idx] == token:
+            return idx
+        return None
+
+    def get(self, ngram):
+        """
+        Returns the (frequency, documents) of the N-Gram, or (0, 0).
+        """
+        if isinstance(ngram, basestring):
+            ngram = (ngram,)
+
+        ids = tuple(self.token_id(token) for token in ngram)
+        if None in ids:
+            return (0, 0)
+
+        if len(ids) == 1:
+            return COUNTS.unpack_from(self.data, self.unigrams + ids[0] * COUNTS.size)
+
+        if len(ids) not in self.records:
+            raise ValueError("The index holds unigrams to trigrams, not %i-grams." % len(ids))
+
+        records = self.records[len(ids)]
+        idx = bisect_left(records, ids)
+        if idx < len(records):
+            record = records[idx]
+            if record[:len(ids)] == ids:
+                return record[len(ids):]
+        return (0, 0)
+
+    def frequency(self, ngram):
+        return self.get(ngram)[0]
+
+    def documents(self, ngram):
+        return self.get(ngram)[1]
+
+    def close(self):
+        self.data.close()
+
+    def __contains__(self, ngram):
+        return self.get(ngram) != (0, 0)
+
+    def __len__(self):
+        return len(self.tokens) + sum(len(records) for records in self.records.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,56 @@
+__author__ = 'benjamin'
+
+from optparse import make_option
+from django.conf import settings
+from django.utils.importlib import import_module
+from django.utils.module_loading import module_has_submodule
+from django.core.management import BaseCommand, CommandError
+from movieplot.core.benchmark import registry
+from ngram.cache import cache_report
+
+def autodiscover():
+    """
+    Imports the benchmarks module of every installed app, registering the
+    benchmarks that they define.
+    """
+    for app in settings.INSTALLED_APPS:
+        module = import_module(app)
+        if module_has_submodule(module, 'benchmarks'):
+            import_module('%s.benchmarks' % app)
+
+class Command(BaseCommand):
+
+    args = "[benchmark benchmark ...]"
+    help = "Runs the named benchmarks (or all of them) and reports the timings."
+
+    option_list = BaseCommand.option_list + (
+        make_option('-l', '--list', action='store_true', dest='list', default=False,
+            help='List the available benchmarks.'),
+        make_option('-r', '--repeat', type='int', dest='repeat', default=3,
+            help='Number of timings to take the best of.'),
+        make_option('-n', '--limit', type='int', dest='limit', default=100,
+            help='Number of movies or samples to benchmark against.'),
+    )
+
+    def handle(self, *args, **options):
+        autodiscover()
+
+        if options.get('list'):
+            for name, func in registry.items():
+                print "%-24s %s" % (name, (func.__doc__ or '').strip().splitlines()[0])
+            return
+
+        names = args or registry.keys()
+        for name in names:
+            if name not in registry:
+                raise CommandError("No benchmark named '%s', use --list to see them." % name)
+
+        verbosity = int(options.get('verbosity', 1))
+        for name in names:
+            print name
+            for label, value, unit in registry[name](**options):
+                print "    %-48s %14.5f %s" % (label, value, unit)
+
+        if verbosity > 1:
+            for line in cache_report():
+                print line
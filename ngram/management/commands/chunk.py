@@ -1,23 +1,211 @@
 __author__ = 'benjamin'
 
+import os
+import time
+
+from datetime import datetime
+from optparse import make_option
+from multiprocessing import Pool
+from django.db import connection
+from django.utils import timezone
 from movies.models import Movie
-from ngram.analyze import MoviePlotAnalyzer
+from ngram.models import NGramPlotAnalysis
+from ngram.analyze import MoviePlotAnalyzer, NGramAnalyzer, CorpusSketch
+from ngram.cache import cache_report
+from movieplot.core.utils import batched_queryset, chunked
 from django.core.management import BaseCommand, CommandError
 
+# Seconds to wait for the workers to tag a batch: waiting without a
+# timeout can not be interrupted with Ctrl-C
+TAG_TIMEOUT = 24 * 60 * 60
+
+def warm_processor():
+    """
+    Worker initializer: loads the NLTK models once per worker process.
+    """
+    NGramAnalyzer.processor.load()
+
+def tag_plots(jobs):
+    """
+    Worker task: tags and serializes a list of (id, plot) pairs in batch,
+    without touching the database.
+    """
+    pks, plots = zip(*jobs)
+    return [(pk,) + tagged for pk, tagged in zip(pks, MoviePlotAnalyzer.preprocess_many(plots))]
+
 class Command(BaseCommand):
 
     analyzer = MoviePlotAnalyzer
 
-    help = "Creates NGram Models for all movies in the database, deleting previous analyses."
+    help = "Creates NGram Models for movies whose plot changed since their last analysis."
+
+    option_list = BaseCommand.option_list + (
+        make_option('-w', '--workers', type='int', dest='workers', default=1,
+            help='Number of processes used to tag plots that have no saved tagging.'),
+        make_option('-b', '--batch-size', type='int', dest='batch_size', default=100,
+            help='Number of movies whose vocabulary is resolved together.'),
+        make_option('-f', '--force', action='store_true', dest='force', default=False,
+            help='Reanalyze every movie, even if its plot has not changed.'),
+        make_option('-s', '--since', dest='since', default=None,
+            help='Only consider movies modified since this date (YYYY-MM-DD).'),
+        make_option('-a', '--approximate', dest='approximate', default=None, metavar='PATH',
+            help='Keep approximate corpus counts (a count-min sketch) of the N-Grams of the analyzed plots at PATH: reanalyzed '
+                 'plots replace their previous counts, and analyses that the sketch does not hold yet are added to it.'),
+        make_option('--sketch-error', type='float', dest='sketch_error', default=None,
+            help='Overestimate of the approximate counts, relative to the total count.'),
+        make_option('--sketch-bytes', type='int', dest='sketch_bytes', default=None,
+            help='Memory cap of the counters of the approximate counts.'),
+    )
 
     def handle(self, *args, **options):
 
-        self.verbosity = int(options.get('verbosity', 1))
+        self.verbosity  = int(options.get('verbosity', 1))
+        self.workers    = options.get('workers') or 1
+        self.batch_size = options.get('batch_size') or 100
+        self.force      = options.get('force', False)
+
+        if self.workers < 1 or self.batch_size < 1:
+            raise CommandError("--workers and --batch-size must be positive.")
+
+        movies = Movie.objects.all()
+        if options.get('since'):
+            movies = movies.filter(modified__gte=self.parse_date(options['since']))
+
+        self.sketch = None
+        self.sketch_path = options.get('approximate')
+        if self.sketch_path:
+            self.sketch = self.load_sketch(options['approximate'], options.get('sketch_error'), options.get('sketch_bytes'))
 
-        for movie in Movie.objects.select_related('ngram_analysis').all():
-            if movie.ngram_analysis:
-                movie.ngram_analysis.delete()
-            analysis = self.analyzer.analyze(movie)
+        self.total   = movies.count()
+        self.movies  = 0
+        self.skipped = 0
+        self.tokens  = 0
+        self.started = time.time()
 
+        # Forked workers must not share the coordinator's connection
+        pool = None
+        if self.workers > 1:
+            connection.close()
+            pool = Pool(self.workers, warm_processor)
+
+        try:
+            pending = None
+            for batch in batched_queryset(movies, self.batch_size):
+                batch = self.stale(batch)
+                if not batch: continue
+
+                # Tag the next batch in the pool while this one is written
+                jobs = [(movie.pk, movie.plot) for movie in batch if not self.is_tagged(movie)]
+                if not jobs:
+                    result = []
+                elif pool is not None:
+                    size   = -(-len(jobs) // self.workers)
+                    result = pool.map_async(tag_plots, list(chunked(jobs, size)))
+                else:
+                    result = [tag_plots(jobs)]
+
+                if pending is not None:
+                    self.write(*pending)
+                pending = (batch, result)
+
+            if pending is not None:
+                self.write(*pending)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if self.sketch is not None:
+            self.sketch.save(self.sketch_path)
             if self.verbosity > 0:
-                print analysis
\ No newline at end of file
+                print "Approximate counts of %i N-Grams in %i bytes, overestimated by at most %i: %s" % (
+                    self.sketch.total, self.sketch.nbytes, self.sketch.bound, options['approximate'])
+
+        if self.verbosity > 0:
+            print "Finished, %i analyzed and %i unchanged: %s" % (self.movies, self.skipped, self.throughput())
+        if self.verbosity > 1:
+            for line in cache_report():
+                print line
+
+    def parse_date(self, value):
+        try:
+            since = datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            raise CommandError("Could not parse --since date '%s', use YYYY-MM-DD." % value)
+        return timezone.make_aware(since, timezone.get_default_timezone())
+
+    def load_sketch(self, path, error=None, max_bytes=None):
+        """
+        Returns the approximate counts saved at path, or new ones.
+        """
+        if not os.path.exists(path):
+            try:
+                return CorpusSketch(error=error, max_bytes=max_bytes)
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        try:
+            return CorpusSketch.load(path)
+        except (IOError, ValueError) as e:
+            raise CommandError("Could not load the approximate counts at %s: %s" % (path, e))
+
+    def stale(self, batch):
+        """
+        Filters out movies whose analysis is current with their plot.
+        """
+        if self.force:
+            return batch
+
+        analyses = NGramPlotAnalysis.objects.filter(movie__in=[movie.pk for movie in batch])
+        current  = dict(analyses.values_list('movie_id', 'fingerprint'))
+        stale    = [movie for movie in batch if current.get(movie.pk) != self.analyzer.fingerprint(movie)]
+
+        # Add the current analyses that the sketch does not hold: those
+        # written before it was started, or by a run that was interrupted
+        if self.sketch is not None:
+            unchanged = analyses.exclude(movie__in=[movie.pk for movie in stale])
+            missing   = [analysis for analysis in unchanged if not self.sketch.holds(analysis)]
+            for analysis in missing:
+                self.sketch.add_analysis(analysis)
+            if missing:
+                self.sketch.save(self.sketch_path)
+
+        self.skipped += len(batch) - len(stale)
+        return stale
+
+    def is_tagged(self, movie):
+        return NGramAnalyzer.processor.is_serialization_of(movie.plot_tagged, movie.plot)
+
+    def write(self, batch, result):
+        movies = dict((movie.pk, movie) for movie in batch)
+        for tagged in (result.get(TAG_TIMEOUT) if hasattr(result, 'get') else result):
+            for pk, serialized, tokens in tagged:
+                self.analyzer.save_tagged(movies[pk], serialized)
+                self.tokens += tokens
+
+        # The counts of the analyses about to be replaced are taken out of
+        # the sketch, and the sketch saved, before the new ones are written
+        # (each is committed as it is written), so that a run interrupted
+        # in between leaves it holding neither
+        if self.sketch is not None:
+            for analysis in NGramPlotAnalysis.objects.filter(movie__in=movies.keys()):
+                self.sketch.remove_analysis(analysis)
+            self.sketch.save(self.sketch_path)
+
+        for analysis in self.analyzer.analyze_many(batch, sketch=self.sketch):
+            if self.sketch is not None:
+                self.sketch.counted(analysis)
+            if self.verbosity > 1:
+                print analysis
+
+        if self.sketch is not None:
+            self.sketch.save(self.sketch_path)
+
+        self.movies += len(batch)
+
+        if self.verbosity > 0:
+            print "Analyzed %i of %i movies (%i unchanged): %s" % (self.movies, self.total, self.skipped, self.throughput())
+
+    def throughput(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        return "%0.2f movies/sec, %0.2f tokens/sec" % (self.movies / elapsed, self.tokens / elapsed)
@@ -0,0 +1,18 @@
+__author__ = 'benjamin'
+
+from movieplot.core.transactions import commit_on_success
+from ngram.models import NGramCorpusFrequency
+from django.core.management import BaseCommand
+
+class Command(BaseCommand):
+
+    help = "Rebuilds the corpus frequency table from the N-Gram models of every analysis."
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        with commit_on_success():
+            NGramCorpusFrequency.objects.rebuild()
+
+        if verbosity > 0:
+            print "Rebuilt the corpus frequency of %i N-Grams" % NGramCorpusFrequency.objects.count()
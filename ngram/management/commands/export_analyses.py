@@ -0,0 +1,198 @@
+__author__ = 'benjamin'
+
+import os
+import glob
+import json
+
+from optparse import make_option
+from collections import defaultdict
+from django.db import reset_queries
+from movies.models import Movie
+from ngram.models import NGramModel, NGramPlotAnalysis, NGRAM_MODELS, resolve_tokens
+from movieplot.core.utils import batched_queryset
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand, CommandError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FORMATS = ('jsonl', 'npz')
+STATE   = 'export.json'
+
+def replace(path, write):
+    """
+    Calls write with a temporary file beside the path, then renames it
+    into place so that readers never see a partial file.
+    """
+    temp = "%s.%i.tmp" % (path, os.getpid())
+    with open(temp, 'wb') as f:
+        write(f)
+    os.rename(temp, path)
+
+class Command(BaseCommand):
+
+    args = "<directory>"
+    help = ("Streams movies, their plot analyses and N-Gram counts to numbered JSONL or columnar (npz) files. "
+            "Exports are append-only: a reanalyzed movie is written again with its new analysis, so readers "
+            "should keep the record of each movie with the latest 'analyzed' time.")
+
+    option_list = BaseCommand.option_list + (
+        make_option('-f', '--format', dest='format', default='jsonl', choices=FORMATS,
+            help='Format of the part files: jsonl (one analysis per line) or npz (NumPy columns).'),
+        make_option('-b', '--batch-size', type='int', dest='batch_size', default=500,
+            help='Number of analyses read per query and written per part file.'),
+        make_option('-r', '--restart', action='store_true', dest='restart', default=False,
+            help='Discard the parts of a previous export and start from the first analysis.'),
+    )
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+            raise CommandError("Specify the directory to export the analyses to.")
+
+        self.verbosity  = int(options.get('verbosity', 1))
+        self.batch_size = options.get('batch_size') or 500
+        self.format     = options.get('format') or 'jsonl'
+
+        if self.batch_size < 1:
+            raise CommandError("--batch-size must be positive.")
+        if self.format not in FORMATS:
+            raise CommandError("Unknown format '%s', use one of %s." % (self.format, ", ".join(FORMATS)))
+        if self.format == 'npz' and np is None:
+            raise CommandError("NumPy is required to write npz parts.")
+
+        self.directory = os.path.abspath(args[0])
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        state = self.read_state(options.get('restart', False))
+        self.ngram_types = dict((ContentType.objects.get_for_model(model).pk, model) for model in NGRAM_MODELS)
+
+        # Keyset batches from the last exported analysis, so that a rerun
+        # picks up where an interrupted export stopped. Reanalysis creates
+        # a new analysis, so the parts may hold several records of a movie
+        # (told apart by their movie id and analyzed time)
+        analyses = NGramPlotAnalysis.objects.filter(pk__gt=state['last']).select_related('movie')
+        for batch in batched_queryset(analyses, self.batch_size):
+            records = self.records(batch)
+            path = self.write(records, state['parts'] + 1)
+
+            state['last']      = batch[-1].pk
+            state['parts']    += 1
+            state['analyses'] += len(records)
+            state['ngrams']   += sum(len(record['ngrams']) for record in records)
+            self.write_state(state)
+
+            # Keep the query log of DEBUG from growing with the corpus
+            reset_queries()
+
+            if self.verbosity > 1:
+                print "Wrote %i analyses to %s" % (len(records), path)
+
+        if self.verbosity > 0:
+            print "Exported %i analyses and %i N-Gram counts in %i parts to %s" % (state['analyses'], state['ngrams'], state['parts'], self.directory)
+
+    def read_state(self, restart):
+        """
+        Returns the progress of the export in the directory: the primary
+        key of the last exported analysis and the number of parts written.
+        """
+        path = os.path.join(self.directory, STATE)
+        if restart or not os.path.exists(path):
+            for part in glob.glob(os.path.join(self.directory, "analyses-*.%s" % self.format)):
+                os.remove(part)
+            return {'format': self.format, 'last': 0, 'parts': 0, 'analyses': 0, 'ngrams': 0}
+
+        with open(path, 'rb') as f:
+            try:
+                state = json.load(f)
+            except ValueError:
+                raise CommandError("Could not read the export state in %s, use --restart." % path)
+
+        if state.get('format') != self.format:
+            raise CommandError("%s holds a %s export, use --restart to replace it." % (self.directory, state.get('format')))
+        return state
+
+    def write_state(self, state):
+        replace(os.path.join(self.directory, STATE), lambda f: json.dump(state, f))
+
+    def records(self, batch):
+        """
+        Returns a record of the movie, analysis and N-Gram counts of each
+        analysis in the batch, with the N-Grams as lists of tokens.
+        """
+        counts = defaultdict(list)
+        rows   = NGramModel.objects.filter(analysis__in=[analysis.pk for analysis in batch if not analysis.is_packed])
+        for analysis, ngram_type, ngram_id, frequency in rows.values_list('analysis', 'ngram_type', 'ngram_id', 'frequency').order_by():
+            counts[analysis].append((self.ngram_types[ngram_type], ngram_id, frequency))
+
+        for analysis in batch:
+            if not analysis.is_packed: continue
+            for model in NGRAM_MODELS:
+                counts[analysis.pk].extend((model, ngram_id, frequency) for ngram_id, frequency in analysis.histogram(model).iteritems())
+
+        needed = defaultdict(set)
+        for ngrams in counts.itervalues():
+            for model, ngram_id, frequency in ngrams:
+                needed[model].add(ngram_id)
+        tokens = resolve_tokens(needed)
+
+        genres = defaultdict(list)
+        through = Movie.genres.through.objects.filter(movie__in=[analysis.movie_id for analysis in batch])
+        for movie, genre in through.values_list('movie', 'genre__name').order_by('genre__name'):
+            genres[movie].append(genre)
+
+        records = []
+        for analysis in batch:
+            movie  = analysis.movie
+            ngrams = [(tokens[(model, ngram_id)], frequency) for model, ngram_id, frequency in counts[analysis.pk]
+                      if (model, ngram_id) in tokens]
+            ngrams.sort(key=lambda (key, frequency): (len(key), -frequency, key))
+            records.append({
+                'analysis': analysis.pk,
+                'analyzed': analysis.analyzed.isoformat() if analysis.analyzed else None,
+                'fingerprint': analysis.fingerprint,
+                'movie': movie.pk,
+                'title': movie.title,
+                'slug': movie.slug,
+                'year': movie.year,
+                'rated': movie.rated,
+                'released': movie.released.isoformat() if movie.released else None,
+                'runtime': movie.runtime,
+                'genres': genres[movie.pk],
+                'ngrams': [(list(key), frequency) for key, frequency in ngrams],
+            })
+        return records
+
+    def write(self, records, part):
+        path = os.path.join(self.directory, "analyses-%05i.%s" % (part, self.format))
+        writer = self.write_jsonl if self.format == 'jsonl' else self.write_npz
+        replace(path, lambda f: writer(f, records))
+        return path
+
+    def write_jsonl(self, f, records):
+        for record in records:
+            f.write(json.dumps(record, separators=(',', ':')))
+            f.write("\n")
+
+    def write_npz(self, f, records):
+        """
+        Writes a table of analyses and a table of their N-Gram counts,
+        joined on the analysis column, with N-Grams as space separated
+        tokens.
+        """
+        columns = {
+            'analysis': np.array([record['analysis'] for record in records], dtype=np.int64),
+            'movie': np.array([record['movie'] for record in records], dtype=np.int64),
+            'title': np.array([record['title'] or u'' for record in records], dtype=np.unicode_),
+            'year': np.array([record['year'] or u'' for record in records], dtype=np.unicode_),
+            'analyzed': np.array([record['analyzed'] or u'' for record in records], dtype=np.unicode_),
+            'genres': np.array([u"|".join(record['genres']) for record in records], dtype=np.unicode_),
+            'ngram_analysis': np.array([record['analysis'] for record in records for ngram in record['ngrams']], dtype=np.int64),
+            'ngram_order': np.array([len(key) for record in records for key, frequency in record['ngrams']], dtype=np.int8),
+            'ngram': np.array([u" ".join(key) for record in records for key, frequency in record['ngrams']], dtype=np.unicode_),
+            'ngram_frequency': np.array([frequency for record in records for key, frequency in record['ngrams']], dtype=np.int64),
+        }
+        np.savez_compressed(f, **columns)
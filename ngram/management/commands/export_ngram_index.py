@@ -0,0 +1,75 @@
+__author__ = 'benjamin'
+
+import os
+
+from optparse import make_option
+from ngram.index import write_index
+from ngram.managers import NGRAM_KEYS
+from ngram.models import NGramCorpusFrequency, NGRAM_ORDER_MAP
+from movieplot.core.utils import batched_queryset
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import BaseCommand, CommandError
+
+class Command(BaseCommand):
+
+    args = "<path>"
+    help = "Writes the corpus counts of every N-Gram to a memory-mapped index file for offline lookups."
+
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batch-size', type='int', dest='batch_size', default=10000,
+            help='Number of rows read from the database per query.'),
+    )
+
+    def handle(self, *args, **options):
+
+        if len(args) != 1:
+            raise CommandError("Specify the path of the index file to write.")
+
+        self.verbosity  = int(options.get('verbosity', 1))
+        self.batch_size = options.get('batch_size') or 10000
+        if self.batch_size < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        path = os.path.abspath(args[0])
+        if not os.path.isdir(os.path.dirname(path)):
+            raise CommandError("The directory of '%s' does not exist." % path)
+
+        self.tokens = self.read_tokens()
+        ngrams = dict((order, self.read_ngrams(order)) for order in NGRAM_ORDER_MAP)
+        unigrams = [(token, frequency, documents) for (token,), frequency, documents in ngrams[1]]
+        write_index(path, unigrams, ngrams[2], ngrams[3])
+
+        if self.verbosity > 0:
+            print "Wrote %i unigrams, %i bigrams and %i trigrams to %s" % (len(ngrams[1]), len(ngrams[2]), len(ngrams[3]), path)
+
+    def read_tokens(self):
+        """
+        Returns a dictionary of Unigram ids to their tokens.
+        """
+        tokens = {}
+        for batch in batched_queryset(NGRAM_ORDER_MAP[1].objects.values('pk', 'token'), self.batch_size):
+            tokens.update((row['pk'], row['token']) for row in batch)
+        return tokens
+
+    def read_ngrams(self, order):
+        """
+        Returns a list of ((token, ...), frequency, documents) for the
+        N-Grams of an order in the corpus frequency table.
+        """
+        model  = NGRAM_ORDER_MAP[order]
+        counts = NGramCorpusFrequency.objects.filter(ngram_type=ContentType.objects.get_for_model(model))
+        counts = counts.values('pk', 'ngram_id', 'frequency', 'documents')
+
+        keys = {}
+        if order > 1:
+            fields = tuple('%s_id' % key for key in NGRAM_KEYS[:order])
+            for batch in batched_queryset(model.objects.values('pk', *fields), self.batch_size):
+                keys.update((row['pk'], tuple(self.tokens[row[field]] for field in fields)) for row in batch)
+
+        ngrams = []
+        for batch in batched_queryset(counts, self.batch_size):
+            for row in batch:
+                key = (self.tokens[row['ngram_id']],) if order == 1 else keys.get(row['ngram_id'])
+                if key is not None:
+                    ngrams.append((key, row['frequency'], row['documents']))
+        return ngrams
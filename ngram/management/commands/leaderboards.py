@@ -0,0 +1,24 @@
+__author__ = 'benjamin'
+
+from optparse import make_option
+from movieplot.core.transactions import commit_on_success
+from ngram.models import NGramLeaderboard
+from django.core.management import BaseCommand
+
+class Command(BaseCommand):
+
+    help = "Rebuilds the stale top-k N-Gram leaderboards of the genres and decades of the analyzed movies."
+
+    option_list = BaseCommand.option_list + (
+        make_option('-a', '--all', action='store_true', dest='all', default=False,
+            help='Rebuild every leaderboard, not only the stale ones.'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        with commit_on_success():
+            built = NGramLeaderboard.objects.rebuild(stale=not options.get('all', False))
+
+        if verbosity > 0:
+            print "Rebuilt %i leaderboards" % built
@@ -0,0 +1,39 @@
+__author__ = 'benjamin'
+
+from optparse import make_option
+from movieplot.core.transactions import commit_on_success
+from ngram.models import NGramPlotAnalysis
+from movieplot.core.utils import batched_queryset
+from django.core.management import BaseCommand, CommandError
+
+class Command(BaseCommand):
+
+    help = "Converts plot analyses from N-Gram model rows to packed histograms, or back."
+
+    option_list = BaseCommand.option_list + (
+        make_option('-u', '--unpack', action='store_true', dest='unpack', default=False,
+            help='Convert packed analyses back into N-Gram model rows.'),
+        make_option('-b', '--batch-size', type='int', dest='batch_size', default=100,
+            help='Number of analyses converted per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+
+        verbosity  = int(options.get('verbosity', 1))
+        unpack     = options.get('unpack', False)
+        batch_size = options.get('batch_size') or 100
+
+        if batch_size < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        analyses  = NGramPlotAnalysis.objects.filter(packed_unigrams__isnull=not unpack)
+        total     = analyses.count()
+        converted = 0
+
+        for batch in batched_queryset(analyses, batch_size):
+            with commit_on_success():
+                for analysis in batch:
+                    converted += int(analysis.unpack() if unpack else analysis.pack())
+
+            if verbosity > 0:
+                print "%s %i of %i analyses" % ("Unpacked" if unpack else "Packed", converted, total)
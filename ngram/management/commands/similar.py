@@ -0,0 +1,36 @@
+__author__ = 'benjamin'
+
+import time
+
+from optparse import make_option
+from ngram.similarity import SimilarityEngine
+from django.core.management import BaseCommand, CommandError
+
+class Command(BaseCommand):
+
+    help = "Computes the most similar movies of every analyzed movie by the TF-IDF of their plot N-Grams."
+
+    option_list = BaseCommand.option_list + (
+        make_option('-f', '--full', action='store_true', dest='full', default=False,
+            help='Recompute every movie rather than only those analyzed since the last run.'),
+        make_option('-k', '--neighbours', type='int', dest='k', default=SimilarityEngine.k,
+            help='Number of similar movies stored per movie.'),
+        make_option('-p', '--block-postings', type='int', dest='block_postings', default=SimilarityEngine.block_postings,
+            help='Maximum number of postings walked per block of movies (bounds memory).'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options.get('k', 1) < 1 or options.get('block_postings', 1) < 1:
+            raise CommandError("--neighbours and --block-postings must be positive.")
+
+        try:
+            engine = SimilarityEngine(k=options.get('k'), block_postings=options.get('block_postings'))
+        except ImportError as e:
+            raise CommandError(str(e))
+
+        started = time.time()
+        updated = engine.build() if options.get('full') else engine.update()
+
+        if verbosity > 0:
+            print "Updated the similar movies of %i movies in %0.2f seconds" % (updated, time.time() - started)
@@ -1,20 +1,613 @@
 __author__ = 'benjamin'
 
-from django.db import models
+import struct
+import hashlib
+
+from collections import defaultdict
+from django.db import models, connections, transaction, IntegrityError
+from django.conf import settings
+from django.utils import timezone
+from django.db.models import F, Sum, Count
 from django.core.exceptions import MultipleObjectsReturned
+from django.contrib.contenttypes.models import ContentType
+from ngram.cache import ngram_cache
+from movieplot.core.utils import batched_queryset, chunked
+from movieplot.core.transactions import commit_on_success
+
+# Field names of the Unigram components of an N-Gram, in order
+NGRAM_KEYS = ('alpha', 'beta', 'gamma', 'delta')
 
 class NGramManager(models.Manager):
 
+    # Number of keys looked up or inserted per query
+    batch_size = 300
+
     def get_by_natural_key(self, *args):
 
         # Special case for Unigrams
         if len(args) == 1:
-            return self.get(token=args[0])
+            pk = ngram_cache.get(self.model, args[0])
+            if pk is not None:
+                return self._build(args[0], self.key_fields(), pk)
+            ngram = self.get(token=args[0])
+            ngram_cache.set(self.model, args[0], ngram.pk)
+            return ngram
 
-        # For Bigrams through Quadgrams
-        keys   = ('alpha', 'beta', 'gamma', 'delta')
-        kwargs = dict(zip(keys, args))
+        # For Bigrams through Quadgrams, which may be given ids or Unigrams
+        key = tuple(getattr(arg, 'pk', arg) for arg in args)
+        pk  = ngram_cache.get(self.model, key)
+        if pk is not None:
+            ngram = self._build(key, self.key_fields(), pk)
+            for name, arg in zip(NGRAM_KEYS, args):
+                if isinstance(arg, models.Model):
+                    setattr(ngram, '_%s_cache' % name, arg)
+            return ngram
+
+        kwargs = dict(zip(NGRAM_KEYS, args))
         try:
-            return self.get(**kwargs)
+            ngram = self.get(**kwargs)
         except MultipleObjectsReturned:
-            raise MultipleObjectsReturned("Did you specify the correct number of tokens for the N-Gram?")
\ No newline at end of file
+            raise MultipleObjectsReturned("Did you specify the correct number of tokens for the N-Gram?")
+        ngram_cache.set(self.model, key, ngram.pk)
+        return ngram
+
+    def key_fields(self):
+        """
+        Returns the fields that make up the natural key of the model: the
+        token of a Unigram, or the Unigram components of a higher N-Gram.
+        """
+        fields = dict((field.name, field) for field in self.model._meta.fields)
+        if 'token' in fields:
+            return (fields['token'],)
+        return tuple(fields[key] for key in NGRAM_KEYS if key in fields)
+
+    def get_key(self, ngram, fields=None):
+        """
+        Returns the key of an instance as used by resolve().
+        """
+        fields = fields or self.key_fields()
+        if len(fields) == 1:
+            return getattr(ngram, fields[0].attname)
+        return tuple(getattr(ngram, field.attname) for field in fields)
+
+    def resolve(self, keys, save=True):
+        """
+        Bulk counterpart to get_or_create: takes an iterable of keys, which
+        are tokens for Unigrams or tuples of Unigram ids for higher order
+        N-Grams, and returns a dictionary mapping each key to its instance.
+
+        Keys in the id cache are built without a query, the rest are
+        fetched with a handful of IN queries, and if save is true the
+        missing rows are bulk created, otherwise DoesNotExist is raised
+        for the first key that is not in the database.
+        """
+        fields   = self.key_fields()
+        found    = {}
+        uncached = []
+        for key in set(keys):
+            pk = ngram_cache.get(self.model, key)
+            if pk is None:
+                uncached.append(key)
+            else:
+                found[key] = self._build(key, fields, pk)
+
+        found.update(self._lookup(uncached, fields))
+        missing = set(uncached).difference(found)
+
+        if missing:
+            if not save:
+                raise self.model.DoesNotExist("%s matching key %r does not exist." % (self.model.__name__, min(missing)))
+
+            # Sorted so that reruns assign ids in the same order
+            missing = sorted(missing)
+            self.bulk_create([self._build(key, fields) for key in missing], batch_size=self.batch_size)
+            found.update(self._lookup(missing, fields))
+
+        return found
+
+    def _lookup(self, keys, fields):
+        found = {}
+        for chunk in chunked(keys, self.batch_size):
+            # Multi-field lookups return a superset of the chunk: filter it
+            wanted = set(chunk)
+            for ngram in self.filter(**self._key_lookup(chunk, fields)):
+                key = self.get_key(ngram, fields)
+                if key in wanted:
+                    found[key] = ngram
+                    ngram_cache.set(self.model, key, ngram.pk)
+        return found
+
+    def _key_lookup(self, keys, fields):
+        """
+        Returns the filter arguments that select (at least) the keys.
+        """
+        if len(fields) == 1:
+            return {'%s__in' % fields[0].attname: keys}
+        return dict(('%s__in' % field.attname, set(key[idx] for key in keys))
+                    for idx, field in enumerate(fields))
+
+    def _key_values(self, key, fields):
+        """
+        Returns the field values of the instance with the key.
+        """
+        ident = key if len(fields) > 1 else (key,)
+        return dict((field.attname, value) for field, value in zip(fields, ident))
+
+    def _build(self, key, fields, pk=None):
+        """
+        Builds an instance from its key, as if it was loaded from the
+        database when a primary key is given.
+        """
+        ngram = self.model(pk=pk, **self._key_values(key, fields))
+        if pk is not None:
+            ngram._state.adding = False
+            ngram._state.db = self.db
+        return ngram
+
+class HashedNGramManager(NGramManager):
+    """
+    Manager of N-Grams of any order keyed by a 64 bit hash of their
+    Unigram ids: keys are tuples of Unigram ids as for the other orders,
+    but every lookup is a probe of the hash index, and the ids stored with
+    each row tell apart N-Grams whose hashes collide.
+    """
+
+    def hash_key(self, ids):
+        digest = hashlib.sha1(struct.pack('<%iQ' % len(ids), *ids)).digest()
+        return struct.unpack('<q', digest[:8])[0]
+
+    def get_by_natural_key(self, *args):
+        key   = tuple(getattr(arg, 'pk', arg) for arg in args)
+        ngram = self.resolve([key], save=False)[key]
+        if all(isinstance(arg, models.Model) for arg in args):
+            ngram._components_cache = tuple(args)
+        return ngram
+
+    def key_fields(self):
+        return (self.model._meta.get_field('unigrams'),)
+
+    def get_key(self, ngram, fields=None):
+        return ngram.ids
+
+    def attach_components(self, ngrams):
+        """
+        Fetches the Unigrams of a list of N-Grams with one query a batch.
+        """
+        from ngram.models import Unigram
+
+        ids = set()
+        for ngram in ngrams:
+            ids.update(ngram.ids)
+
+        unigrams = {}
+        for chunk in chunked(ids, self.batch_size):
+            unigrams.update(Unigram.objects.in_bulk(chunk))
+
+        for ngram in ngrams:
+            ngram._components_cache = tuple(unigrams.get(ident) for ident in ngram.ids)
+        return ngrams
+
+    def _key_lookup(self, keys, fields):
+        return {'key__in': set(self.hash_key(key) for key in keys)}
+
+    def _key_values(self, key, fields):
+        unigrams = ",".join(str(ident) for ident in key)
+        if len(unigrams) > self.model._meta.get_field('unigrams').max_length:
+            raise ValueError("The %i-gram %r has too many Unigram ids to store." % (len(key), key))
+        return {'order': len(key), 'key': self.hash_key(key), 'unigrams': unigrams}
+
+def hydrate_ngrams(rows, batch_size=300):
+    """
+    Sets the N-Gram of each of a list of N-Gram models (or other rows with
+    an ngram generic foreign key) with one query per content type and
+    batch, joining in the Unigram components of higher order N-Grams.
+    """
+    by_type = defaultdict(set)
+    for row in rows:
+        by_type[row.ngram_type_id].add(row.ngram_id)
+
+    ngrams = {}
+    for ngram_type, ids in by_type.iteritems():
+        model = ContentType.objects.get_for_id(ngram_type).model_class()
+        manager = model._default_manager
+        for chunk in chunked(ids, batch_size):
+            found = manager.select_related().in_bulk(chunk)
+            if hasattr(manager, 'attach_components'):
+                manager.attach_components(found.values())
+            for pk, ngram in found.iteritems():
+                ngrams[(ngram_type, pk)] = ngram
+
+    for row in rows:
+        row._ngram_cache = ngrams.get((row.ngram_type_id, row.ngram_id))
+    return rows
+
+class NGramModelQuerySet(models.query.QuerySet):
+    """
+    Query set of N-Gram models that, once hydrated(), fetches the N-Grams
+    of its rows in bulk instead of one generic lookup (and a query per
+    Unigram component) for every row.
+    """
+
+    # Number of rows whose N-Grams are fetched together
+    batch_size = 300
+
+    def __init__(self, *args, **kwargs):
+        super(NGramModelQuerySet, self).__init__(*args, **kwargs)
+        self._hydrate = False
+
+    def hydrated(self):
+        clone = self._clone()
+        clone._hydrate = True
+        return clone
+
+    def _clone(self, *args, **kwargs):
+        clone = super(NGramModelQuerySet, self)._clone(*args, **kwargs)
+        if isinstance(clone, NGramModelQuerySet):
+            clone._hydrate = self._hydrate
+        return clone
+
+    def iterator(self):
+        rows = super(NGramModelQuerySet, self).iterator()
+        if not self._hydrate:
+            for row in rows:
+                yield row
+            return
+
+        for chunk in chunked(rows, self.batch_size):
+            for row in hydrate_ngrams(chunk, self.batch_size):
+                yield row
+
+class NGramModelManager(models.Manager):
+
+    def get_query_set(self):
+        return NGramModelQuerySet(self.model, using=self._db)
+
+    def hydrated(self):
+        return self.get_query_set().hydrated()
+
+class CorpusFrequencyManager(models.Manager):
+    """
+    Maintains the corpus and document frequency of every N-Gram from the
+    analyses. Analyses stored as N-Gram model rows are added or removed
+    with a constant number of set-based statements, whatever their size;
+    packed analyses are applied from their decoded histograms.
+
+    The unique constraint on (ngram_type, ngram_id) makes the insert of an
+    N-Gram that a concurrent writer has just inserted fail; the write is
+    then rolled back to a savepoint and run again, updating that row.
+    """
+
+    # Number of N-Grams looked up, updated or inserted per query
+    batch_size = 300
+
+    # Times a write is run again after losing a race to insert an N-Gram
+    retries = 3
+
+    def add_analysis(self, analysis):
+        """
+        Adds the N-Grams of a newly written analysis to the totals.
+        """
+        if analysis.is_packed:
+            self._retry(self.apply, self.deltas([analysis]))
+        else:
+            self._retry(self._apply, analysis, '+')
+
+    def remove_analysis(self, analysis):
+        """
+        Subtracts the N-Grams of an analysis about to be deleted.
+        """
+        if analysis.is_packed:
+            self._retry(self.apply, self.deltas([analysis], -1))
+        else:
+            self._retry(self._apply, analysis, '-')
+
+    def rebuild(self):
+        """
+        Recomputes the whole table from the N-Gram models and the packed
+        analyses.
+        """
+        from ngram.models import NGramPlotAnalysis
+
+        table, models_table = self._tables()
+        cursor = connections[self.db].cursor()
+        cursor.execute("DELETE FROM %s" % table)
+        cursor.execute(
+            "INSERT INTO %s (ngram_type_id, ngram_id, frequency, documents) "
+            "SELECT ngram_type_id, ngram_id, SUM(frequency), COUNT(*) FROM %s "
+            "GROUP BY ngram_type_id, ngram_id" % (table, models_table)
+        )
+        transaction.commit_unless_managed(using=self.db)
+
+        packed = NGramPlotAnalysis.objects.filter(packed_unigrams__isnull=False)
+        for batch in batched_queryset(packed, self.batch_size):
+            self._retry(self.apply, self.deltas(batch))
+
+    def deltas(self, analyses, sign=1):
+        """
+        Returns the changes to the table made by adding (or removing, with
+        a sign of -1) analyses, as {(type id, N-Gram id): [frequency,
+        documents]}.
+        """
+        from ngram.models import NGRAM_MODELS
+
+        deltas = defaultdict(lambda: [0, 0])
+        for model in NGRAM_MODELS:
+            ngram_type = ContentType.objects.get_for_model(model).pk
+            for analysis in analyses:
+                for ngram_id, frequency in analysis.histogram(model).iteritems():
+                    delta = deltas[(ngram_type, ngram_id)]
+                    delta[0] += sign * frequency
+                    delta[1] += sign
+        return deltas
+
+    def apply(self, deltas):
+        """
+        Applies deltas: existing rows that change by the same amounts are
+        updated together and new N-Grams are bulk created.
+        """
+        by_type = defaultdict(dict)
+        for (ngram_type, ngram_id), delta in deltas.iteritems():
+            by_type[ngram_type][ngram_id] = tuple(delta)
+
+        created = []
+        for ngram_type, changes in by_type.iteritems():
+            existing = set()
+            for chunk in chunked(changes, self.batch_size):
+                existing.update(self.filter(ngram_type=ngram_type, ngram_id__in=chunk).values_list('ngram_id', flat=True))
+
+            groups = defaultdict(list)
+            for ngram_id, (frequency, documents) in changes.iteritems():
+                if ngram_id in existing:
+                    groups[(frequency, documents)].append(ngram_id)
+                elif documents > 0:
+                    created.append(self.model(ngram_type_id=ngram_type, ngram_id=ngram_id, frequency=frequency, documents=documents))
+
+            for (frequency, documents), ids in groups.iteritems():
+                for chunk in chunked(ids, self.batch_size):
+                    self.filter(ngram_type=ngram_type, ngram_id__in=chunk).update(
+                        frequency=F('frequency') + frequency, documents=F('documents') + documents
+                    )
+
+        self.bulk_create(created, batch_size=self.batch_size)
+        if any(documents < 0 for frequency, documents in deltas.itervalues()):
+            self.filter(documents__lte=0).delete()
+
+    def _retry(self, func, *args):
+        """
+        Runs func in a savepoint of a managed transaction, rolling back and
+        running it again when its insert of an N-Gram loses a race with
+        another writer. Backends without savepoints (SQLite, which allows
+        one writer at a time) raise the IntegrityError.
+        """
+        if not transaction.is_managed(using=self.db):
+            with commit_on_success(using=self.db):
+                return self._retry(func, *args)
+
+        connection = connections[self.db]
+        for attempt in xrange(self.retries):
+            sid = transaction.savepoint(using=self.db)
+            try:
+                result = func(*args)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=self.db)
+                if not connection.features.uses_savepoints or attempt == self.retries - 1:
+                    raise
+            else:
+                transaction.savepoint_commit(sid, using=self.db)
+                return result
+
+    def _tables(self):
+        from ngram.models import NGramModel
+        qn = connections[self.db].ops.quote_name
+        return qn(self.model._meta.db_table), qn(NGramModel._meta.db_table)
+
+    def _apply(self, analysis, op):
+        table, models_table = self._tables()
+        matching = (
+            "FROM %s m WHERE m.analysis_id = %%s AND m.ngram_type_id = %s.ngram_type_id "
+            "AND m.ngram_id = %s.ngram_id" % (models_table, table, table)
+        )
+        params = [getattr(analysis, 'pk', analysis)]
+
+        cursor = connections[self.db].cursor()
+        cursor.execute(
+            "UPDATE %s SET frequency = frequency %s (SELECT m.frequency %s), documents = documents %s 1 "
+            "WHERE EXISTS (SELECT 1 %s)" % (table, op, matching, op, matching), params * 2
+        )
+
+        if op == '+':
+            # N-Grams seen for the first time in the corpus
+            cursor.execute(
+                "INSERT INTO %s (ngram_type_id, ngram_id, frequency, documents) "
+                "SELECT m.ngram_type_id, m.ngram_id, m.frequency, 1 FROM %s m WHERE m.analysis_id = %%s "
+                "AND NOT EXISTS (SELECT 1 FROM %s c WHERE c.ngram_type_id = m.ngram_type_id "
+                "AND c.ngram_id = m.ngram_id)" % (table, models_table, table), params
+            )
+        else:
+            cursor.execute("DELETE FROM %s WHERE documents <= 0" % table)
+
+class LeaderboardManager(models.Manager):
+    """
+    Top-k N-Gram leaderboards per order, across the corpus or within a
+    slice of the movies: a genre or a decade of release.
+
+    The corpus-wide boards of N-Grams with a table of their own are read
+    from the incrementally maintained corpus frequency table through its
+    frequency index. The others are stored as rankings, marked stale when
+    the analysis of a movie in their slice is written or deleted (or the
+    movie's genres change) and rebuilt with the leaderboards command.
+    Reads of any board cost O(k).
+    """
+
+    # Number of packed analyses decoded at a time when building a board
+    batch_size = 100
+
+    def get_size(self):
+        return getattr(settings, 'NGRAM_LEADERBOARD_SIZE', 100)
+
+    def get_orders(self):
+        return getattr(settings, 'NGRAM_LEADERBOARD_ORDERS', (1, 2, 3))
+
+    def slice_key(self, genre=None, decade=None):
+        """
+        Returns the key of the slice of a genre (or its id) or a decade
+        (or any year in it), or the empty key of the whole corpus.
+        """
+        if genre is not None and decade is not None:
+            raise ValueError("Leaderboards are sliced by genre or by decade, not both.")
+        if genre is not None:
+            return "genre:%i" % getattr(genre, 'pk', genre)
+        if decade is not None:
+            return "decade:%i" % (int(decade) // 10 * 10)
+        return ""
+
+    def decade_years(self, decade):
+        """
+        Returns the years of a decade as they are stored on movies, which
+        keep their year as a string that may not be a number ("199?").
+        """
+        start = int(decade) // 10 * 10
+        return [str(year) for year in xrange(start, start + 10)]
+
+    def movie_slices(self, movie):
+        """
+        Returns the keys of the slices that a movie belongs to.
+        """
+        slices = [self.slice_key()]
+        slices.extend(self.slice_key(genre=genre) for genre in movie.genres.values_list('pk', flat=True))
+        if movie.year and movie.year.isdigit():
+            slices.append(self.slice_key(decade=movie.year))
+        return slices
+
+    def mark_stale(self, slices):
+        return self.filter(slice__in=slices, stale=False).update(stale=True)
+
+    def is_live(self, order, slice=""):
+        from ngram.models import HashedNGram, get_model_for_order
+        return not slice and get_model_for_order(order) is not HashedNGram
+
+    def top(self, order, k=None, genre=None, decade=None):
+        """
+        Returns the k (by default, all the stored) most frequent N-Grams
+        of an order as rankings with the N-Gram, its frequency and
+        document count, hydrated in bulk. Stored boards are read as they
+        were last built by the leaderboards command, and are empty until
+        then.
+        """
+        from ngram.models import NGramRanking, NGramCorpusFrequency, get_model_for_order
+
+        k     = min(k or self.get_size(), self.get_size())
+        slice = self.slice_key(genre, decade)
+
+        if self.is_live(order, slice):
+            ngram_type = ContentType.objects.get_for_model(get_model_for_order(order))
+            rows = NGramCorpusFrequency.objects.filter(ngram_type=ngram_type).order_by('-frequency', 'ngram_id')[:k]
+            rankings = [
+                NGramRanking(rank=rank, ngram_type=ngram_type, ngram_id=row.ngram_id, frequency=row.frequency, documents=row.documents)
+                for rank, row in enumerate(rows, 1)
+            ]
+        else:
+            rankings = list(NGramRanking.objects.filter(leaderboard__order=order, leaderboard__slice=slice).order_by('rank')[:k])
+
+        return hydrate_ngrams(rankings)
+
+    def build(self, order, slice=""):
+        """
+        Recomputes and stores the board of an order and slice.
+        """
+        from ngram.models import NGramRanking
+
+        ngram_type, counts = self.count(order, slice)
+        board, _ = self.get_or_create(order=order, slice=slice)
+        board.rankings.all().delete()
+        NGramRanking.objects.bulk_create([
+            NGramRanking(leaderboard=board, rank=rank, ngram_type=ngram_type, ngram_id=ngram_id, frequency=frequency, documents=documents)
+            for rank, (ngram_id, frequency, documents) in enumerate(counts, 1)
+        ], batch_size=NGramManager.batch_size)
+
+        board.stale = False
+        board.built = timezone.now()
+        board.save()
+        return board
+
+    def rebuild(self, stale=True):
+        """
+        Rebuilds the stored boards (only the stale ones if stale is true),
+        creating the boards of every order, genre and decade that do not
+        exist yet. Returns the number of boards built.
+        """
+        from movies.models import Movie
+        from ngram.models import NGramPlotAnalysis
+
+        analyzed = Movie.objects.filter(pk__in=NGramPlotAnalysis.objects.values('movie'))
+        slices   = set([self.slice_key()])
+        slices.update(self.slice_key(genre=genre) for genre in analyzed.values_list('genres', flat=True).distinct() if genre)
+        slices.update(self.slice_key(decade=year) for year in analyzed.values_list('year', flat=True).distinct() if year and year.isdigit())
+
+        existing = dict(((board.order, board.slice), board.stale) for board in self.all())
+        built = 0
+        for order in self.get_orders():
+            for slice in sorted(slices):
+                if self.is_live(order, slice):
+                    continue
+                if not stale or existing.get((order, slice), True):
+                    self.build(order, slice)
+                    built += 1
+        return built
+
+    def count(self, order, slice=""):
+        """
+        Returns the content type of the N-Grams of an order and the list
+        of their k highest (id, frequency, documents) in a slice.
+        """
+        from movies.models import Movie
+        from ngram.models import NGramModel, NGramPlotAnalysis, NGramCorpusFrequency, HashedNGram, get_model_for_order
+
+        model      = get_model_for_order(order)
+        ngram_type = ContentType.objects.get_for_model(model)
+        size       = self.get_size()
+        hashed     = HashedNGram.objects.filter(order=order).values('pk')
+
+        if not slice:
+            rows = NGramCorpusFrequency.objects.filter(ngram_type=ngram_type)
+            if model is HashedNGram:
+                rows = rows.filter(ngram_id__in=hashed)
+            rows = rows.order_by('-frequency', 'ngram_id').values_list('ngram_id', 'frequency', 'documents')
+            return ngram_type, list(rows[:size])
+
+        kind, value = slice.split(":")
+        if kind == "genre":
+            movies = Movie.objects.filter(genres=int(value))
+        else:
+            movies = Movie.objects.filter(year__in=self.decade_years(value))
+
+        analyses = NGramPlotAnalysis.objects.filter(movie__in=movies)
+        packed   = analyses.filter(packed_unigrams__isnull=False)
+
+        rows = NGramModel.objects.filter(analysis__in=analyses.filter(packed_unigrams__isnull=True), ngram_type=ngram_type)
+        if model is HashedNGram:
+            rows = rows.filter(ngram_id__in=hashed)
+        rows = rows.values('ngram_id').annotate(total=Sum('frequency'), docs=Count('id')).order_by('-total', 'ngram_id')
+
+        if not packed.exists():
+            return ngram_type, [(row['ngram_id'], row['total'], row['docs']) for row in rows[:size]]
+
+        # Packed histograms can only be merged in with the full counts
+        frequency, documents = {}, {}
+        for row in rows.iterator():
+            frequency[row['ngram_id']] = row['total']
+            documents[row['ngram_id']] = row['docs']
+        for batch in batched_queryset(packed, self.batch_size):
+            for analysis in batch:
+                for ngram_id, count in analysis.histogram(model).iteritems():
+                    frequency[ngram_id] = frequency.get(ngram_id, 0) + count
+                    documents[ngram_id] = documents.get(ngram_id, 0) + 1
+
+        if model is HashedNGram:
+            ids = set()
+            for chunk in chunked(frequency, NGramManager.batch_size):
+                ids.update(HashedNGram.objects.filter(pk__in=chunk, order=order).values_list('pk', flat=True))
+            frequency = dict((ngram_id, count) for ngram_id, count in frequency.iteritems() if ngram_id in ids)
+
+        top = sorted(frequency.iteritems(), key=lambda item: (-item[1], item[0]))[:size]
+        return ngram_type, [(ngram_id, count, documents[ngram_id]) for ngram_id, count in top]
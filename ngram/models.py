@@ -1,11 +1,20 @@
+from ngram import encoding
 from django.db import models
-from ngram.managers import NGramManager
+from ngram.cache import ngram_cache
+from movieplot.core.counting import Histogram
+from django.db.models import F
+from django.conf import settings
+from collections import defaultdict
+from movieplot.core.utils import chunked
+from ngram.managers import NGRAM_KEYS, NGramManager, HashedNGramManager, NGramModelManager, CorpusFrequencyManager, LeaderboardManager, hydrate_ngrams
+from django.db.models.signals import pre_delete, post_save, post_delete, m2m_changed
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 
 UNIGRAM = 'Unigram'
 BIGRAM  = 'Bigram'
 TRIGRAM = 'Trigram'
+HASHED  = 'HashedNGram'
 
 class NGram(models.Model):
 
@@ -13,10 +22,19 @@ class NGram(models.Model):
     ngram_models = generic.GenericRelation( 'NGramModel', content_type_field='ngram_type', object_id_field='ngram_id' )
 
     def get_corpus_frequency(self):
-        count = 0
-        for frequency in self.ngram_models.values('frequency'):
-            count += frequency['frequency']
-        return count
+        return self.corpus_frequency('frequency')
+
+    def get_document_frequency(self):
+        return self.corpus_frequency('documents')
+
+    def corpus_frequency(self, field='frequency'):
+        """
+        Reads a field of the N-Gram's row in the corpus frequency table,
+        which is 0 for N-Grams that are not in any analysis.
+        """
+        ngram_type = ContentType.objects.get_for_model(self)
+        values = NGramCorpusFrequency.objects.filter(ngram_type=ngram_type, ngram_id=self.pk).values_list(field, flat=True)
+        return values[0] if values else 0
 
     class Meta:
         abstract = True
@@ -89,12 +107,127 @@ class Trigram(NGram):
         unique_together = ('alpha', 'beta', 'gamma')
         ordering = ('alpha', 'beta', 'gamma')
 
+class HashedNGram(NGram):
+    """
+    An N-Gram of any order in a single table, keyed by a fixed width hash
+    of the ids of its Unigrams so that a lookup is one index probe
+    whatever the order. The ids are kept to tell colliding N-Grams apart.
+
+    Unlike the Bigram and Trigram tables there is no foreign key to the
+    Unigrams, so deleting a Unigram does not cascade to these rows.
+    """
+
+    order    = models.PositiveSmallIntegerField()
+    key      = models.BigIntegerField()
+    unigrams = models.CharField( max_length=255 )
+
+    objects  = HashedNGramManager()
+
+    @property
+    def ids(self):
+        return tuple(int(ident) for ident in self.unigrams.split(","))
+
+    @property
+    def components(self):
+        if not hasattr(self, '_components_cache'):
+            HashedNGram.objects.attach_components([self])
+        return self._components_cache
+
+    def natural_key(self):
+        return self.components
+
+    def __getitem__(self, idx):
+        try:
+            return self.components[idx]
+        except IndexError:
+            raise IndexError("%i-grams do not have an index '%s'" % (self.order, str(idx)))
+
+    def __repr__(self):
+        return "<HashedNGram %s>" % unicode(self)
+
+    def __unicode__(self):
+        return "(%s)" % ", ".join(unicode(unigram) for unigram in self.components)
+
+    class Meta:
+        unique_together = ('key', 'unigrams')
+        ordering = ('order', 'key')
+
 NGRAM_TYPE_MAP = {
     UNIGRAM: Unigram,
     BIGRAM: Bigram,
     TRIGRAM: Trigram,
+    HASHED: HashedNGram,
+}
+
+NGRAM_ORDER_MAP = {
+    1: Unigram,
+    2: Bigram,
+    3: Trigram,
 }
 
+# Every model that N-Gram analyses refer to
+NGRAM_MODELS = (Unigram, Bigram, Trigram, HashedNGram)
+
+def get_model_for_order(order):
+    """
+    Returns the model storing N-Grams of an order: orders from the
+    NGRAM_HASH_ORDER setting up (and those without a table of their own)
+    are stored as HashedNGrams.
+    """
+    if order < 1:
+        raise ValueError("N-Grams have an order of at least 1, not %i." % order)
+    if order == 1:
+        return Unigram
+    if order >= getattr(settings, 'NGRAM_HASH_ORDER', 4) or order not in NGRAM_ORDER_MAP:
+        return HashedNGram
+    return NGRAM_ORDER_MAP[order]
+
+def resolve_tokens(needed, size=500):
+    """
+    Returns a dictionary of (model, id) to the tuple of tokens of each
+    N-Gram in a dictionary of models to sets of ids, looking up size ids
+    per query.
+    """
+    components = {}
+    for model, ids in needed.iteritems():
+        if model is Unigram:
+            components.update(((model, pk), (pk,)) for pk in ids)
+        elif model is HashedNGram:
+            for chunk in chunked(ids, size):
+                for pk, unigrams in model.objects.filter(pk__in=chunk).values_list('pk', 'unigrams'):
+                    components[(model, pk)] = tuple(int(ident) for ident in unigrams.split(","))
+        else:
+            order  = dict((value, key) for key, value in NGRAM_ORDER_MAP.items())[model]
+            fields = tuple('%s_id' % key for key in NGRAM_KEYS[:order])
+            for chunk in chunked(ids, size):
+                for row in model.objects.filter(pk__in=chunk).values_list('pk', *fields):
+                    components[(model, row[0])] = row[1:]
+
+    unigrams = set(ident for key in components.itervalues() for ident in key)
+    tokens = {}
+    for chunk in chunked(unigrams, size):
+        tokens.update(Unigram.objects.filter(pk__in=chunk).values_list('pk', 'token'))
+
+    return dict((ngram, tuple(tokens[ident] for ident in key)) for ngram, key in components.iteritems()
+                if all(ident in tokens for ident in key))
+
+def uncache_ngram(sender, instance, **kwargs):
+    """
+    Removes deleted N-Grams (including cascades) from the id cache.
+    """
+    ngram_cache.discard(sender, sender.objects.get_key(instance))
+
+def discard_corpus_frequency(sender, instance, **kwargs):
+    """
+    Removes the corpus frequency of deleted N-Grams.
+    """
+    ngram_type = ContentType.objects.get_for_model(sender)
+    NGramCorpusFrequency.objects.filter(ngram_type=ngram_type, ngram_id=instance.pk).delete()
+
+for ngram_model in NGRAM_MODELS:
+    post_delete.connect(uncache_ngram, sender=ngram_model, dispatch_uid="uncache_%s" % ngram_model.__name__)
+    post_delete.connect(discard_corpus_frequency, sender=ngram_model, dispatch_uid="corpus_%s" % ngram_model.__name__)
+
 class NGramModel(models.Model):
     """
     Utilizes the contenttypes contrib to generically hold a frequency for
@@ -113,36 +246,78 @@ class NGramModel(models.Model):
     ngram      = generic.GenericForeignKey('ngram_type', 'ngram_id')
     analysis   = models.ForeignKey( 'NGramPlotAnalysis', related_name='ngram_model' )
 
+    objects    = NGramModelManager()
+
     def increment(self):
         self.frequency += 1
         self.save()
+        self.adjust_totals(1)
 
     def decrement(self):
         if self.frequency > 0:
             self.frequency -= 1
+            self.adjust_totals(-1)
         else:
             self.frequency = 0
         self.save()
 
+    def adjust_totals(self, delta):
+        """
+        Carries a change to the frequency over to the corpus frequency
+        table and the summary of the analysis, and marks the stored
+        leaderboards of the movie stale.
+        """
+        self.corpus_rows.update(frequency=F('frequency') + delta)
+
+        model = self.ngram_type.model_class()
+        if model in NGRAM_ORDER_MAP.values():
+            # Summaries that were never computed are left to summarize()
+            total = NGramPlotAnalysis.summary_fields(model)[1]
+            NGramPlotAnalysis.objects.filter(pk=self.analysis_id, **{total + '__isnull': False}).update(**{total: F(total) + delta})
+
+        analysis = self.analysis
+        NGramLeaderboard.objects.mark_stale(NGramLeaderboard.objects.movie_slices(analysis.movie))
+        uncache_analysis(NGramPlotAnalysis, analysis)
+
+    @property
+    def corpus_rows(self):
+        return NGramCorpusFrequency.objects.filter(ngram_type=self.ngram_type_id, ngram_id=self.ngram_id)
+
     def __unicode__(self):
         return "%s: %i" % (self.ngram, self.frequency)
 
     class Meta:
         verbose_name = "N-Gram Model"
         verbose_name_plural = "N-Gram Models"
-        unique_together = ("ngram_id", "analysis")
+        unique_together = ("ngram_type", "ngram_id", "analysis")
 
 class NGramPlotAnalysis(models.Model):
     """
     An N-Gram model of a particular plot in the Movies database.
     """
 
-    movie      = models.OneToOneField( 'movies.Movie', related_name="ngram_analysis", null=False )
+    movie       = models.OneToOneField( 'movies.Movie', related_name="ngram_analysis", null=False )
+    fingerprint = models.CharField( max_length=40, null=True, blank=True, db_index=True )
+    analyzed    = models.DateTimeField( auto_now=True, null=True )
+
+    # Summary statistics per order, stored when the analysis is written
+    distinct_unigrams = models.PositiveIntegerField( null=True, blank=True )
+    total_unigrams    = models.PositiveIntegerField( null=True, blank=True )
+    distinct_bigrams  = models.PositiveIntegerField( null=True, blank=True )
+    total_bigrams     = models.PositiveIntegerField( null=True, blank=True )
+    distinct_trigrams = models.PositiveIntegerField( null=True, blank=True )
+    total_trigrams    = models.PositiveIntegerField( null=True, blank=True )
+
+    # Packed (N-Gram id, frequency) histograms, stored in place of rows
+    packed_unigrams = models.TextField( null=True, blank=True, editable=False )
+    packed_bigrams  = models.TextField( null=True, blank=True, editable=False )
+    packed_trigrams = models.TextField( null=True, blank=True, editable=False )
+    packed_hashedngrams = models.TextField( null=True, blank=True, editable=False )
 
     @property
     def unigrams(self):
         unigram_type = NGRAM_TYPE_MAP[UNIGRAM]
-        return self.filter_by_type(unigram_type).order_by('frequency')
+        return self.models_of_type(unigram_type)
 
     @property
     def unigram_count(self):
@@ -155,7 +330,7 @@ class NGramPlotAnalysis(models.Model):
     @property
     def bigrams(self):
         bigram_type = NGRAM_TYPE_MAP[BIGRAM]
-        return self.filter_by_type(bigram_type).order_by('frequency')
+        return self.models_of_type(bigram_type)
 
     @property
     def bigram_count(self):
@@ -168,7 +343,7 @@ class NGramPlotAnalysis(models.Model):
     @property
     def trigrams(self):
         trigram_type = NGRAM_TYPE_MAP[TRIGRAM]
-        return self.filter_by_type(trigram_type).order_by('frequency')
+        return self.models_of_type(trigram_type)
 
     @property
     def trigram_count(self):
@@ -178,7 +353,146 @@ class NGramPlotAnalysis(models.Model):
     def trigram_total(self):
         return self.total(TRIGRAM)
 
-    def get_ngram_type(self, ngram_type):
+    @staticmethod
+    def summary_fields(ngram_type):
+        """
+        Returns the names of the distinct and total fields of an N-Gram
+        model class.
+        """
+        name = ngram_type.__name__.lower()
+        return ('distinct_%ss' % name, 'total_%ss' % name)
+
+    @classmethod
+    def summarize_histogram(cls, histogram):
+        """
+        Returns the summary field values for a histogram of N-Grams.
+        """
+        summary = {}
+        for ngram_type in NGRAM_ORDER_MAP.values():
+            summary.update(dict.fromkeys(cls.summary_fields(ngram_type), 0))
+        for ngram, frequency in histogram.iteritems():
+            distinct, total = cls.summary_fields(type(ngram))
+            if distinct not in summary: continue
+            summary[distinct] += 1
+            summary[total]    += frequency
+        return summary
+
+    @staticmethod
+    def packed_field(ngram_type):
+        return 'packed_%ss' % ngram_type.__name__.lower()
+
+    @property
+    def is_packed(self):
+        return any(getattr(self, self.packed_field(model)) is not None for model in NGRAM_MODELS)
+
+    def histogram(self, ngram_type=UNIGRAM):
+        """
+        Returns a Histogram of the frequencies of the N-Grams of a type
+        keyed by N-Gram id, from the packed storage if the analysis has
+        it (decoded once, on first use) or from the N-Gram models.
+        """
+        model = self.get_ngram_model(ngram_type)
+        if not hasattr(self, '_histograms'):
+            self._histograms = {}
+
+        if model not in self._histograms:
+            if self.is_packed:
+                packed = getattr(self, self.packed_field(model))
+                counts = dict(encoding.unpack_histogram(packed)) if packed else {}
+            else:
+                counts = dict(self.filter_by_type(model).values_list('ngram_id', 'frequency'))
+            self._histograms[model] = Histogram(counts)
+        return self._histograms[model]
+
+    def token_histogram(self):
+        """
+        Returns the frequencies of every N-Gram of the analysis keyed by
+        its tuple of tokens, as the analyzers count them.
+        """
+        counts = dict(((model, ngram_id), count) for model in NGRAM_MODELS
+                      for ngram_id, count in self.histogram(model).iteritems())
+        needed = defaultdict(set)
+        for model, ngram_id in counts:
+            needed[model].add(ngram_id)
+        tokens = resolve_tokens(needed)
+        return Histogram((tokens[key], count) for key, count in counts.iteritems() if key in tokens)
+
+    def models_of_type(self, ngram_type):
+        """
+        The N-Gram models of a type ordered by frequency, then id, with
+        their N-Grams fetched in bulk: a hydrated queryset with row
+        storage, or unsaved models built from the packed histogram.
+        """
+        if not self.is_packed:
+            return self.filter_by_type(ngram_type).order_by('frequency', 'ngram_id').hydrated()
+
+        model     = self.get_ngram_model(ngram_type)
+        histogram = self.histogram(model)
+
+        rows, content_type = [], self.get_ngram_type(model)
+        for ngram_id, frequency in sorted(histogram.iteritems(), key=lambda item: (item[1], item[0])):
+            rows.append(NGramModel(frequency=frequency, ngram_type=content_type, ngram_id=ngram_id, analysis=self))
+        return hydrate_ngrams(rows)
+
+    def pack(self):
+        """
+        Moves the N-Gram models of the analysis into packed storage.
+        """
+        if self.is_packed: return False
+
+        packed = dict((self.packed_field(model), encoding.pack_histogram(self.histogram(model)))
+                      for model in NGRAM_MODELS)
+        NGramPlotAnalysis.objects.filter(pk=self.pk).update(**packed)
+        self.ngram_model.all().delete()
+        for field, value in packed.items():
+            setattr(self, field, value)
+        return True
+
+    def unpack(self):
+        """
+        Moves packed storage back into N-Gram model rows.
+        """
+        if not self.is_packed: return False
+
+        rows = []
+        for model in NGRAM_MODELS:
+            ngram_type = self.get_ngram_type(model).pk
+            for ngram_id, frequency in self.histogram(model).iteritems():
+                rows.append(NGramModel(analysis=self, ngram_type_id=ngram_type, ngram_id=ngram_id, frequency=frequency))
+        NGramModel.objects.bulk_create(rows, batch_size=NGramManager.batch_size)
+
+        packed = dict.fromkeys((self.packed_field(model) for model in NGRAM_MODELS), None)
+        NGramPlotAnalysis.objects.filter(pk=self.pk).update(**packed)
+        for field, value in packed.items():
+            setattr(self, field, value)
+        return True
+
+    def summarize(self, save=False):
+        """
+        Computes the summary fields from the N-Gram models with a single
+        aggregate query, for analyses written before they were stored.
+        """
+        summary = {}
+        for ngram_type in NGRAM_ORDER_MAP.values():
+            summary.update(dict.fromkeys(self.summary_fields(ngram_type), 0))
+            if self.is_packed:
+                histogram = self.histogram(ngram_type)
+                summary.update(zip(self.summary_fields(ngram_type), (histogram.distinct, histogram.total)))
+
+        rows = self.ngram_model.values('ngram_type').annotate(distinct=models.Count('id'), total=models.Sum('frequency'))
+        for row in ([] if self.is_packed else rows.order_by()):
+            model = ContentType.objects.get_for_id(row['ngram_type']).model_class()
+            if model in NGRAM_ORDER_MAP.values():
+                summary.update(zip(self.summary_fields(model), (row['distinct'], row['total'])))
+
+        for field, value in summary.items():
+            setattr(self, field, value)
+        if save and self.pk:
+            # Update rather than save so the analyzed timestamp is kept
+            NGramPlotAnalysis.objects.filter(pk=self.pk).update(**summary)
+        return summary
+
+    def get_ngram_model(self, ngram_type):
 
         if isinstance(ngram_type, basestring):
             if ngram_type not in NGRAM_TYPE_MAP:
@@ -188,20 +502,32 @@ class NGramPlotAnalysis(models.Model):
         if NGram not in ngram_type.__bases__:
             raise TypeError('NGram types must subclass Ngram, "%s" does not.' % repr(ngram_type))
 
-        return ContentType.objects.get_for_model(ngram_type)
+        return ngram_type
+
+    def get_ngram_type(self, ngram_type):
+        return ContentType.objects.get_for_model(self.get_ngram_model(ngram_type))
 
     def filter_by_type(self, ngram_type):
         ngram_type = self.get_ngram_type(ngram_type)
         return self.ngram_model.filter(ngram_type=ngram_type)
 
+    def get_summary(self, ngram_type, index):
+        model = self.get_ngram_model(ngram_type)
+        if model not in NGRAM_ORDER_MAP.values():
+            # N-Grams of the hashed table are summarized on demand
+            histogram = self.histogram(model)
+            return (histogram.distinct, histogram.total)[index]
+
+        field = self.summary_fields(model)[index]
+        if getattr(self, field) is None:
+            self.summarize()
+        return getattr(self, field)
+
     def count(self, ngram_type=UNIGRAM):
-        return self.filter_by_type(ngram_type).count()
+        return self.get_summary(ngram_type, 0)
 
     def total(self, ngram_type=UNIGRAM):
-        count = 0
-        for row in self.filter_by_type(ngram_type).values('frequency'):
-            count += row['frequency']
-        return count
+        return self.get_summary(ngram_type, 1)
 
     def average(self, ngram_type=UNIGRAM):
         return float(self.total(ngram_type)) / float(self.count(ngram_type))
@@ -212,4 +538,143 @@ class NGramPlotAnalysis(models.Model):
     class Meta:
         db_table = "plot_ngram_model"
         verbose_name = "Plot Analysis"
-        verbose_name_plural = "Plot Analyses"
\ No newline at end of file
+        verbose_name_plural = "Plot Analyses"
+
+def remove_corpus_frequency(sender, instance, **kwargs):
+    """
+    Subtracts the N-Gram models of deleted analyses (including cascades
+    from movies) from the corpus frequency table, and marks the stored
+    leaderboards of the movie stale.
+    """
+    NGramCorpusFrequency.objects.remove_analysis(instance)
+    NGramLeaderboard.objects.mark_stale(NGramLeaderboard.objects.movie_slices(instance.movie))
+
+pre_delete.connect(remove_corpus_frequency, sender=NGramPlotAnalysis, dispatch_uid="corpus_analysis")
+
+def uncache_analysis(sender, instance, **kwargs):
+    from movies.fragments import fragment_cache
+    fragment_cache.invalidate(instance.movie_id, 'analysis')
+
+post_save.connect(uncache_analysis, sender=NGramPlotAnalysis, dispatch_uid="uncache_analysis")
+post_delete.connect(uncache_analysis, sender=NGramPlotAnalysis, dispatch_uid="uncache_analysis")
+
+class NGramCorpusFrequency(models.Model):
+    """
+    The frequency of an N-Gram across the analyses of every plot, and the
+    number of analyses it appears in, kept up to date as analyses are
+    written and deleted; rebuild it with the `corpus` command.
+    """
+
+    ngram_type = models.ForeignKey(ContentType)
+    ngram_id   = models.PositiveIntegerField()
+    ngram      = generic.GenericForeignKey('ngram_type', 'ngram_id')
+    frequency  = models.PositiveIntegerField( default=0, db_index=True )
+    documents  = models.PositiveIntegerField( default=0, db_index=True )
+
+    objects    = CorpusFrequencyManager()
+
+    def __unicode__(self):
+        return "%s: %i in %i documents" % (self.ngram, self.frequency, self.documents)
+
+    class Meta:
+        db_table = "ngram_corpus_frequency"
+        verbose_name = "Corpus Frequency"
+        verbose_name_plural = "Corpus Frequencies"
+        unique_together = ("ngram_type", "ngram_id")
+
+class NGramLeaderboard(models.Model):
+    """
+    A stored top-k leaderboard of the N-Grams of an order within a slice
+    of the movies ("genre:<id>", "decade:<year>", or "" for all of them).
+    Query leaderboards with NGramLeaderboard.objects.top().
+    """
+
+    order  = models.PositiveSmallIntegerField()
+    slice  = models.CharField( max_length=64, blank=True, default="" )
+    stale  = models.BooleanField( default=True, db_index=True )
+    built  = models.DateTimeField( null=True, blank=True )
+
+    objects = LeaderboardManager()
+
+    def __unicode__(self):
+        return "Top %i-grams of %s" % (self.order, self.slice or "all movies")
+
+    class Meta:
+        verbose_name = "Leaderboard"
+        verbose_name_plural = "Leaderboards"
+        unique_together = ("order", "slice")
+
+class NGramRanking(models.Model):
+    """
+    The N-Gram at a rank of a leaderboard, with its frequency and the
+    number of analyses it appears in within the slice.
+    """
+
+    leaderboard = models.ForeignKey( NGramLeaderboard, related_name="rankings" )
+    rank        = models.PositiveSmallIntegerField()
+    ngram_type  = models.ForeignKey(ContentType)
+    ngram_id    = models.PositiveIntegerField()
+    ngram       = generic.GenericForeignKey('ngram_type', 'ngram_id')
+    frequency   = models.PositiveIntegerField( default=0 )
+    documents   = models.PositiveIntegerField( default=0 )
+
+    def __unicode__(self):
+        return "%i. %s: %i" % (self.rank, self.ngram, self.frequency)
+
+    class Meta:
+        ordering = ("rank",)
+        unique_together = ("leaderboard", "rank")
+
+class SimilarMovie(models.Model):
+    """
+    One of the nearest neighbours of a movie by the cosine similarity of
+    the TF-IDF vectors of their plot N-Grams, computed by the similar
+    command (see ngram.similarity).
+    """
+
+    movie    = models.ForeignKey( 'movies.Movie', related_name="similar_movies" )
+    similar  = models.ForeignKey( 'movies.Movie', related_name="+" )
+    rank     = models.PositiveSmallIntegerField()
+    score    = models.FloatField()
+    computed = models.DateTimeField( db_index=True )
+
+    def __unicode__(self):
+        return "%i. %s (%0.3f)" % (self.rank, self.similar, self.score)
+
+    class Meta:
+        verbose_name = "Similar Movie"
+        verbose_name_plural = "Similar Movies"
+        unique_together = ("movie", "rank")
+        ordering = ("movie", "rank")
+
+def stale_genre_leaderboards(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Marks the leaderboards of the genres added to or removed from
+    analyzed movies stale. Connected to every relation, since the movies
+    app may not be loaded yet.
+    """
+    if sender is not models.get_model('movies', 'Movie').genres.through:
+        return
+    if action not in ("post_add", "post_remove", "pre_clear") or reverse:
+        return
+    if not NGramPlotAnalysis.objects.filter(movie=instance).exists():
+        return
+
+    genres = pk_set if action != "pre_clear" else instance.genres.values_list('pk', flat=True)
+    NGramLeaderboard.objects.mark_stale([NGramLeaderboard.objects.slice_key(genre=genre) for genre in genres])
+
+m2m_changed.connect(stale_genre_leaderboards, dispatch_uid="stale_genre_leaderboards")
+
+def uncache_similar_movies(sender, instance, **kwargs):
+    """
+    Invalidates the movies that list a changed or deleted movie among
+    their similar movies.
+    """
+    if sender is not models.get_model('movies', 'Movie'):
+        return
+
+    from movies.fragments import fragment_cache
+    fragment_cache.invalidate_many(SimilarMovie.objects.filter(similar=instance).values_list('movie_id', flat=True), 'detail')
+
+post_save.connect(uncache_similar_movies, dispatch_uid="uncache_similar_movies")
+pre_delete.connect(uncache_similar_movies, dispatch_uid="uncache_similar_movies")
@@ -0,0 +1,309 @@
+"""
+Similar movies by the cosine similarity of the TF-IDF vectors of the
+N-Grams in their plot analyses.
+
+The analyses are streamed into a sparse movie by N-Gram matrix (kept as
+NumPy arrays in both row and column order) and the similarities of a
+block of movies at a time are computed by walking the postings of their
+N-Grams, so memory is bounded by the matrix plus one block's postings.
+N-Grams found in a single plot only count towards the norm of its vector,
+and those found in more than max_df of the plots are dropped as noise.
+"""
+
+__author__ = 'benjamin'
+
+from movieplot.core.transactions import commit_on_success
+from django.utils import timezone
+from django.db.models import Min, Count
+from ngram.models import NGramModel, NGramPlotAnalysis, SimilarMovie, NGRAM_MODELS
+from django.contrib.contenttypes.models import ContentType
+from movieplot.core.utils import batched_queryset, chunked
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class MatrixEntries(object):
+    """
+    The movie id, feature and count columns of the entries of the matrix
+    as preallocated NumPy arrays, grown by doubling when full.
+    """
+
+    def __init__(self, capacity=0):
+        self.size = 0
+        self.data = np.empty((3, max(capacity, 1024)), dtype=np.int64)
+
+    def extend(self, movies, features, counts):
+        end = self.size + len(movies)
+        if end > self.data.shape[1]:
+            data = np.empty((3, max(end, 2 * self.data.shape[1])), dtype=np.int64)
+            data[:, :self.size] = self.data[:, :self.size]
+            self.data = data
+        self.data[0, self.size:end] = movies
+        self.data[1, self.size:end] = features
+        self.data[2, self.size:end] = counts
+        self.size = end
+
+    def arrays(self):
+        return [self.data[idx, :self.size].copy() for idx in range(3)]
+
+class SimilarityEngine(object):
+    """
+    Builds and stores the k nearest neighbours of every analyzed movie.
+    """
+
+    # Number of neighbours stored per movie
+    k = 10
+
+    # Upper bound on the postings walked at once for a block of movies
+    block_postings = 2000000
+
+    # N-Grams in more than this fraction of the plots are ignored
+    max_df = 0.5
+
+    # Number of analyses or rows read per query
+    batch_size = 1000
+
+    def __init__(self, k=None, block_postings=None, max_df=None):
+        if np is None:
+            raise ImportError("NumPy is required by the similarity engine.")
+        self.loaded = None
+        if k is not None: self.k = k
+        if block_postings is not None: self.block_postings = block_postings
+        if max_df is not None: self.max_df = max_df
+
+    def load(self):
+        """
+        Reads every analysis into the TF-IDF matrix.
+        """
+        self.loaded  = timezone.now()
+        self.entries = self.read()
+        return self.index()
+
+    def refresh(self, movie_ids):
+        """
+        Reads the analyses of the movies again, dropping the movies that
+        are no longer analyzed, and recomputes the weights of the matrix
+        without reading the analyses of the other movies.
+        """
+        loaded  = timezone.now()
+        movies  = np.array(sorted(movie_ids), dtype=np.int64)
+        keep    = ~np.in1d(self.entries[0], movies)
+        entries = [column[keep] for column in self.entries]
+        self.entries = [np.concatenate(columns) for columns in zip(entries, self.read(movies.tolist()))]
+        self.loaded  = loaded
+        return self.index()
+
+    def read(self, movie_ids=None):
+        """
+        Returns the arrays of movie ids, features and counts of the
+        N-Grams in the analyses of the movies (by default, all of them),
+        read a batch at a time into preallocated NumPy arrays.
+        """
+        if movie_ids is None:
+            chunks = [None]
+        else:
+            chunks = list(chunked(movie_ids, self.batch_size))
+        rows   = NGramModel.objects.values('pk', 'analysis__movie', 'ngram_type', 'ngram_id', 'frequency')
+        packed = NGramPlotAnalysis.objects.filter(packed_unigrams__isnull=False)
+
+        entries = MatrixEntries(rows.count() if movie_ids is None else 0)
+        ngram_types = [(model, ContentType.objects.get_for_model(model).pk) for model in NGRAM_MODELS]
+        for chunk in chunks:
+            # Rows of N-Gram models, read in primary key order
+            queryset = rows if chunk is None else rows.filter(analysis__movie__in=chunk)
+            for batch in batched_queryset(queryset, self.batch_size):
+                entries.extend(
+                    [row['analysis__movie'] for row in batch],
+                    [(row['ngram_type'] << 32) | row['ngram_id'] for row in batch],
+                    [row['frequency'] for row in batch],
+                )
+
+            # Packed analyses, decoded a batch at a time
+            queryset = packed if chunk is None else packed.filter(movie__in=chunk)
+            for batch in batched_queryset(queryset, self.batch_size):
+                for analysis in batch:
+                    for model, ngram_type in ngram_types:
+                        histogram = analysis.histogram(model)
+                        entries.extend(
+                            [analysis.movie_id] * len(histogram),
+                            [(ngram_type << 32) | ngram_id for ngram_id in histogram.iterkeys()],
+                            histogram.values(),
+                        )
+        return entries.arrays()
+
+    def index(self):
+        """
+        Weighs the loaded entries and lays them out by movie and by
+        N-Gram.
+        """
+        movies, features, counts = self.entries
+        self.movies, rows = np.unique(movies, return_inverse=True)
+        _, cols = np.unique(features, return_inverse=True)
+        counts  = counts.astype(np.float64)
+        self.size = len(self.movies)
+
+        # Sublinear term frequency, smoothed inverse document frequency
+        df = np.bincount(cols)
+        weights  = (1.0 + np.log(np.maximum(counts, 1))) * np.log((1.0 + self.size) / (1.0 + df[cols]))
+        norms    = np.sqrt(np.bincount(rows, weights ** 2, minlength=self.size))
+        weights /= np.where(norms[rows] > 0, norms[rows], 1.0)
+
+        keep = (df[cols] > 1) & (df[cols] <= max(2, self.max_df * self.size))
+        rows, cols, weights = rows[keep], cols[keep], weights[keep]
+
+        order = np.lexsort((cols, rows))
+        self.row_cols    = cols[order]
+        self.row_weights = weights[order]
+        self.row_ptr     = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=self.size))))
+
+        order = np.argsort(cols, kind='mergesort')
+        self.col_rows    = rows[order]
+        self.col_weights = weights[order]
+        self.col_ptr     = np.concatenate(([0], np.cumsum(np.bincount(cols, minlength=len(df)))))
+        return self
+
+    def index_of(self, movie_ids):
+        """
+        Returns the matrix rows of those of the movies that are loaded.
+        """
+        movie_ids = np.array(sorted(movie_ids), dtype=np.int64)
+        idx = np.searchsorted(self.movies, movie_ids)
+        idx = idx[idx < self.size]
+        return idx[np.in1d(self.movies[idx], movie_ids)]
+
+    def similarities(self, rows=None):
+        """
+        Yields (movie id, other movie ids, scores) for every movie with a
+        row in rows (by default, all of them), with a score for every
+        other movie that shares an N-Gram with it.
+        """
+        rows = np.arange(self.size) if rows is None else np.asarray(rows)
+        lengths = self.col_ptr[self.row_cols + 1] - self.col_ptr[self.row_cols]
+        postings = np.array([lengths[self.row_ptr[row]:self.row_ptr[row + 1]].sum() for row in rows])
+
+        start = 0
+        while start < len(rows):
+            # Grow the block until it walks the budgeted number of postings
+            end = start + max(1, np.searchsorted(np.cumsum(postings[start:]), self.block_postings, side='right'))
+            for result in self._block(rows[start:end]):
+                yield result
+            start = end
+
+    def _block(self, rows):
+        entries = np.concatenate([np.arange(self.row_ptr[row], self.row_ptr[row + 1]) for row in rows])
+        owners  = np.repeat(np.arange(len(rows)), self.row_ptr[rows + 1] - self.row_ptr[rows])
+        if not len(entries):
+            for row in rows:
+                yield self.movies[row], np.array([], dtype=np.int64), np.array([])
+            return
+
+        cols    = self.row_cols[entries]
+        starts  = self.col_ptr[cols]
+        lengths = self.col_ptr[cols + 1] - starts
+
+        # Gather the postings of every entry without a Python level loop
+        offsets  = np.cumsum(lengths) - lengths
+        postings = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        entry    = np.repeat(np.arange(len(entries)), lengths)
+
+        keys    = owners[entry].astype(np.int64) * self.size + self.col_rows[postings]
+        weights = self.row_weights[entries][entry] * self.col_weights[postings]
+        keys, inverse = np.unique(keys, return_inverse=True)
+        scores  = np.bincount(inverse, weights)
+
+        bounds = np.searchsorted(keys // self.size, np.arange(len(rows) + 1))
+        for idx, row in enumerate(rows):
+            others = keys[bounds[idx]:bounds[idx + 1]] % self.size
+            values = scores[bounds[idx]:bounds[idx + 1]]
+            mask   = (others != row) & (values > 0)
+            yield self.movies[row], self.movies[others[mask]], values[mask]
+
+    def top(self, others, scores):
+        """
+        Returns the k best (movie id, score) pairs, best first.
+        """
+        if len(scores) > self.k:
+            best = np.argpartition(-scores, self.k)[:self.k]
+            others, scores = others[best], scores[best]
+        order = np.lexsort((others, -scores))
+        return [(int(others[idx]), float(scores[idx])) for idx in order]
+
+    def build(self):
+        """
+        Recomputes the neighbours of every movie.
+        """
+        started = timezone.now()
+        self.load()
+
+        neighbours = dict((int(movie), self.top(others, scores)) for movie, others, scores in self.similarities())
+        listed     = set(SimilarMovie.objects.values_list('movie_id', flat=True).distinct())
+        with commit_on_success():
+            SimilarMovie.objects.all().delete()
+            self.store(neighbours, started)
+        from movies.fragments import fragment_cache
+        fragment_cache.invalidate_many(listed | set(neighbours), 'detail')
+        return len(neighbours)
+
+    def update(self):
+        """
+        Recomputes the neighbours of the movies analyzed since the last
+        build, and of the movies whose lists they enter or leave. An
+        engine that has already loaded the matrix only reads the analyses
+        of the changed movies again. The lists of the other movies are
+        kept, so drift in the inverse document frequencies is only picked
+        up by build().
+        """
+        last = SimilarMovie.objects.latest('computed').computed if SimilarMovie.objects.exists() else None
+        if last is None:
+            return self.build()
+
+        started  = timezone.now()
+        since    = last if self.loaded is None else min(last, self.loaded)
+        analyzed = set(NGramPlotAnalysis.objects.values_list('movie_id', flat=True))
+        changed  = set(NGramPlotAnalysis.objects.filter(analyzed__gt=since).values_list('movie_id', flat=True))
+        listed   = set(SimilarMovie.objects.values_list('movie_id', flat=True).distinct())
+        removed  = listed - analyzed
+        if not changed and not removed:
+            return 0
+
+        if self.loaded is None:
+            self.load()
+        else:
+            self.refresh(changed | removed | (set(self.movies.tolist()) - analyzed))
+
+        # The stored lists stop at k, so the movies that listed a changed
+        # or removed movie, or that now score a changed movie above their
+        # k-th neighbour, are recomputed from the matrix
+        affected = set()
+        for chunk in chunked(changed | removed, self.batch_size):
+            affected.update(SimilarMovie.objects.filter(similar__in=chunk).values_list('movie_id', flat=True))
+
+        floors = SimilarMovie.objects.values('movie').annotate(floor=Min('score'), listed=Count('id')).order_by()
+        floors = dict((row['movie'], row['floor'] if row['listed'] >= self.k else 0.0) for row in floors)
+
+        neighbours = {}
+        for movie, others, values in self.similarities(self.index_of(changed)):
+            neighbours[int(movie)] = self.top(others, values)
+            for other, score in zip(others.tolist(), values.tolist()):
+                if score > floors.get(other, 0.0):
+                    affected.add(other)
+
+        for movie, others, values in self.similarities(self.index_of(affected - changed - removed)):
+            neighbours[int(movie)] = self.top(others, values)
+
+        with commit_on_success():
+            for chunk in chunked(set(neighbours) | removed, self.batch_size):
+                SimilarMovie.objects.filter(movie__in=chunk).delete()
+            self.store(neighbours, started)
+        from movies.fragments import fragment_cache
+        fragment_cache.invalidate_many(set(neighbours) | removed, 'detail')
+        return len(neighbours)
+
+    def store(self, neighbours, computed):
+        SimilarMovie.objects.bulk_create([
+            SimilarMovie(movie_id=movie, similar_id=similar, rank=rank, score=score, computed=computed)
+            for movie, top in neighbours.iteritems()
+            for rank, (similar, score) in enumerate(top, 1)
+        ], batch_size=self.batch_size)
@@ -5,9 +5,22 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.db import connection
+import os
+import nltk
+
+from django.db import connection, connections, IntegrityError
 from django.test import TestCase
+from django.core.management import call_command, CommandError
 from ngram.models import *
+from ngram.analyze import *
+from ngram import engines
+from ngram import encoding
+from django.utils import unittest
+from ngram.cache import NGramCache, TokenCache, ngram_cache, token_cache
+from movieplot.core.transactions import commit_on_success
+from movies.models import Movie
+from movieplot.core.counting import Histogram
+from movieplot.core.sketch import CountMinSketch, ApproximateHistogram
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -16,6 +29,110 @@ class SimpleTest(TestCase):
         """
         self.assertEqual(1 + 1, 2)
 
+class WhitespaceProcessor(TextProcessor):
+    """
+    Splits on whitespace so that the tests do not depend on NLTK data.
+    """
+
+    def load(self):
+        pass
+
+    def segment(self, text):
+        return [text] if text else []
+
+    def tokenize(self, text):
+        return text.split()
+
+    def postag(self, tokens):
+        return [(token, 'NN') for token in tokens]
+
+    def postag_sents(self, sentences):
+        return map(self.postag, sentences)
+
+def count_queries(func, *args, **kwargs):
+    """
+    Returns the number of queries executed by calling func.
+    """
+    debug = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        start = len(connection.queries)
+        func(*args, **kwargs)
+        return len(connection.queries) - start
+    finally:
+        connection.use_debug_cursor = debug
+
+def as_tokens(ngram):
+    if isinstance(ngram, Unigram):
+        return (ngram.token,)
+    return tuple(unigram.token for unigram in ngram.natural_key())
+
+class NGramTestCase(TestCase):
+
+    text = "the brown bear ate some bad berries and the brown bear got sick"
+
+    def setUp(self):
+        self.processor = NGramAnalyzer.processor
+        NGramAnalyzer.processor = WhitespaceProcessor()
+
+        # Test transactions are rolled back without delete signals
+        ngram_cache.clear()
+        token_cache.clear()
+
+    def tearDown(self):
+        NGramAnalyzer.processor = self.processor
+
+class VocabularyTest(NGramTestCase):
+
+    def test_ngrams_match_windows(self):
+        """
+        Resolved models match the windows of the pure Python analyzers.
+        """
+        for N in (1, 2, 3):
+            expected = list(NGramAnalyzer(self.text, N))
+            if N == 1: expected = [(token,) for token in expected]
+            self.assertEqual([as_tokens(ngram) for ngram in NGramModelAnalyzer(self.text, N).ngrams()], expected)
+
+        expected = [ngram if isinstance(ngram, tuple) else (ngram,) for ngram in MultiNGramAnalyzer(self.text, 3)]
+        self.assertEqual([as_tokens(ngram) for ngram in MultiNGramModelAnalyzer(self.text, 3).ngrams()], expected)
+
+    def test_ngrams_reuse_rows(self):
+        """
+        Resolving the same text twice does not create new rows.
+        """
+        first  = list(MultiNGramModelAnalyzer(self.text, 3).ngrams())
+        counts = [model.objects.count() for model in (Unigram, Bigram, Trigram)]
+        second = list(MultiNGramModelAnalyzer(self.text, 3).ngrams())
+        self.assertEqual([ngram.pk for ngram in first], [ngram.pk for ngram in second])
+        self.assertEqual(counts, [model.objects.count() for model in (Unigram, Bigram, Trigram)])
+
+    def test_query_count_is_constant(self):
+        """
+        The number of queries does not scale with the number of tokens.
+        """
+        self.addCleanup(setattr, ngram_cache, 'size', ngram_cache.size)
+        ngram_cache.size = 0
+        short = count_queries(lambda: list(MultiNGramModelAnalyzer("one two three four", 3).ngrams()))
+        longer = count_queries(lambda: list(MultiNGramModelAnalyzer(self.text * 10, 3).ngrams()))
+        self.assertEqual(short, longer)
+
+    def test_batch_resolution(self):
+        """
+        A shared vocabulary resolves a batch of texts in one pass.
+        """
+        analyzers = [MultiNGramModelAnalyzer(text, 3) for text in (self.text, "some bad bear", "the sick bear")]
+        resolve_vocabulary(analyzers)
+        for analyzer in analyzers:
+            self.assertEqual(count_queries(lambda: list(analyzer.ngrams())), 0)
+
+    def test_iter_does_not_save(self):
+        """
+        Iterating a model analyzer raises instead of creating rows.
+        """
+        with self.assertRaises(Bigram.DoesNotExist):
+            list(iter(NGramModelAnalyzer("never seen before", 2)))
+        self.assertEqual(Unigram.objects.count(), 0)
+
 def create_or_get_test_data():
     sentence = ['The', 'brown', 'bear', 'ate', 'some', 'bad', 'berries', '.']
     ngrams = {
@@ -56,3 +173,1069 @@ def create_or_get_test_data():
             trigram = trigram[1:]
 
     return ngrams
+
+class NGramCacheTest(NGramTestCase):
+
+    def test_lru_eviction(self):
+        cache = NGramCache(size=2)
+        with commit_on_success():
+            cache.set(Unigram, 'the', 1)
+            cache.set(Unigram, 'bear', 2)
+        self.assertEqual(cache.get(Unigram, 'the'), 1)
+        with commit_on_success():
+            cache.set(Unigram, 'ate', 3)
+        self.assertIsNone(cache.get(Unigram, 'bear'))
+        self.assertEqual(cache.get(Unigram, 'the'), 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_shared_after_commit(self):
+        """
+        Ids cached in a transaction are only shared once it commits.
+        """
+        cache = NGramCache(size=10)
+        with commit_on_success():
+            cache.set(Unigram, 'bear', 2)
+            self.assertEqual(cache.get(Unigram, 'bear'), 2)
+            self.assertEqual(len(cache), 0)
+        self.assertEqual(len(cache), 1)
+
+        with self.assertRaises(ValueError):
+            with commit_on_success():
+                cache.set(Unigram, 'cub', 3)
+                raise ValueError("rolled back")
+        self.assertIsNone(cache.get(Unigram, 'cub'))
+        self.assertEqual(cache.get(Unigram, 'bear'), 2)
+
+    def test_rolled_back_analysis(self):
+        """
+        The N-Grams created for an analysis that rolls back are dropped.
+        """
+        from django.core.exceptions import ImproperlyConfigured
+        movie = Movie.objects.create(title="Rollback", year="2013", plot="the zebra ate the grass")
+        with self.settings(NGRAM_STORAGE='bogus'):
+            with self.assertRaises(ImproperlyConfigured):
+                MoviePlotAnalyzer.analyze(movie)
+        self.assertIsNone(ngram_cache.get(Unigram, "zebra"))
+
+        MoviePlotAnalyzer.analyze(movie)
+        self.assertEqual(ngram_cache.get(Unigram, "zebra"), Unigram.objects.get(token="zebra").pk)
+
+    def test_cached_lookups_skip_queries(self):
+        """
+        Resolving a text a second time is served from the id cache.
+        """
+        first = list(MultiNGramModelAnalyzer(self.text, 3).ngrams())
+        self.assertEqual(count_queries(lambda: list(MultiNGramModelAnalyzer(self.text, 3).ngrams())), 0)
+        self.assertEqual(count_queries(Unigram.objects.get_by_natural_key, 'bear'), 0)
+
+        bigram = first[1]
+        cached = Bigram.objects.get_by_natural_key(bigram.alpha, bigram.beta)
+        self.assertEqual(cached.pk, bigram.pk)
+        self.assertEqual(as_tokens(cached), as_tokens(bigram))
+
+    def test_delete_invalidates(self):
+        """
+        Deleting a Unigram removes it and its cascades from the cache.
+        """
+        ngrams = list(MultiNGramModelAnalyzer("the brown bear", 2).ngrams())
+        Unigram.objects.get(token="brown").delete()
+        self.assertIsNone(ngram_cache.get(Unigram, "brown"))
+        self.assertIsNone(ngram_cache.get(Bigram, (ngrams[0].pk, ngrams[2].pk)))
+        with self.assertRaises(Unigram.DoesNotExist):
+            Unigram.objects.get_by_natural_key("brown")
+
+class MoviePlotAnalyzerTest(NGramTestCase):
+
+    def setUp(self):
+        super(MoviePlotAnalyzerTest, self).setUp()
+        self.movie = Movie.objects.create(title="The Bear", year="2013", plot=self.text)
+
+    def test_analysis_rows(self):
+        """
+        The analysis stores one row per distinct N-Gram with its count.
+        """
+        analysis  = MoviePlotAnalyzer.analyze(self.movie)
+        histogram = MoviePlotAnalyzer.get_analyzer(self.movie).frequency
+        self.assertEqual(analysis.ngram_model.count(), len(histogram))
+        self.assertEqual(analysis.unigram_total + analysis.bigram_total + analysis.trigram_total, histogram.total)
+        self.assertEqual(analysis.count(TRIGRAM), len([ngram for ngram in histogram if isinstance(ngram, Trigram)]))
+
+    def test_stored_summary(self):
+        analysis = NGramPlotAnalysis.objects.get(pk=MoviePlotAnalyzer.analyze(self.movie).pk)
+        stored   = [(analysis.count(kind), analysis.total(kind)) for kind in (UNIGRAM, BIGRAM, TRIGRAM)]
+        self.assertEqual(count_queries(lambda: analysis.unigram_count + analysis.trigram_total), 0)
+
+        # Analyses without stored values fall back to one aggregate query
+        NGramPlotAnalysis.objects.filter(pk=analysis.pk).update(total_unigrams=None)
+        analysis = NGramPlotAnalysis.objects.get(pk=analysis.pk)
+        self.assertEqual(count_queries(analysis.total, UNIGRAM), 1)
+        self.assertEqual([(analysis.count(kind), analysis.total(kind)) for kind in (UNIGRAM, BIGRAM, TRIGRAM)], stored)
+
+    def test_hydrated_rows(self):
+        """
+        Listing and rendering the N-Grams of an analysis takes a constant
+        number of queries, whatever the number of rows.
+        """
+        analysis = NGramPlotAnalysis.objects.get(pk=MoviePlotAnalyzer.analyze(self.movie).pk)
+        render   = lambda rows: [unicode(row) for row in rows]
+
+        self.assertEqual(count_queries(render, analysis.trigrams), 2)
+        self.assertEqual(count_queries(render, analysis.ngram_model.all().hydrated()), 4)
+        self.assertEqual(render(analysis.trigrams), render(analysis.filter_by_type(TRIGRAM).order_by('frequency', 'ngram_id')))
+
+    def test_fingerprint_settings(self):
+        """
+        Changing how analyses are stored makes existing ones out of date.
+        """
+        MoviePlotAnalyzer.analyze(self.movie)
+        self.assertTrue(MoviePlotAnalyzer.is_current(self.movie))
+        with self.settings(NGRAM_STORAGE='packed'):
+            self.assertFalse(MoviePlotAnalyzer.is_current(self.movie))
+        with self.settings(NGRAM_HASH_ORDER=3):
+            self.assertFalse(MoviePlotAnalyzer.is_current(self.movie))
+
+    def test_view_force(self):
+        from django.test.client import RequestFactory
+        from ngram.views import MovieAnalyze
+
+        forced = []
+        class Analyzer(MoviePlotAnalyzer):
+            @classmethod
+            def analyze(cls, movie, force=False):
+                forced.append(force)
+        view = MovieAnalyze.as_view(analyzer=Analyzer)
+        for value in ("1", "true", "on", "0", "false", ""):
+            view(RequestFactory().post('/analyze/', {'movieid': self.movie.pk, 'force': value}))
+        self.assertEqual(forced, [True, True, True, False, False, False])
+
+    def test_reanalysis_replaces(self):
+        MoviePlotAnalyzer.analyze(self.movie)
+        analysis = MoviePlotAnalyzer.analyze(self.movie)
+        self.assertEqual(list(NGramPlotAnalysis.objects.values_list('pk', flat=True)), [analysis.pk])
+        self.assertEqual(NGramModel.objects.count(), analysis.ngram_model.count())
+
+    def test_query_count_is_bounded(self):
+        """
+        Writing an analysis costs a bounded number of queries.
+        """
+        self.addCleanup(setattr, ngram_cache, 'size', ngram_cache.size)
+        ngram_cache.size = 0
+
+        # Thousands of tokens, but well under a batch of distinct N-Grams
+        self.movie.plot = " ".join([self.text] * 200)
+        self.assertLessEqual(count_queries(MoviePlotAnalyzer.analyze, self.movie), 20)
+        self.assertLessEqual(count_queries(MoviePlotAnalyzer.analyze, self.movie), 20)
+
+class ChunkCommandTest(NGramTestCase):
+
+    def setUp(self):
+        super(ChunkCommandTest, self).setUp()
+        for idx, plot in enumerate((self.text, "some bad bear", "the sick bear", None)):
+            Movie.objects.create(title="Movie %i" % idx, year="2013", plot=plot)
+
+    def snapshot(self):
+        return sorted(NGramModel.objects.values_list('analysis__movie_id', 'ngram_type_id', 'ngram_id', 'frequency'))
+
+    def test_chunk_is_repeatable(self):
+        call_command('chunk', batch_size=3, verbosity=0)
+        self.assertEqual(NGramPlotAnalysis.objects.count(), 4)
+        first = self.snapshot()
+
+        call_command('chunk', batch_size=2, verbosity=0)
+        self.assertEqual(self.snapshot(), first)
+
+    def test_tag_plots_in_pool(self):
+        from multiprocessing import Pool
+        from ngram.management.commands.chunk import tag_plots, warm_processor, TAG_TIMEOUT
+        jobs = list(Movie.objects.exclude(plot=None).values_list('pk', 'plot'))
+        pool = Pool(2, warm_processor)
+        try:
+            tagged = pool.map_async(tag_plots, [jobs[:2], jobs[2:]]).get(TAG_TIMEOUT)
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(tagged[0] + tagged[1], tag_plots(jobs))
+
+    @unittest.skipUnless(connection.settings_dict['NAME'] in ('', ':memory:') and connection.vendor == 'sqlite',
+                         "The command closes the connection (and the test transaction) before forking workers")
+    def test_chunk_workers(self):
+        call_command('chunk', batch_size=2, verbosity=0)
+        first = self.snapshot()
+        NGramPlotAnalysis.objects.all().delete()
+        call_command('chunk', batch_size=2, workers=2, verbosity=0)
+        self.assertEqual(self.snapshot(), first)
+
+    def test_chunk_skips_unchanged(self):
+        call_command('chunk', verbosity=0)
+        analyzed = dict(NGramPlotAnalysis.objects.values_list('movie_id', 'pk'))
+
+        movie = Movie.objects.get(plot="some bad bear")
+        movie.plot = "some good bear"
+        movie.save()
+
+        call_command('chunk', verbosity=0)
+        current = dict(NGramPlotAnalysis.objects.values_list('movie_id', 'fingerprint'))
+        for other in Movie.objects.all():
+            self.assertEqual(current[other.pk], MoviePlotAnalyzer.fingerprint(other))
+            if other.pk != movie.pk:
+                self.assertEqual(other.ngram_analysis.pk, analyzed[other.pk])
+
+        self.assertTrue(MoviePlotAnalyzer.is_current(movie))
+        self.assertEqual(count_queries(call_command, 'chunk', verbosity=0), 3)
+
+    def test_chunk_cache_report(self):
+        import sys
+        from StringIO import StringIO
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command('chunk', verbosity=2)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn("N-Gram id cache: ", output)
+        self.assertIn("Token cache: ", output)
+
+    def test_chunk_approximate(self):
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "corpus.sketch")
+
+        def assertMatchesAnalyses():
+            sketch = ApproximateHistogram.load(path)
+            self.assertEqual(sketch.total, sum(NGramModel.objects.values_list('frequency', flat=True)))
+            for row in NGramCorpusFrequency.objects.filter(ngram_type=ContentType.objects.get_for_model(Unigram)):
+                self.assertEqual(sketch[(row.ngram.token,)], row.frequency)
+
+        call_command('chunk', approximate=path, verbosity=0)
+        assertMatchesAnalyses()
+        sketch = ApproximateHistogram.load(path)
+
+        # Movies that are not reanalyzed are not counted again
+        call_command('chunk', approximate=path, verbosity=0)
+        self.assertEqual(ApproximateHistogram.load(path).total, sketch.total)
+
+        # Reanalyzed plots replace their counts, even when forced
+        movie = Movie.objects.all()[0]
+        movie.plot = "the bear ate the sick fox"
+        movie.save()
+        call_command('chunk', approximate=path, verbosity=0)
+        assertMatchesAnalyses()
+        call_command('chunk', approximate=path, force=True, verbosity=0)
+        assertMatchesAnalyses()
+
+        # Analyses committed without reaching the sketch (as by a run that
+        # was interrupted) are added on the next run
+        MoviePlotAnalyzer.analyze(Movie.objects.create(title="Fox", year="2013", plot="the fox ate berries"))
+        call_command('chunk', approximate=path, verbosity=0)
+        assertMatchesAnalyses()
+
+class CorpusFrequencyTest(NGramTestCase):
+
+    def setUp(self):
+        super(CorpusFrequencyTest, self).setUp()
+        self.movies = [Movie.objects.create(title="Movie %i" % idx, year="2013", plot=plot)
+                       for idx, plot in enumerate((self.text, "the sick bear", "the bear ate berries"))]
+
+    def snapshot(self):
+        return sorted(NGramCorpusFrequency.objects.values_list('ngram_type_id', 'ngram_id', 'frequency', 'documents'))
+
+    def assertMatchesRebuild(self):
+        maintained = self.snapshot()
+        call_command('corpus', verbosity=0)
+        self.assertEqual(maintained, self.snapshot())
+
+    def expected(self, ngram):
+        rows = NGramModel.objects.filter(ngram_type=ContentType.objects.get_for_model(ngram), ngram_id=ngram.pk)
+        return sum(rows.values_list('frequency', flat=True)), rows.count()
+
+    def test_incremental_matches_rebuild(self):
+        for movie in self.movies:
+            MoviePlotAnalyzer.analyze(movie)
+        self.assertMatchesRebuild()
+
+        the = Unigram.objects.get(token="the")
+        self.assertEqual((the.get_corpus_frequency(), the.get_document_frequency()), self.expected(the))
+        self.assertEqual(the.get_document_frequency(), 3)
+        self.assertEqual(count_queries(the.get_corpus_frequency), 1)
+
+        # Reanalysis replaces rather than adds to the counts
+        self.movies[1].plot = "the bear ate"
+        MoviePlotAnalyzer.analyze(self.movies[1])
+        self.assertEqual((the.get_corpus_frequency(), the.get_document_frequency()), self.expected(the))
+        self.assertEqual(Unigram.objects.get(token="sick").get_corpus_frequency(), 0)
+        self.assertMatchesRebuild()
+
+    def test_delete_subtracts(self):
+        for movie in self.movies:
+            MoviePlotAnalyzer.analyze(movie)
+        self.movies[0].delete()
+        self.assertEqual(Unigram.objects.get(token="the").get_document_frequency(), 2)
+        self.assertEqual(Unigram.objects.get(token="brown").get_document_frequency(), 0)
+        self.assertMatchesRebuild()
+
+    def race(self, savepoints):
+        """
+        Analyzes the second movie with the first attempt at its corpus
+        frequency write failing as if another writer had inserted one of
+        its N-Grams first. Returns the savepoint calls made.
+        """
+        manager = NGramCorpusFrequency.objects
+        apply, calls = manager._apply, []
+
+        def lose(analysis, op):
+            if 'rollback' not in calls:
+                raise IntegrityError("duplicate key value violates unique constraint")
+            return apply(analysis, op)
+
+        # SQLite savepoints commit the test transaction under pysqlite, so
+        # the calls are recorded instead; the lost attempt writes nothing
+        methods = {
+            'savepoint': lambda: calls.append('savepoint') or 'sid',
+            'savepoint_rollback': lambda sid: calls.append('rollback'),
+            'savepoint_commit': lambda sid: calls.append('commit'),
+        }
+        database = connections[manager.db]
+        manager._apply = lose
+        database.features.uses_savepoints = savepoints
+        database.__dict__.update(methods)
+        try:
+            MoviePlotAnalyzer.analyze(self.movies[1])
+        finally:
+            del manager._apply
+            del database.features.uses_savepoints
+            for name in methods:
+                delattr(database, name)
+        return calls
+
+    def test_retries_lost_insert(self):
+        MoviePlotAnalyzer.analyze(self.movies[0])
+        self.assertEqual(self.race(True), ['savepoint', 'rollback', 'savepoint', 'commit'])
+        self.assertEqual(Unigram.objects.get(token="the").get_document_frequency(), 2)
+        self.assertMatchesRebuild()
+
+    def test_lost_insert_without_savepoints(self):
+        self.assertRaises(IntegrityError, self.race, False)
+
+class PackedStorageTest(NGramTestCase):
+
+    def setUp(self):
+        super(PackedStorageTest, self).setUp()
+        self.movies = [Movie.objects.create(title="Movie %i" % idx, year="2013", plot=plot)
+                       for idx, plot in enumerate((self.text, "the sick bear ate"))]
+
+    def contents(self, analysis):
+        analysis = NGramPlotAnalysis.objects.get(pk=analysis.pk)
+        return [[(unicode(row.ngram), row.frequency) for row in getattr(analysis, name)]
+                for name in ('unigrams', 'bigrams', 'trigrams')]
+
+    def test_packed_matches_rows(self):
+        expected = [self.contents(MoviePlotAnalyzer.analyze(movie)) for movie in self.movies]
+        corpus   = sorted(NGramCorpusFrequency.objects.values_list('ngram_type_id', 'ngram_id', 'frequency', 'documents'))
+
+        with self.settings(NGRAM_STORAGE='packed'):
+            analyses = [MoviePlotAnalyzer.analyze(movie) for movie in self.movies]
+        self.assertEqual(NGramModel.objects.count(), 0)
+        self.assertTrue(all(analysis.is_packed for analysis in analyses))
+        self.assertEqual([self.contents(analysis) for analysis in analyses], expected)
+        self.assertEqual(sorted(NGramCorpusFrequency.objects.values_list('ngram_type_id', 'ngram_id', 'frequency', 'documents')), corpus)
+
+        analysis = NGramPlotAnalysis.objects.get(pk=analyses[0].pk)
+        analysis.total_bigrams = None
+        self.assertEqual(count_queries(analysis.total, BIGRAM), 0)
+        self.assertEqual(analysis.histogram(BIGRAM).total, analyses[0].bigram_total)
+
+        call_command('corpus', verbosity=0)
+        self.assertEqual(sorted(NGramCorpusFrequency.objects.values_list('ngram_type_id', 'ngram_id', 'frequency', 'documents')), corpus)
+
+    def test_pack_command(self):
+        analyses = [MoviePlotAnalyzer.analyze(movie) for movie in self.movies]
+        expected = [self.contents(analysis) for analysis in analyses]
+
+        call_command('pack', verbosity=0)
+        self.assertEqual(NGramModel.objects.count(), 0)
+        self.assertEqual([self.contents(analysis) for analysis in analyses], expected)
+
+        call_command('pack', unpack=True, verbosity=0)
+        self.assertFalse(NGramPlotAnalysis.objects.filter(packed_unigrams__isnull=False).exists())
+        self.assertEqual([self.contents(analysis) for analysis in analyses], expected)
+
+    def test_encoding(self):
+        counts = {7: 1, 3: 12, 100000: 2}
+        self.assertEqual(dict(encoding.unpack_histogram(encoding.pack_histogram(counts))), counts)
+        self.assertEqual(encoding.unpack_histogram(encoding.pack_histogram({})), [])
+        with self.assertRaises(encoding.EncodingError):
+            encoding.unpack_histogram(encoding.encode([]))
+
+class HashedNGramTest(NGramTestCase):
+
+    def test_any_order(self):
+        analyzer = ngram_factory(self.text, 5, database=True)
+        ngrams   = list(analyzer.ngrams())
+        self.assertTrue(all(isinstance(ngram, HashedNGram) for ngram in ngrams))
+        self.assertEqual([as_tokens(ngram) for ngram in ngrams], list(NGramAnalyzer(self.text, 5)))
+        self.assertEqual(HashedNGram.objects.count(), len(set(ngrams)))
+
+        # Resolving again is a single probe of the hash index
+        ngram_cache.clear()
+        ids = ngrams[0].ids
+        self.assertEqual(count_queries(HashedNGram.objects.get_by_natural_key, *ids), 1)
+        self.assertEqual(HashedNGram.objects.get_by_natural_key(*ids).pk, ngrams[0].pk)
+
+    def test_collisions(self):
+        self.addCleanup(delattr, HashedNGram.objects, 'hash_key')
+        HashedNGram.objects.hash_key = lambda ids: 42
+
+        found = HashedNGram.objects.resolve([(1, 2, 3, 4), (4, 3, 2, 1), (1, 2)])
+        self.assertEqual(len(set(ngram.pk for ngram in found.values())), 3)
+        ngram_cache.clear()
+        self.assertEqual(HashedNGram.objects.resolve([(4, 3, 2, 1)], save=False)[(4, 3, 2, 1)].pk, found[(4, 3, 2, 1)].pk)
+
+    def test_hashed_analysis(self):
+        movie = Movie.objects.create(title="The Bear", year="2013", plot=self.text)
+        self.addCleanup(setattr, MoviePlotAnalyzer, 'max_n_value', MoviePlotAnalyzer.max_n_value)
+        MoviePlotAnalyzer.max_n_value = 4
+
+        with self.settings(NGRAM_HASH_ORDER=3):
+            analysis = MoviePlotAnalyzer.analyze(movie)
+        self.assertEqual(Trigram.objects.count(), 0)
+        self.assertEqual(analysis.trigram_count, 0)
+        rendered = [unicode(row.ngram) for row in analysis.models_of_type(HASHED)]
+        self.assertEqual(len(rendered), analysis.count(HASHED))
+        self.assertIn(u"(the, brown, bear, ate)", rendered)
+
+        MoviePlotAnalyzer.max_n_value = 3
+        self.assertFalse(MoviePlotAnalyzer.is_current(movie))
+
+class LeaderboardTest(NGramTestCase):
+
+    def setUp(self):
+        super(LeaderboardTest, self).setUp()
+        from movies.models import Genre
+        self.drama  = Genre.objects.create(name="Drama")
+        self.comedy = Genre.objects.create(name="Comedy")
+
+        plots = ((self.text, "1994", self.drama), ("the sick bear ate the bear", "1998", self.comedy),
+                 ("the brown bear ate some berries", "2003", self.drama))
+        self.movies = []
+        for idx, (plot, year, genre) in enumerate(plots):
+            movie = Movie.objects.create(title="Movie %i" % idx, year=year, plot=plot)
+            movie.genres.add(genre)
+            self.movies.append(movie)
+
+    def expected(self, order, movies):
+        counts, documents = Histogram(), Histogram()
+        for movie in movies:
+            histogram = MoviePlotAnalyzer.get_analyzer(movie).frequency
+            for ngram, count in histogram.iteritems():
+                if len(as_tokens(ngram)) == order:
+                    counts.increase(as_tokens(ngram), count)
+                    documents.increment(as_tokens(ngram))
+        return sorted((-count, documents[key], key) for key, count in counts.iteritems())
+
+    def board(self, order, **kwargs):
+        return sorted((-row.frequency, row.documents, as_tokens(row.ngram))
+                      for row in NGramLeaderboard.objects.top(order, **kwargs))
+
+    def test_boards(self):
+        for movie in self.movies:
+            MoviePlotAnalyzer.analyze(movie)
+
+        # Stored boards are built by the command, not on read
+        self.assertEqual(self.board(1, genre=self.drama), [])
+        call_command('leaderboards', verbosity=0)
+
+        self.assertEqual(self.board(2), self.expected(2, self.movies))
+        self.assertEqual(self.board(1, genre=self.drama), self.expected(1, [self.movies[0], self.movies[2]]))
+        self.assertEqual(self.board(3, decade=1990), self.expected(3, self.movies[:2]))
+
+        top = NGramLeaderboard.objects.top(1, k=2)
+        self.assertEqual([row.rank for row in top], [1, 2])
+        self.assertEqual((-top[0].frequency, top[0].documents, as_tokens(top[0].ngram)), self.expected(1, self.movies)[0])
+        self.assertEqual(count_queries(NGramLeaderboard.objects.top, 1, 3, genre=self.drama), 2)
+
+    def test_stale_boards_are_rebuilt(self):
+        MoviePlotAnalyzer.analyze(self.movies[0])
+        MoviePlotAnalyzer.analyze(self.movies[1])
+        call_command('leaderboards', verbosity=0)
+        self.assertFalse(NGramLeaderboard.objects.filter(stale=True).exists())
+        self.assertEqual(NGramLeaderboard.objects.filter(slice="decade:2000").count(), 0)
+
+        # A new analysis only marks the boards of its movie's slices stale
+        MoviePlotAnalyzer.analyze(self.movies[2])
+        stale = set(NGramLeaderboard.objects.filter(stale=True).values_list('slice', flat=True))
+        self.assertEqual(stale, set(["genre:%i" % self.drama.pk]))
+
+        self.movies[1].genres.add(self.drama)
+        call_command('leaderboards', verbosity=0)
+        self.assertEqual(self.board(2, genre=self.drama), self.expected(2, self.movies))
+        self.assertEqual(self.board(1, decade=2003), self.expected(1, self.movies[2:]))
+
+    def test_increment_updates_totals(self):
+        analysis = MoviePlotAnalyzer.analyze(self.movies[0])
+        call_command('leaderboards', verbosity=0)
+        model = analysis.filter_by_type(Unigram).order_by('ngram_id')[0]
+        total = analysis.total_unigrams
+        corpus = model.ngram.get_corpus_frequency()
+
+        model.increment()
+        model.increment()
+        model.decrement()
+        analysis = NGramPlotAnalysis.objects.get(pk=analysis.pk)
+        self.assertEqual(analysis.total_unigrams, total + 1)
+        self.assertEqual(analysis.total_unigrams, analysis.summarize()['total_unigrams'])
+        self.assertEqual(model.ngram.get_corpus_frequency(), corpus + 1)
+        self.assertTrue(NGramLeaderboard.objects.filter(stale=True).exists())
+
+    def test_packed_boards(self):
+        with self.settings(NGRAM_STORAGE='packed'):
+            MoviePlotAnalyzer.analyze(self.movies[0])
+        MoviePlotAnalyzer.analyze(self.movies[2])
+        call_command('leaderboards', verbosity=0)
+        self.assertEqual(self.board(2, genre=self.drama), self.expected(2, [self.movies[0], self.movies[2]]))
+
+    def test_decade_years(self):
+        # Unknown years sort inside the decade as strings but are not in it
+        unknown = Movie.objects.create(title="Movie 3", year="199?", plot="the bear")
+        for movie in self.movies + [unknown]:
+            MoviePlotAnalyzer.analyze(movie)
+        call_command('leaderboards', verbosity=0)
+        self.assertEqual(self.board(1, decade=1990), self.expected(1, self.movies[:2]))
+        self.assertRaises(ValueError, NGramLeaderboard.objects.slice_key, decade="199?")
+
+class SimilarityTest(NGramTestCase):
+
+    plots = (
+        "the brown bear ate some bad berries and the brown bear got sick",
+        "the brown bear ate some good berries and the brown bear got fat",
+        "a sick dog ate some bad meat and the sick dog got sicker",
+        "a small cat drank some milk and the small cat went to sleep",
+        "the small cat ate some bad fish and the small cat got sick",
+    )
+
+    def setUp(self):
+        super(SimilarityTest, self).setUp()
+        self.movies = []
+        for idx, plot in enumerate(self.plots):
+            movie = Movie.objects.create(title="Movie %i" % idx, year="2013", plot=plot)
+            MoviePlotAnalyzer.analyze(movie)
+            self.movies.append(movie)
+
+    def expected(self, k):
+        """
+        Brute force cosine similarities of the TF-IDF vectors.
+        """
+        import math
+        vectors = {}
+        for analysis in NGramPlotAnalysis.objects.all():
+            vectors[analysis.movie_id] = dict(((model, ngram_id), count) for model in NGRAM_MODELS
+                                              for ngram_id, count in analysis.histogram(model).iteritems())
+        df = Histogram().count(feature for vector in vectors.values() for feature in vector)
+        for movie, vector in vectors.items():
+            weights = dict((feature, (1 + math.log(count)) * math.log((1.0 + len(vectors)) / (1 + df[feature])))
+                           for feature, count in vector.items())
+            norm = math.sqrt(sum(weight ** 2 for weight in weights.values()))
+            vectors[movie] = dict((feature, weight / norm) for feature, weight in weights.items())
+
+        neighbours = {}
+        for movie, vector in vectors.items():
+            scores = [(-sum(weight * vectors[other].get(feature, 0) for feature, weight in vector.items()), other)
+                      for other in vectors if other != movie]
+            neighbours[movie] = [(other, round(-score, 6)) for score, other in sorted(scores) if score < 0][:k]
+        return neighbours
+
+    def stored(self):
+        neighbours = {}
+        for row in SimilarMovie.objects.all():
+            neighbours.setdefault(row.movie_id, []).append((row.similar_id, round(row.score, 6)))
+        return neighbours
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_matches_brute_force(self):
+        from ngram.similarity import SimilarityEngine
+        SimilarityEngine(k=3, max_df=1.0).build()
+        self.assertEqual(self.stored(), self.expected(3))
+
+        # Tiny blocks give the same neighbours
+        SimilarityEngine(k=3, max_df=1.0, block_postings=1).build()
+        self.assertEqual(self.stored(), self.expected(3))
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_incremental_update(self):
+        from ngram.similarity import SimilarityEngine
+        engine = SimilarityEngine(k=2, max_df=1.0)
+        engine.build()
+        self.assertEqual(engine.update(), 0)
+
+        movie = self.movies[3]
+        movie.plot = "a sick cat ate some bad berries and the brown cat got sick"
+        MoviePlotAnalyzer.analyze(movie)
+        self.movies[4].delete()
+        self.assertGreater(engine.update(), 0)
+
+        stored = self.stored()
+        self.assertEqual(stored[movie.pk], self.expected(2)[movie.pk])
+        self.assertNotIn(self.movies[4].pk, stored)
+        self.assertFalse(any(self.movies[4].pk in [other for other, score in top] for top in stored.values()))
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_update_matches_build(self):
+        from ngram.similarity import SimilarityEngine
+        engine = SimilarityEngine(k=2, max_df=1.0)
+        engine.build()
+
+        # The neighbours that replace a changed one were never stored
+        movie = self.movies[0]
+        movie.plot = "a small dog drank some milk and the small dog went to sleep"
+        MoviePlotAnalyzer.analyze(movie)
+        engine.update()
+        updated = self.stored()
+
+        SimilarityEngine(k=2, max_df=1.0).build()
+        self.assertEqual(updated, self.stored())
+        self.assertTrue(all(len(top) == 2 for top in updated.values()))
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_update_reads_changed(self):
+        from ngram.similarity import SimilarityEngine
+        engine = SimilarityEngine(k=2, max_df=1.0)
+        engine.build()
+
+        reads, read = [], engine.read
+        engine.read = lambda movie_ids=None: reads.append(movie_ids) or read(movie_ids)
+        movie, deleted = self.movies[3], self.movies[4].pk
+        movie.plot = "a sick cat ate some bad berries and the brown cat got sick"
+        MoviePlotAnalyzer.analyze(movie)
+        self.movies[4].delete()
+        engine.update()
+
+        # Only the changed movies are read, into the same matrix as a full load
+        self.assertEqual(reads, [sorted([movie.pk, deleted])])
+        fresh = SimilarityEngine(k=2, max_df=1.0).load()
+        self.assertEqual(engine.movies.tolist(), fresh.movies.tolist())
+        self.assertEqual(engine.row_cols.tolist(), fresh.row_cols.tolist())
+        self.assertTrue(engines.np.allclose(engine.row_weights, fresh.row_weights))
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_movie_detail(self):
+        call_command('similar', neighbours=2, verbosity=0)
+        from movies.views import MovieDetail
+        view = MovieDetail()
+        view.object = Movie.objects.get(pk=self.movies[0].pk)
+        context = view.get_context_data(object=view.object)
+        self.assertEqual([row.similar.pk for row in context['similar_movies']],
+                         [pk for pk, score in self.stored()[view.object.pk]])
+        self.assertTrue(context['similar_movies'])
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_movie_detail_invalidation(self):
+        from django.core.cache import cache
+        from movies.views import MovieDetail
+        from movies.fragments import fragment_cache
+        cache.clear()
+        fragment_cache.reset()
+
+        def fragments():
+            view = MovieDetail(object=Movie.objects.get(pk=self.movies[0].pk))
+            return view.get_context_data(object=view.object)
+
+        self.assertNotIn("Similar Movies", fragments()['detail_fragment'])
+        call_command('similar', neighbours=2, verbosity=0)
+        self.assertIn("Similar Movies", fragments()['detail_fragment'])
+
+        neighbour = SimilarMovie.objects.filter(movie=self.movies[0])[0].similar
+        neighbour.title = "Renamed Neighbour"
+        neighbour.save()
+        self.assertIn("Renamed Neighbour", fragments()['detail_fragment'])
+
+        movie = self.movies[0]
+        self.assertNotIn("zebra", fragments()['analysis_fragment'])
+        movie.plot = "the zebra ate some bad berries"
+        MoviePlotAnalyzer.analyze(movie)
+        self.assertIn("zebra", fragments()['analysis_fragment'])
+
+class NGramIndexTest(NGramTestCase):
+
+    def test_export_matches_corpus(self):
+        import shutil, tempfile
+        from ngram.index import NGramIndex
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for idx, plot in enumerate((self.text, u"the caf\xe9 bear ate some berries")):
+            MoviePlotAnalyzer.analyze(Movie.objects.create(title="Movie %i" % idx, year="2013", plot=plot))
+
+        path = os.path.join(directory, "ngrams.idx")
+        call_command('export_ngram_index', path, batch_size=5, verbosity=0)
+
+        with NGramIndex(path) as index:
+            for row in NGramCorpusFrequency.objects.all():
+                key = as_tokens(row.ngram)
+                self.assertEqual(index.get(key if len(key) > 1 else key[0]), (row.frequency, row.documents))
+
+            self.assertEqual(index.frequency(u"caf\xe9"), 1)
+            self.assertEqual(index.get(("bear", "the")), (0, 0))
+            self.assertNotIn(("the", "unknown"), index)
+            self.assertEqual(len(index), Unigram.objects.count() + NGramCorpusFrequency.objects.exclude(
+                ngram_type=ContentType.objects.get_for_model(Unigram)).count())
+
+class ExportAnalysesTest(NGramTestCase):
+
+    plots = (
+        "the brown bear ate some bad berries and the brown bear got sick",
+        "a sick dog ate some bad meat and the sick dog got sicker",
+        "a small cat drank some milk and the small cat went to sleep",
+    )
+
+    def setUp(self):
+        super(ExportAnalysesTest, self).setUp()
+        import shutil, tempfile
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def analyze(self, plots, storage='rows'):
+        with self.settings(NGRAM_STORAGE=storage):
+            for plot in plots:
+                title = "Movie %i" % Movie.objects.count()
+                MoviePlotAnalyzer.analyze(Movie.objects.create(title=title, year="2013", plot=plot))
+
+    def expected(self, analysis):
+        rows = []
+        for model in NGRAM_MODELS:
+            for row in analysis.models_of_type(model):
+                rows.append((list(as_tokens(row.ngram)), row.frequency))
+        return sorted(rows)
+
+    def parts(self):
+        import json
+        parts = sorted(name for name in os.listdir(self.directory) if name.endswith('.jsonl'))
+        return [[json.loads(line) for line in open(os.path.join(self.directory, name))] for name in parts]
+
+    def test_export_resumes(self):
+        self.analyze(self.plots[:2])
+        self.analyze(self.plots[2:], storage='packed')
+        call_command('export_analyses', self.directory, batch_size=2, verbosity=0)
+
+        parts = self.parts()
+        self.assertEqual([len(part) for part in parts], [2, 1])
+        for record in sum(parts, []):
+            analysis = NGramPlotAnalysis.objects.get(pk=record['analysis'])
+            self.assertEqual(record['movie'], analysis.movie_id)
+            self.assertEqual(sorted(map(tuple, record['ngrams'])), map(tuple, self.expected(analysis)))
+
+        # A rerun only writes the analyses added since
+        self.analyze(["the small cat ate some bad fish and the small cat got sick"])
+        call_command('export_analyses', self.directory, batch_size=2, verbosity=0)
+        parts = self.parts()
+        self.assertEqual([len(part) for part in parts], [2, 1, 1])
+        self.assertEqual(parts[-1][0]['title'], "Movie 3")
+
+        call_command('export_analyses', self.directory, batch_size=5, restart=True, verbosity=0)
+        self.assertEqual([len(part) for part in self.parts()], [4])
+
+    def test_reanalysis_appends(self):
+        self.analyze(self.plots[:2])
+        call_command('export_analyses', self.directory, verbosity=0)
+
+        movie = Movie.objects.get(title="Movie 0")
+        movie.plot = "the brown bear ate some good berries"
+        MoviePlotAnalyzer.analyze(movie)
+        call_command('export_analyses', self.directory, verbosity=0)
+
+        # The movie is exported again; the latest analyzed record wins
+        records = [record for record in sum(self.parts(), []) if record['movie'] == movie.pk]
+        self.assertEqual(len(records), 2)
+        latest = max(records, key=lambda record: record['analyzed'])
+        self.assertEqual(latest['analysis'], movie.ngram_analysis.pk)
+        self.assertIn([["some", "good"], 1], latest['ngrams'])
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_npz_columns(self):
+        import numpy as np
+        self.analyze(self.plots)
+        call_command('export_analyses', self.directory, format='npz', verbosity=0)
+
+        columns = np.load(os.path.join(self.directory, "analyses-00001.npz"))
+        self.assertEqual(sorted(columns['analysis']), sorted(NGramPlotAnalysis.objects.values_list('pk', flat=True)))
+        self.assertEqual(len(columns['ngram']), NGramModel.objects.count())
+        self.assertEqual(columns['ngram_frequency'].sum(), sum(NGramModel.objects.values_list('frequency', flat=True)))
+
+        # Resuming in another format is refused
+        from ngram.management.commands.export_analyses import Command
+        with self.assertRaises(CommandError):
+            Command().handle(self.directory, format='jsonl', verbosity=0)
+
+class TextProcessorTest(NGramTestCase):
+
+    def test_process_many(self):
+        processor = NGramAnalyzer.processor
+        texts = [self.text, "", None, "one", self.text]
+        expected = [list(processor.process(text)) for text in texts]
+        for batch_size in (1, 2, 1000):
+            self.assertEqual(list(processor.process_many(texts, batch_size)), expected)
+
+    def test_nltk_tagger(self):
+        """
+        The NLTK segmenter and tagger tag the sentences of texts in batches.
+        """
+        processor = TextProcessor()
+        try:
+            processor.load()
+            nltk.word_tokenize("warm up")
+        except (LookupError, IOError) as e:
+            self.skipTest("NLTK data is not installed: %s" % e)
+
+        text = "The brown bear ate the berries. The bear got sick."
+        sentences = processor.process(text)
+        self.assertEqual([[token for token, tag in sentence] for sentence in sentences],
+                         [["The", "brown", "bear", "ate", "the", "berries", "."], ["The", "bear", "got", "sick", "."]])
+        self.assertTrue(all(tag for sentence in sentences for token, tag in sentence))
+        self.assertEqual(sentences[1], processor.postag(processor.tokenize("The bear got sick.")))
+        self.assertEqual(list(processor.process_many([text, text], batch_size=1)), [sentences, sentences])
+
+class TokenCacheTest(NGramTestCase):
+
+    def test_analyzers_share_tokens(self):
+        processor = NGramAnalyzer.processor
+        calls = []
+        processor.process = lambda text: calls.append(text) or WhitespaceProcessor.process(processor, text)
+        self.addCleanup(delattr, processor, 'process')
+
+        for factory in (unigrams, bigrams, trigrams):
+            list(iter(factory(self.text)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((token_cache.hits, token_cache.misses), (2, 1))
+        self.assertTrue(token_cache.bytes > 0)
+
+    def test_key_names_processor_module(self):
+        # A processor of the same name from another module does not share tokens
+        other = type('WhitespaceProcessor', (WhitespaceProcessor,), {'__module__': 'other.processors'})()
+        processor = NGramAnalyzer.processor
+        self.assertNotEqual(token_cache.key(self.text, other), token_cache.key(self.text, processor))
+
+        movie = Movie.objects.create(title="Bear", year="2013", plot=self.text)
+        fingerprint = MoviePlotAnalyzer.fingerprint(movie)
+        NGramAnalyzer.processor = other
+        self.addCleanup(setattr, NGramAnalyzer, 'processor', processor)
+        self.assertNotEqual(MoviePlotAnalyzer.fingerprint(movie), fingerprint)
+
+    def test_memory_bound(self):
+        cache  = TokenCache(max_bytes=2000)
+        tokens = [u"token%i" % idx for idx in xrange(10)]
+        for idx in xrange(10):
+            cache.set(str(idx), tokens)
+        self.assertTrue(0 < cache.bytes <= 2000)
+        self.assertIsNone(cache.get("0"))
+        self.assertEqual(cache.get("9"), tokens)
+
+    def test_disk_tier(self):
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        TokenCache(directory=directory).set("abc", [u"the", u"bear"])
+        cache = TokenCache(directory=directory)
+        self.assertEqual(cache.get("abc"), [u"the", u"bear"])
+        self.assertEqual((cache.disk_hits, len(cache)), (1, 1))
+
+class EncodingTest(NGramTestCase):
+
+    sentences = [
+        [(u'The', 'DT'), (u'brown', 'JJ'), (u'bear', 'NN'), (u'ate', 'VBD'), (u'.', '.')],
+        [],
+        [(u'Caf\xe9', 'NNP'), (u'the', 'DT'), (u'bear', 'NN')],
+    ]
+
+    def test_roundtrip(self):
+        data = encoding.encode(self.sentences, encoding.digest(u"source"), 1)
+        self.assertEqual(encoding.decode(data), self.sentences)
+        self.assertTrue(encoding.is_encoding_of(data, u"source", 1))
+        self.assertFalse(encoding.is_encoding_of(data, u"changed", 1))
+        self.assertFalse(encoding.is_encoding_of(data, u"source", 2))
+
+    def test_processor_identity(self):
+        """
+        Serializations of another processor are not reused.
+        """
+        serialized = WhitespaceProcessor().serialize(u"the brown bear")
+        self.assertTrue(WhitespaceProcessor().is_serialization_of(serialized, u"the brown bear"))
+        self.assertFalse(TextProcessor().is_serialization_of(serialized, u"the brown bear"))
+
+        # Format 1 encodings are still read, but match no processor
+        import zlib, base64
+        data = encoding.HEADERS[1].pack(encoding.MAGIC, 1, 1, encoding.digest(u"source"), 0, 1, 1, 1, 1)
+        data += ''.join((encoding._pack_strings([u'bear']), encoding._pack_strings(['NN']), encoding._pack_array('I', [1]),
+                         encoding._pack_array('H', [0]), encoding._pack_array('B', [0])))
+        old = base64.b64encode(zlib.compress(data))
+        self.assertEqual(encoding.decode(old), [[(u'bear', 'NN')]])
+        self.assertTrue(encoding.is_encoding_of(old, u"source", 1))
+        self.assertFalse(WhitespaceProcessor().is_serialization_of(old, u"source"))
+
+    def test_wide_tables(self):
+        sentences = [[(unicode(idx), 'T%i' % (idx % 300)) for idx in xrange(70000)]]
+        self.assertEqual(encoding.decode(encoding.encode(sentences)), sentences)
+
+    def test_invalid(self):
+        self.assertRaises(encoding.EncodingError, encoding.decode, "not an encoding")
+        self.assertFalse(encoding.is_encoding_of(None, u""))
+
+    def test_preprocessed_analysis(self):
+        """
+        Analyzers of the serialized text match analyzers of the raw text.
+        """
+        processor = NGramAnalyzer.processor
+        data = processor.serialize(self.text)
+        self.assertTrue(processor.is_serialization_of(data, self.text))
+        for N in (1, 2, 3):
+            self.assertEqual(list(NGramAnalyzer(data, N, preprocessed=True)), list(NGramAnalyzer(self.text, N)))
+
+    def test_movie_tagging_is_saved(self):
+        movie = Movie.objects.create(title="The Bear", year="2013", plot=self.text)
+        MoviePlotAnalyzer.analyze(movie)
+        movie = Movie.objects.get(pk=movie.pk)
+        self.assertTrue(NGramAnalyzer.processor.is_serialization_of(movie.plot_tagged, movie.plot))
+
+class EngineTest(NGramTestCase):
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_numpy_matches_python(self):
+        texts = (self.text, "", "one", "one two", " ".join(["the bear"] * 50 + ["ate"]))
+        for text in texts:
+            for klass in (NGramAnalyzer, MultiNGramAnalyzer):
+                for N in (1, 2, 3, 4):
+                    expected = Histogram()
+                    for ngram in klass(text, N):
+                        expected.increment(ngram)
+                    self.assertEqual(klass(text, N).frequency, expected)
+                    self.assertEqual(klass(text, N, engine='numpy').frequency, expected)
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_numpy_wide_codes(self):
+        engine = engines.NumpyEngine()
+        engine.max_code = 2
+        analyzer = NGramAnalyzer(self.text, 3)
+        self.assertEqual(engine.count(analyzer, list(analyzer.tokenize())), engines.PythonEngine().count(analyzer, list(analyzer.tokenize())))
+
+    @unittest.skipIf(engines.np is None, "NumPy is not installed")
+    def test_numpy_model_analyzer(self):
+        python = MultiNGramModelAnalyzer(self.text, 3).frequency
+        self.assertEqual(MultiNGramModelAnalyzer(self.text, 3, engine='numpy').frequency, python)
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, lambda: NGramAnalyzer(self.text, engine='fortran').frequency)
+
+class SketchTest(TestCase):
+
+    def stream(self):
+        # Key i is seen i times
+        return [u"key%i" % idx for idx in xrange(1, 201) for count in xrange(idx)]
+
+    def test_estimates(self):
+        sketch = ApproximateHistogram(error=0.001, heavy_hitters=10)
+        sketch.update(self.stream())
+        self.assertEqual(sketch.total, 200 * 201 / 2)
+
+        errors = [sketch[u"key%i" % idx] - idx for idx in xrange(1, 201)]
+        self.assertTrue(all(error >= 0 for error in errors))
+        self.assertLessEqual(sum(error > sketch.bound for error in errors), 200 * sketch.delta)
+        self.assertEqual(sorted(sketch), [u"key%i" % idx for idx in xrange(191, 201)])
+        self.assertEqual(sketch.most_common(1)[0][0], u"key200")
+
+    def test_memory_cap(self):
+        sketch = ApproximateHistogram(max_bytes=4096, heavy_hitters=10)
+        self.assertLessEqual(CountMinSketch.nbytes.fget(sketch), 4096)
+        self.assertGreater(sketch.error, ApproximateHistogram.error)
+
+        sketch.update(self.stream())
+        self.assertEqual(len(sketch), 10)
+        self.assertIn(u"key200", sketch)
+        self.assertRaises(ValueError, ApproximateHistogram, max_bytes=8)
+
+    def test_turnstile(self):
+        sketch = ApproximateHistogram(error=0.01, heavy_hitters=5)
+        sketch.update(self.stream())
+        tables, total = [table[:] for table in sketch.tables], sketch.total
+
+        counts = Histogram({u"extra": 7, u"key3": 2})
+        sketch.add(counts).subtract(counts)
+        self.assertEqual(sketch.tables, tables)
+        self.assertEqual(sketch.total, total)
+
+        # Heavy hitters follow their counts down
+        sketch.subtract({u"key200": 200})
+        self.assertNotIn(u"key200", sketch)
+        self.assertEqual(sketch.total, total - 200)
+        self.assertRaises(ValueError, ApproximateHistogram().decrease, u"never")
+
+    def test_merge_and_save(self):
+        import shutil, tempfile
+        stream = self.stream()
+        whole, first, second = [ApproximateHistogram(error=0.01, heavy_hitters=5) for idx in xrange(3)]
+        whole.update(stream)
+        first.update(stream[::2])
+        second.update(stream[1::2])
+        first.merge(second)
+        self.assertEqual(first.tables, whole.tables)
+        self.assertEqual(first.most_common(), whole.most_common())
+        self.assertRaises(ValueError, first.merge, ApproximateHistogram(error=0.1))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        loaded = ApproximateHistogram.load(first.save(os.path.join(directory, "counts.sketch")))
+        self.assertEqual((loaded.tables, loaded.heavy, loaded.total), (first.tables, first.heavy, first.total))
+
+    def test_analyzer_sketch(self):
+        sketch = ApproximateHistogram()
+        analyzer = NGramAnalyzer(NGramTestCase.text, 2, sketch=sketch)
+        analyzer.processor = WhitespaceProcessor()
+        frequency = analyzer.frequency
+        self.assertEqual(analyzer.frequency, frequency)
+        self.assertEqual(sketch.total, frequency.total)
+        self.assertEqual(sketch[("the", "brown")], 2)
+
+class HistogramTest(TestCase):
+
+    def test_running_total(self):
+        histogram = Histogram().count("the bear ate the berries the end".split())
+        self.assertEqual((histogram.total, histogram.distinct), (7, 5))
+
+        histogram.increment("bear")
+        histogram.increase("sick", 3)
+        histogram.decrement("the")
+        histogram["end"] = 5
+        del histogram["ate"]
+        histogram.pop("berries")
+        self.assertEqual(histogram.total, sum(histogram.values()))
+        self.assertEqual(histogram.total, 2 + 2 + 3 + 5)
+
+        histogram.add({"bear": 2, "new": 1})
+        self.assertEqual(histogram["bear"], 4)
+        self.assertEqual(histogram.total, sum(histogram.values()))
+        self.assertRaises(ValueError, histogram.__setitem__, "bad", 1.5)
+
+    def test_dict_semantics(self):
+        """
+        Construction and update take pairs and replace, like a dict.
+        """
+        histogram = Histogram([("a", 2), ("b", 3)], c=1)
+        self.assertEqual(histogram, {"a": 2, "b": 3, "c": 1})
+        histogram.update({"a": 5})
+        histogram.update([("b", 1)])
+        self.assertEqual(histogram, {"a": 5, "b": 1, "c": 1})
+        self.assertEqual(histogram.total, 7)
+        self.assertRaises(ValueError, Histogram, [("a", "many")])
+
+    def test_most_common(self):
+        histogram = Histogram({"a": 5, "b": 1, "c": 3, "d": 4})
+        self.assertEqual(histogram.most_common(2), [("a", 5), ("d", 4)])
+        self.assertEqual(histogram.least_common(2), [("b", 1), ("c", 3)])
+        self.assertEqual(histogram.maximum, ("a", 5))
+        self.assertEqual(histogram.minimum, ("b", 1))
+        self.assertEqual(histogram.average, 13 / 4)
+
+    def test_copy_and_pickle(self):
+        import pickle
+        histogram = Histogram().count("a b a c".split())
+        for other in (histogram.copy(), pickle.loads(pickle.dumps(histogram, 2))):
+            self.assertEqual(other, histogram)
+            self.assertEqual(other.total, 4)
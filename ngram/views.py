@@ -23,6 +23,5 @@ class MovieAnalyze(View):
 
     def analyze(self):
         self.movie = self.get_object()
-        if self.movie.ngram_analysis:
-            self.movie.ngram_analysis.delete()
-        self.ngram_analysis = self.analyzer.analyze(self.movie)
+        force = self.request.POST.get('force', '').lower() in ('1', 'true', 'on')
+        self.ngram_analysis = self.analyzer.analyze(self.movie, force=force)
@@ -0,0 +1,74 @@
+__author__ = 'benjamin'
+
+from ngram.managers import NGRAM_KEYS
+from ngram.models import Unigram, HashedNGram, get_model_for_order
+
+class Vocabulary(object):
+    """
+    Collects the distinct tokens and N-Gram windows of one or more texts
+    and resolves them against the database in bulk, so that the number of
+    queries scales with the number of batches rather than the number of
+    tokens in the texts.
+
+    Keys are tuples of token strings (a 1-tuple for a Unigram). Add keys
+    with update(), call resolve() and then index the vocabulary by key to
+    get the model instance.
+    """
+
+    def __init__(self, save=True):
+        self.save     = save
+        self.pending  = set()
+        self.resolved = {}
+
+    def add(self, key):
+        self.pending.add(key)
+
+    def update(self, keys):
+        self.pending.update(keys)
+
+    def resolve(self):
+        """
+        Resolves every pending key, creating the missing rows if save is
+        true. Keys that were already resolved cost no further queries.
+        """
+        pending = [key for key in self.pending if key not in self.resolved]
+        self.pending = set()
+        if not pending: return self
+
+        # Resolve the Unigrams first, since they key the higher orders
+        tokens = set()
+        orders = {}
+        for key in pending:
+            tokens.update(token for token in key if (token,) not in self.resolved)
+            if len(key) > 1:
+                orders.setdefault(len(key), []).append(key)
+
+        if tokens:
+            for token, unigram in Unigram.objects.resolve(tokens, save=self.save).items():
+                self.resolved[(token,)] = unigram
+
+        for order, keys in sorted(orders.items()):
+            model  = get_model_for_order(order)
+            idents = dict((tuple(self.resolved[(token,)].pk for token in key), key) for key in keys)
+            for ident, ngram in model.objects.resolve(idents.keys(), save=self.save).items():
+                key = idents[ident]
+
+                # Prime the foreign key caches with the resolved Unigrams
+                unigrams = tuple(self.resolved[(token,)] for token in key)
+                if model is HashedNGram:
+                    ngram._components_cache = unigrams
+                else:
+                    for name, unigram in zip(NGRAM_KEYS, unigrams):
+                        setattr(ngram, '_%s_cache' % name, unigram)
+                self.resolved[key] = ngram
+
+        return self
+
+    def __getitem__(self, key):
+        return self.resolved[key]
+
+    def __contains__(self, key):
+        return key in self.resolved
+
+    def __len__(self):
+        return len(self.resolved)